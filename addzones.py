@@ -1,41 +1,69 @@
-import itertools
+"""
+Provisions the test zones (see zonematrix.py) on the knot name server and delegates them from ZONE at deSEC.
+
+By default, the zones are provisioned in phases: one knotc session with a single configuration transaction for all
+zones and one zone transaction per zone, key generation with up to --jobs parallel keymgr processes, and a second
+knotc session that enables signing and removes DNSKEYs. With --serial, the zones are added one after another as
+before. Per-phase timings are logged at the end. fakeknot.py checks that both produce the same commands.
+
+With --incremental, the state of the name server (knotc conf-read, zone-status and zone-read, keymgr list and ds) and
+the delegations at deSEC are read first, and only what is missing is added: zones, zone contents, keys, signing,
+DNSKEY removals and changed delegations. --dry-run prints this plan without applying it.
+
+Keys are taken from the key pool in FIXED_KEYS_DIR (see keypool.py) where possible: the key a zone had before, or a
+pre-generated one. keymgr generates keys only when the pool has none, or for all keys with --new-keys.
+DS and DNSKEY records are computed from the PEM files of the keys (see keymaterial.py), and taken from keymgr only
+for zones with keys of unknown origin; --verify-keys compares them to those of keymgr for all zones.
+"""
+import argparse
+import concurrent.futures
 import json
 import logging
 import os
+import re
 import shutil
 import subprocess
-from typing import List
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Set, Tuple
 
 import dns.dnssec
 import dns.name
+import dns.rdata
 import dns.rrset
-import requests
 from tqdm import tqdm
 
-# requirements: dnspython, requests, tqdm
+from desec import Desec, RRsetKey, rrset_key, same_rrset
+from keymaterial import KeyMaterial
+from keypool import KeyPool
+from zonematrix import zones as zone_matrix
+
+# requirements: cryptography, dnspython, requests, tqdm
 
 logging.basicConfig(level=logging.WARNING)
 
-ZONE = dns.name.from_text(os.environ.get('ZONE'))
 MITM_A_RR = os.environ.get('MITM_A_RR')
 A_RR = os.environ.get('A_RR')
 TTL = os.environ.get('TTL', 0)
-DESEC_TOKEN = os.environ['DESEC_TOKEN']
+KEYS_DIR = os.environ.get('KNOT_KEYS_DIR', '/storage/keys/keys')
+FIXED_KEYS_DIR = os.environ.get('FIXED_KEYS_DIR', '/fixed-keys')
+KEYS = KeyMaterial(int(TTL))  # keys of the zones, where their PEM files are known
 
 IN = dns.rdataclass.from_text("IN")
 DS = dns.rdatatype.from_text("DS")
 DNSKEY = dns.rdatatype.from_text("DNSKEY")
 NS = dns.rdatatype.from_text("NS")
 
-ALGORITHMS = [
-    dns.dnssec.RSASHA1,
-    dns.dnssec.RSASHA256,
-    dns.dnssec.RSASHA512,
-    dns.dnssec.ECDSAP256SHA256,
-    dns.dnssec.ECDSAP384SHA384,
-    dns.dnssec.ED25519,
-    dns.dnssec.ED448,
-]
+KEYSIZES = {
+    dns.dnssec.RSASHA1: 2048,
+    dns.dnssec.RSASHA256: 2048,
+    dns.dnssec.RSASHA512: 2048,
+    dns.dnssec.ECDSAP256SHA256: 256,
+    dns.dnssec.ECDSAP384SHA384: 384,
+    dns.dnssec.ED25519: 256,
+    dns.dnssec.ED448: 456,
+}
 
 
 def run(args, stdin: str = None) -> str:
@@ -52,22 +80,90 @@ def knotc(commands: str) -> str:
     return run(["knotc"], stdin=commands)
 
 
-def add_algorithm(zone: dns.name.Name, algorithm: dns.dnssec.Algorithm) -> None:
-    keysizes = {
-        dns.dnssec.RSASHA1: 2048,
-        dns.dnssec.RSASHA256: 2048,
-        dns.dnssec.RSASHA512: 2048,
-        dns.dnssec.ECDSAP256SHA256: 256,
-        dns.dnssec.ECDSAP384SHA384: 384,
-        dns.dnssec.ED25519: 256,
-        dns.dnssec.ED448: 456,
-    }
-    stdout = run(["keymgr", zone.to_text(), "generate", f"algorithm={algorithm}", f"size={keysizes[algorithm]}", "ksk=true", "zsk=true"])
+class KnotcSession:
+    """A single knotc process that executes all commands sent to it, in order; close() waits for them to finish."""
+
+    def __init__(self) -> None:
+        self.process = subprocess.Popen(["knotc"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        self.commands = 0
+        self.output: List[str] = []
+        self.reader = threading.Thread(target=lambda: self.output.extend(self.process.stdout), daemon=True)
+        self.reader.start()  # keeps knotc from blocking on a full stdout pipe
+
+    def send(self, commands: List[str]) -> None:
+        self.process.stdin.write("".join(f"{command}\n" for command in commands))
+        self.commands += len(commands)
+
+    def close(self) -> str:
+        self.process.stdin.close()
+        self.process.wait()
+        self.reader.join()
+        stdout = "".join(self.output)
+        logging.info(f"knotc session ({self.commands} commands): {stdout}")
+        if self.process.returncode:
+            raise RuntimeError(f"knotc exited with {self.process.returncode}")
+        return stdout
+
+
+def zone_conf_commands(fqdn: str) -> List[str]:
+    return [
+        f'conf-set "zone[{fqdn}]"',
+        f'conf-set "zone[{fqdn}].dnssec-signing" off',
+        f'conf-set "zone[{fqdn}].acl" "acme"',
+    ]
+
+
+def zone_content_commands(name: dns.name.Name, a_record: str, ns_a_record: str) -> List[str]:
+    fqdn = name.to_text()
+    ns = dns.name.Name(['ns'])
+    return [
+        f'zone-set "{fqdn}" @ {TTL} SOA get.desec.io. get.desec.io. 2021014779 86400 86400 2419200 {TTL}',
+        f'zone-set "{fqdn}" @ {TTL} NS "{(ns + name.parent()).to_text()}"',
+        f'zone-set "{fqdn}" ns {TTL} A "{ns_a_record}"',
+        f'zone-set "{fqdn}" @ {TTL} A "{a_record}"',
+        f'zone-set "{fqdn}" * {TTL} A "{a_record}"',
+        f'zone-set "{fqdn}" @ {TTL} TXT "research test zone"',
+        f'zone-set "{fqdn}" * {TTL} TXT "research test zone"',
+        f'zone-set "{fqdn}" mitm-rs16-rd {TTL} NS "ns1.desec.io."',
+        f'zone-set "{fqdn}" mitm-rs16-rd {TTL} NS "ns2.desec.org."',
+        f'zone-set "{fqdn}" mitm-rs16-rd {TTL} DS "29449 13 2 {"f" * 64}"',
+        f'zone-set "{fqdn}" mitm-rs16-rd {TTL} DS "29449 13 4 {"f" * 96}"',
+    ]
+
+
+def signing_commands(fqdn: str) -> List[str]:
+    return [
+        f'conf-set "zone[{fqdn}].dnssec-policy" "nsec1"',
+        f'conf-set "zone[{fqdn}].dnssec-signing" on',
+    ]
+
+
+def conf_transaction(commands: List[str]) -> List[str]:
+    return ["conf-begin", *commands, "conf-commit"]
+
+
+def zone_transaction(fqdn: str, commands: List[str]) -> List[str]:
+    return [f'zone-begin "{fqdn}"', *commands, f'zone-commit "{fqdn}"']
+
+
+def add_algorithm(zone: dns.name.Name, algorithm: dns.dnssec.Algorithm, pool: Optional[KeyPool] = None) -> None:
+    """Adds a key to the zone: the one of the zone in the key pool, a new one from the pool, or a generated one."""
+    pem = pool.key_for(zone, algorithm) if pool else None
+    if pem:
+        stdout = run(["keymgr", zone.to_text(), "import-pem", pem, f"algorithm={algorithm}", "ksk=true", "zsk=true"])
+    else:
+        stdout = run(["keymgr", zone.to_text(), "generate", f"algorithm={algorithm}", f"size={KEYSIZES[algorithm]}", "ksk=true", "zsk=true"])
     keyid = [line for line in stdout.strip().split('\n') if 'warning' not in line][0]
-    shutil.copyfile(f"/storage/keys/keys/{keyid}.pem", f"/fixed-keys/{zone.to_text()}-{algorithm}.pem")
+    if not pem:
+        pem = f"{FIXED_KEYS_DIR}/{zone.to_text()}-{algorithm}.pem"
+        shutil.copyfile(f"{KEYS_DIR}/{keyid}.pem", pem)
+    if pool:
+        pool.bind(zone, algorithm, pem, keyid)
+    KEYS.add(zone, algorithm, pem)
 
 
 def get_ds(zone: dns.name.Name) -> dns.rrset.RRset:
+    """The DS records of the zone from keymgr; see zone_ds."""
     stdout = run(["keymgr", zone.to_text(), "ds"])
     content = [x.split(' ', 2)[-1] for x in stdout.split('\n') if x]
     logging.debug(content)
@@ -81,106 +177,315 @@ def get_dnskeys(zone: dns.name.Name) -> dns.rrset.RRset:
     return dns.rrset.from_text_list(zone, TTL, IN, DNSKEY, content)
 
 
+def zone_ds(zone: dns.name.Name) -> dns.rrset.RRset:
+    """The DS records of the zone, computed from its keys if they are known, else from keymgr."""
+    return KEYS.ds(zone) if zone in KEYS else get_ds(zone)
+
+
+def zone_dnskeys(zone: dns.name.Name) -> dns.rrset.RRset:
+    return KEYS.dnskey(zone) if zone in KEYS else get_dnskeys(zone)
+
+
+def verify_keys(jobs: int) -> None:
+    """Compares the DS and DNSKEY records computed from the keys to those of keymgr, for all zones."""
+    def differences(zone: dns.name.Name) -> List[str]:
+        return [
+            f"{zone} {what}: {ours.to_text()} instead of {theirs.to_text()}"
+            for what, ours, theirs in [('DS', KEYS.ds(zone), get_ds(zone)), ('DNSKEY', KEYS.dnskey(zone), get_dnskeys(zone))]
+            if set(ours) != set(theirs)
+        ]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        problems = [problem for problems in executor.map(differences, KEYS.zones()) for problem in problems]
+    for problem in problems:
+        logging.error(problem)
+    if problems:
+        raise RuntimeError(f"records computed from the keys differ from keymgr for {len(problems)} RRsets")
+    logging.warning(f"DS and DNSKEY records of {len(KEYS.zones())} zones are the same as those of keymgr")
+
+
+def dnskey_removal_commands(name: dns.name.Name, remove_dnskeys: List[dns.dnssec.Algorithm]) -> List[str]:
+    fqdn = name.to_text()
+    return [f'zone-unset "{fqdn}" @ DNSKEY {dnskey}' for dnskey in zone_dnskeys(name) if dnskey.algorithm in remove_dnskeys]
+
+
 def delegate(delegatee: dns.name.Name) -> List[dns.rrset.RRset]:
     delegator = delegatee.parent()
     logging.debug(f"Delegating from {delegator} to {delegatee}")
-    ds = get_ds(delegatee)
+    ds = zone_ds(delegatee)
     ns = dns.rrset.from_text(delegatee, TTL, IN, NS, (dns.name.Name(['ns']) + delegator).to_text())
     return [ns, ds]
 
 
 def add_zone(name: dns.name.Name, a_record: str, ns_a_record: str, sign_with: List[dns.dnssec.Algorithm],
-             remove_dnskeys: List[dns.dnssec.Algorithm]):
+             remove_dnskeys: List[dns.dnssec.Algorithm], pool: Optional[KeyPool] = None):
     fqdn = name.to_text()
-    ns = dns.name.Name(['ns'])
-    knotc(
-        f"""
-        conf-begin
-            conf-set "zone[{fqdn}]"
-            conf-set "zone[{fqdn}].dnssec-signing" off
-            conf-set "zone[{fqdn}].acl" "acme"
-        conf-commit
-        
-        zone-begin "{fqdn}"
-            zone-set "{fqdn}" @ {TTL} SOA get.desec.io. get.desec.io. 2021014779 86400 86400 2419200 {TTL}
-            zone-set "{fqdn}" @ {TTL} NS "{(ns + name.parent()).to_text()}"
-            zone-set "{fqdn}" ns {TTL} A "{ns_a_record}"
-            zone-set "{fqdn}" @ {TTL} A "{a_record}"
-            zone-set "{fqdn}" * {TTL} A "{a_record}"
-            zone-set "{fqdn}" @ {TTL} TXT "research test zone"
-            zone-set "{fqdn}" * {TTL} TXT "research test zone"
-            zone-set "{fqdn}" mitm-rs16-rd {TTL} NS "ns1.desec.io."
-            zone-set "{fqdn}" mitm-rs16-rd {TTL} NS "ns2.desec.org."
-            zone-set "{fqdn}" mitm-rs16-rd {TTL} DS "29449 13 2 ffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff"
-            zone-set "{fqdn}" mitm-rs16-rd {TTL} DS "29449 13 4 ffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff"
-        zone-commit "{fqdn}"        
-        """
-    )
+    knotc("\n".join(
+        conf_transaction(zone_conf_commands(fqdn)) +
+        zone_transaction(fqdn, zone_content_commands(name, a_record, ns_a_record))
+    ))
 
     for algorithm in sign_with:
-        add_algorithm(name, algorithm)
+        add_algorithm(name, algorithm, pool)
 
     if sign_with:
-        knotc(
-            f"""
-            conf-begin
-                conf-set "zone[{fqdn}].dnssec-policy" "nsec1"
-                conf-set "zone[{fqdn}].dnssec-signing" on
-            conf-commit            
-            """
+        knotc("\n".join(conf_transaction(signing_commands(fqdn))))
+
+    for command in dnskey_removal_commands(name, remove_dnskeys) if remove_dnskeys else []:
+        knotc("\n".join(zone_transaction(fqdn, [command])))
+
+
+def rrset_data(rrset: dns.rrset.RRset) -> dict:
+    return {
+        'subname': dns.name.Name(rrset.name[:1]).to_text(), 'ttl': 60,
+        'type': dns.rdatatype.to_text(rrset.rdtype), 'records': [rr.to_text() for rr in rrset],
+    }
+
+
+def read_conf() -> Dict[str, Dict[str, str]]:
+    """Items of the configured zones, by lowercase zone name, from knotc conf-read."""
+    conf = {}
+    for line in run(["knotc", "conf-read", "zone"]).split('\n'):
+        match = re.match(r'zone\[([^\]]+)\](?:\.([\w-]+) = (.*))?$', line.strip())
+        if match:
+            items = conf.setdefault(match.group(1).lower(), {})
+            if match.group(2):
+                items[match.group(2)] = match.group(3)
+    return conf
+
+
+def read_serials() -> Dict[str, int]:
+    """SOA serials of the zones that have contents, by lowercase zone name, from knotc zone-status."""
+    return {
+        match.group(1).lower(): int(match.group(2))
+        for match in re.finditer(r'^\[([^\]]+)\].*\bserial: (\d+)', run(["knotc", "zone-status"]), re.MULTILINE)
+    }
+
+
+def read_dnskey_algorithms(names: List[dns.name.Name]) -> Dict[str, Set[int]]:
+    """Algorithms of the DNSKEYs published in the zones, by lowercase zone name, from knotc zone-read."""
+    algorithms = {name.to_text().lower(): set() for name in names}
+    if not names:
+        return algorithms
+    session = KnotcSession()
+    session.send([f'zone-read "{name.to_text()}" @ DNSKEY' for name in names])
+    for line in session.close().split('\n'):
+        fields = line.split()  # [zone.] owner ttl DNSKEY flags protocol algorithm key
+        if len(fields) > 6 and fields[3] == 'DNSKEY' and fields[0][1:-1].lower() in algorithms:
+            algorithms[fields[0][1:-1].lower()].add(int(fields[6]))
+    return algorithms
+
+
+def list_keys(zone: dns.name.Name) -> Dict[str, int]:
+    """Algorithms of the keys of the zone by key id, from keymgr list."""
+    return {
+        keyid: int(algorithm)
+        for keyid, algorithm in re.findall(r'^(\w+) .*\balgorithm=(\d+)', run(["keymgr", zone.to_text(), "list"]), re.MULTILINE)
+    }
+
+
+class Plan:
+    """What to add for the zones on the name server and at deSEC."""
+
+    def __init__(self) -> None:
+        self.conf: List[dns.name.Name] = []
+        self.contents: List[dns.name.Name] = []
+        self.keys: List[Tuple[dns.name.Name, dns.dnssec.Algorithm]] = []
+        self.signing: List[dns.name.Name] = []
+        self.removals: Dict[dns.name.Name, List[dns.dnssec.Algorithm]] = {}  # algorithms of DNSKEYs to remove
+        self.delegations: List[dict] = []  # changed delegation RRsets, as sent to deSEC
+        self.pending_delegations: List[dns.name.Name] = []  # zones whose DS is known after key generation only
+        self.current_delegations: Dict[RRsetKey, dict] = {}  # RRsets at deSEC
+
+    @classmethod
+    def everything(cls, zones) -> 'Plan':
+        plan = cls()
+        for algorithms, remove_dnskeys, name in zones:
+            plan.conf.append(name)
+            plan.contents.append(name)
+            plan.keys += [(name, algorithm) for algorithm in algorithms]
+            if algorithms:
+                plan.signing.append(name)
+            if remove_dnskeys:
+                plan.removals[name] = remove_dnskeys
+            plan.pending_delegations.append(name)
+        return plan
+
+    def changed_delegations(self, rrsets: List[dns.rrset.RRset]) -> List[dict]:
+        return [
+            rrset for rrset in map(rrset_data, rrsets)
+            if not same_rrset(rrset, self.current_delegations.get(rrset_key(rrset)))
+        ]
+
+    def summary(self) -> str:
+        return f"{len(self.conf)} zones to configure, {len(self.contents)} to fill, {len(self.keys)} keys to " \
+               f"generate, {len(self.signing)} zones to sign, DNSKEYs to remove from {len(self.removals)} zones, " \
+               f"{len(self.delegations)} delegation RRsets to update, {len(self.pending_delegations)} zones to " \
+               f"delegate after key generation"
+
+    def __str__(self) -> str:
+        return "\n".join(
+            [f"configure {name}" for name in self.conf] +
+            [f"fill {name}" for name in self.contents] +
+            [f"generate key {name} algorithm={int(algorithm)}" for name, algorithm in self.keys] +
+            [f"sign {name}" for name in self.signing] +
+            [f"remove DNSKEY {name} algorithm={int(algorithm)}"
+             for name, algorithms in self.removals.items() for algorithm in algorithms] +
+            [f"delegate {rrset['subname']} {rrset['type']} {' '.join(rrset['records']) or '(delete)'}"
+             for rrset in self.delegations] +
+            [f"delegate {name} after key generation" for name in self.pending_delegations] +
+            [self.summary()]
         )
 
-    if remove_dnskeys:
-        dnskeys = get_dnskeys(name)
-        for dnskey in dnskeys:
-            if dnskey.algorithm in remove_dnskeys:
-                knotc(
-                    f"""
-                    zone-begin "{fqdn}"
-                        zone-unset "{fqdn}" @ DNSKEY {dnskey}
-                    zone-commit "{fqdn}"               
-                    """
+
+def make_plan(zones, jobs: int, desec: Optional[Desec], pool: Optional[KeyPool]) -> Plan:
+    """Compares the state of the name server and the delegations at deSEC (if given) to the zones."""
+    plan = Plan()
+    conf, serials = read_conf(), read_serials()
+    configured = [name for _, _, name in zones if name.to_text().lower() in conf]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:  # each task runs a keymgr process
+        listed = dict(zip(configured, executor.map(list_keys, configured)))
+        for name, zone_keys in listed.items():
+            KEYS.load(name, zone_keys, pool)
+        keys = {name: set(zone_keys.values()) for name, zone_keys in listed.items()}
+        complete = [name for algorithms, _, name in zones if name in keys and set(algorithms) <= keys[name]]
+        delegations = dict(zip(complete, executor.map(delegate, complete)))
+    published = read_dnskey_algorithms([name for name in configured if name.to_text().lower() in serials])
+    if desec:
+        plan.current_delegations = {rrset_key(rrset): rrset for rrset in desec.rrsets()}
+
+    for algorithms, remove_dnskeys, name in zones:
+        fqdn = name.to_text().lower()
+        items = conf.get(fqdn, {})
+        if fqdn not in conf:
+            plan.conf.append(name)
+        if fqdn not in serials:
+            plan.contents.append(name)
+        missing = [algorithm for algorithm in algorithms if algorithm not in keys.get(name, set())]
+        plan.keys += [(name, algorithm) for algorithm in missing]
+        signing = bool(algorithms) and (items.get('dnssec-signing') != 'on' or items.get('dnssec-policy') != 'nsec1')
+        if signing:
+            plan.signing.append(name)
+        # knot publishes the DNSKEYs of new keys and of zones that become signed
+        remove = [a for a in remove_dnskeys if signing or a in missing or a in published.get(fqdn, set())]
+        if remove:
+            plan.removals[name] = remove
+        if name in delegations:
+            plan.delegations += plan.changed_delegations(delegations[name])
+        else:
+            plan.pending_delegations.append(name)
+    return plan
+
+
+class Timings:
+
+    def __init__(self) -> None:
+        self.phases: Dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - start
+            logging.warning(f"{name}: {self.phases[name]:.1f}s")
+
+    def __str__(self) -> str:
+        return ", ".join(f"{name} {seconds:.1f}s" for name, seconds in self.phases.items()) + \
+            f", total {sum(self.phases.values()):.1f}s"
+
+
+def provision(plan: Plan, a_record: str, ns_a_record: str, jobs: int, timings: Timings,
+              pool: Optional[KeyPool] = None) -> None:
+    """Applies the plan, in phases; see the module docstring."""
+    with timings.phase("configuration and zone contents"):
+        if plan.conf or plan.contents:
+            session = KnotcSession()
+            if plan.conf:
+                session.send(conf_transaction([command for name in plan.conf for command in zone_conf_commands(name.to_text())]))
+            for name in plan.contents:
+                session.send(zone_transaction(name.to_text(), zone_content_commands(name, a_record, ns_a_record)))
+            session.close()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:  # each task runs a keymgr process
+        with timings.phase("key generation"):
+            keys = [executor.submit(add_algorithm, name, algorithm, pool) for name, algorithm in plan.keys]
+            for future in tqdm(concurrent.futures.as_completed(keys), total=len(keys)):
+                future.result()
+
+        with timings.phase("signing and DNSKEY removal"):
+            if plan.signing or plan.removals:
+                session = KnotcSession()
+                if plan.signing:
+                    session.send(conf_transaction([command for name in plan.signing
+                                                   for command in signing_commands(name.to_text())]))
+                removals = {
+                    name: executor.submit(dnskey_removal_commands, name, remove_dnskeys)
+                    for name, remove_dnskeys in plan.removals.items()
+                }
+                for name, commands in removals.items():
+                    if commands.result():
+                        session.send(zone_transaction(name.to_text(), commands.result()))
+                session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--serial', action='store_true', help="add the zones one after another")
+    parser.add_argument('--incremental', action='store_true', help="only add what is missing")
+    parser.add_argument('--dry-run', action='store_true', help="print what --incremental would do, and exit")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help="parallel keymgr processes")
+    parser.add_argument('--no-desec', action='store_true', help="print the delegations instead of sending them")
+    parser.add_argument('--new-keys', action='store_true', help="generate all keys, do not use the key pool")
+    parser.add_argument('--verify-keys', action='store_true', help="compare the DS and DNSKEY records to keymgr")
+    args = parser.parse_args()
+
+    zone = dns.name.from_text(os.environ.get('ZONE'))
+    zones = zone_matrix(zone)
+    desec = None if args.no_desec else Desec(zone.to_text(), os.environ["DESEC_TOKEN"])
+    pool = None if args.new_keys else KeyPool(FIXED_KEYS_DIR)
+    timings = Timings()
+
+    if args.incremental or args.dry_run:
+        with timings.phase("reading state"):
+            plan = make_plan(zones, args.jobs, desec, pool)
+        if args.dry_run:
+            print(plan)
+            return
+        logging.warning(plan.summary())
+        provision(plan, A_RR, MITM_A_RR, args.jobs, timings, pool)
+    elif args.serial:
+        plan = Plan.everything(zones)
+        with timings.phase("zones"):
+            for algorithms, remove_dnskeys, name in tqdm(zones):
+                add_zone(
+                    name=name,
+                    a_record=A_RR,
+                    ns_a_record=MITM_A_RR,
+                    sign_with=algorithms,
+                    remove_dnskeys=remove_dnskeys,
+                    pool=pool,
                 )
+    else:
+        plan = Plan.everything(zones)
+        provision(plan, A_RR, MITM_A_RR, args.jobs, timings, pool)
 
+    with timings.phase("delegation"):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            pending = [rrset for rrsets in executor.map(delegate, plan.pending_delegations) for rrset in rrsets]
+        delegations = plan.delegations + plan.changed_delegations(pending)
+        if args.no_desec:
+            print(json.dumps(delegations, indent=4))
+        elif delegations:
+            result = desec.sync(delegations)
+            logging.warning(f"deSEC: {result}")
+            if result.rejected or result.mismatched:
+                raise RuntimeError(f"delegations at deSEC are incomplete: {result}")
+    if args.verify_keys:
+        verify_keys(args.jobs)
+    logging.warning(f"provisioned {len(zones)} zones: {timings}")
 
-zones = [
-    (
-        algos, remove_dnskeys,
-        dns.name.from_text(
-            "-".join(
-                [f"ds{a}" for a in sorted(algos)] +
-                [f"dnskey{int(a)}" for a in sorted(set(algos) - set(remove_dnskeys))]
-            ),
-            origin=ZONE
-        ),
-    )
-    for algos in itertools.chain(itertools.combinations(ALGORITHMS, 1), itertools.combinations(ALGORITHMS, 2))
-    for remove_dnskeys in [[a for i, a in enumerate(algos) if v[i]] for v in itertools.product([True, False], repeat=len(algos))]
-]
-
-for algorithms, remove_dnskeys, name in tqdm(zones):
-    add_zone(
-        name=name,
-        a_record=A_RR,
-        ns_a_record=MITM_A_RR,
-        sign_with=algorithms,
-        remove_dnskeys=remove_dnskeys,
-    )
-
-delegations = [rrset for _, _, zone in zones for rrset in delegate(zone)]
-data = json.dumps([
-        {
-            'subname': dns.name.Name(rrset.name[:1]).to_text(), 'ttl': 60,
-            'type': dns.rdatatype.to_text(rrset.rdtype), 'records': [rr.to_text() for rr in rrset],
-        }
-        for rrset in delegations
-    ], indent=4)
-requests.patch(
-    url=f"https://desec.io/api/v1/domains/{ZONE.to_text().rstrip('.')}/rrsets/",
-    headers={
-        'Authorization': f'Token {DESEC_TOKEN}',
-        'Content-Type': 'application/json',
-    },
-    data=data
-)
 
+if __name__ == '__main__':
+    main()
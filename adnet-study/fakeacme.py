@@ -0,0 +1,242 @@
+"""
+Fake acme.sh, to run genvhost.py without an ACME server and knot, and a check of genvhost.py against it:
+
+    python3 fakeacme.py check [--zone downgrade.dedyn.io] [--jobs 8] [--delay 0.5]
+
+The fake is put in place of acme.sh as a shim calling `fakeacme.py acme.sh`. It logs the start and end of every
+invocation to $FAKEACME_DIR/log.jsonl and, for --issue, sleeps --delay seconds (the dns-01 round trip and --dnssleep)
+before it writes a self-signed certificate for the -d names to the cert home, in the files acme.sh writes. The
+certificate is valid for 90 days, or as many days as $FAKEACME_DIR/days.json says for the name; issuance fails for the
+names in $FAKEACME_DIR/fail.json. Like acme.sh, it skips a certificate that exists and is not due without --force.
+
+The check runs genvhost.py certs on an old-style vhosts file with duplicate blocks and a block of another site, and
+verifies that all certificates are issued with the first issuance alone and at most --jobs at a time, overlapping
+(the time of all acme.sh processes is at least 1.5 times the elapsed time), and that the vhosts are those of the zone
+matrix, each once, with the other site kept. Then a run with nothing to do must not invoke acme.sh nor touch the
+vhosts file, and a run after some certificates expire and one is lost must issue exactly those, with a failure
+leaving out the vhost of the name without certificate and every other block unchanged.
+"""
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Tuple
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+import genvhost
+
+
+def log(entry: dict) -> None:
+    line = json.dumps({'time': time.time(), 'pid': os.getpid(), **entry}) + "\n"
+    fd = os.open(os.path.join(os.environ['FAKEACME_DIR'], 'log.jsonl'), os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
+
+
+def setting(name: str, default):
+    path = os.path.join(os.environ['FAKEACME_DIR'], name)
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def self_signed(names: List[str], days: float) -> Tuple[bytes, bytes]:
+    key = ec.generate_private_key(ec.SECP256R1())
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, names[0])])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = x509.CertificateBuilder().subject_name(subject).issuer_name(subject).public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()).not_valid_before(now - datetime.timedelta(hours=1)) \
+        .not_valid_after(now + datetime.timedelta(days=days)) \
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName(name) for name in names]), critical=False) \
+        .sign(key, hashes.SHA256())
+    return cert.public_bytes(serialization.Encoding.PEM), key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+
+
+def fake_acme_sh(args: List[str]) -> int:
+    parser = argparse.ArgumentParser(prog='acme.sh')
+    parser.add_argument('--issue', action='store_true')
+    parser.add_argument('-d', dest='names', action='append', default=[])
+    parser.add_argument('--cert-home', default=os.path.expanduser('~/.acme.sh'))
+    parser.add_argument('--keylength', default='2048')
+    parser.add_argument('--force', action='store_true')
+    options, _ = parser.parse_known_args(args)
+    name = options.names[0]
+    log({'event': 'start', 'args': args, 'name': name})
+    directory = genvhost.cert_dir(options.cert_home, name, options.keylength)
+    returncode = 0
+    if not options.issue:
+        returncode = 1
+    elif not options.force and os.path.exists(os.path.join(directory, f"{name}.cer")) and not \
+            genvhost.certificate_problem(directory, name, True, datetime.timedelta(days=30),
+                                         datetime.datetime.now(datetime.timezone.utc)):
+        print(f"Skip, Next renewal time is in the future: {name}")
+        returncode = 2
+    else:
+        time.sleep(float(os.environ.get('FAKEACME_DELAY', 0)))
+        if name in setting('fail.json', []):
+            print(f"{name}: Verify error: Invalid status, the TXT record was not found")
+            returncode = 1
+        else:
+            cert, key = self_signed(options.names, setting('days.json', {}).get(name, 90))
+            os.makedirs(directory, exist_ok=True)
+            for file, content in [(f"{name}.cer", cert), (f"{name}.key", key), ("ca.cer", cert),
+                                  ("fullchain.cer", cert)]:
+                with open(os.path.join(directory, file), 'wb') as f:
+                    f.write(content)
+            print(f"Cert success. Your cert is in: {directory}/{name}.cer")
+    log({'event': 'end', 'name': name, 'returncode': returncode})
+    return returncode
+
+
+class Check:
+    """Runs of genvhost.py against the fake acme.sh in a directory, and expectations on their effects."""
+
+    def __init__(self, directory: str, args) -> None:
+        self.directory = directory
+        self.args = args
+        self.cert_home = os.path.join(directory, 'ssl')
+        self.out = os.path.join(directory, 'vhosts.conf-part')
+        self.shim = os.path.join(directory, 'acme.sh')
+        with open(self.shim, 'w') as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.abspath(__file__)}" acme.sh "$@"\n')
+        os.chmod(self.shim, 0o755)
+        self.env = dict(os.environ, FAKEACME_DIR=directory, FAKEACME_DELAY=str(args.delay))
+        self.problems: List[str] = []
+
+    def expect(self, condition: bool, problem: str) -> None:
+        print(f"  {'ok' if condition else 'FAILED'}: {problem}")
+        if not condition:
+            self.problems.append(problem)
+
+    def genvhost(self, *args: str) -> Tuple[int, float, List[dict]]:
+        """Runs genvhost.py; returns its exit code, how long it took and the invocations of acme.sh."""
+        log_path = os.path.join(self.directory, 'log.jsonl')
+        offset = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+        start = time.perf_counter()
+        result = subprocess.run([
+            sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'genvhost.py'), *args,
+            '--zone', self.args.zone, '--out', self.out, '--cert-home', self.cert_home, '--acme-sh', self.shim,
+            '--server', 'https://127.0.0.1:14000/dir', '--jobs', str(self.args.jobs),
+        ], env=self.env, stderr=subprocess.PIPE, text=True)
+        elapsed = time.perf_counter() - start
+        entries = []
+        if os.path.exists(log_path):
+            with open(log_path) as f:
+                f.seek(offset)
+                entries = [json.loads(line) for line in f]
+        print(f"genvhost.py {' '.join(args)}: exited with {result.returncode} after {elapsed:.1f}s, "
+              f"{sum(e['event'] == 'start' for e in entries)} acme.sh invocations; "
+              f"{result.stderr.strip().splitlines()[-1] if result.stderr.strip() else ''}")
+        return result.returncode, elapsed, entries
+
+    def blocks(self) -> List[Tuple[str, str]]:
+        with open(self.out) as f:
+            return [(genvhost.server_name(block), block) for block in genvhost.VHOST_PATTERN.findall(f.read())]
+
+
+def concurrency(entries: List[dict]) -> Tuple[int, bool]:
+    """The most acme.sh processes at a time, and whether the first one ran alone."""
+    entries = sorted(entries, key=lambda e: (e['time'], e['event'] == 'start'))
+    running, most = 0, 0
+    for entry in entries:
+        running += 1 if entry['event'] == 'start' else -1
+        most = max(most, running)
+    first = next(e['pid'] for e in entries if e['event'] == 'start')
+    first_end = next(e['time'] for e in entries if e['event'] == 'end' and e['pid'] == first)
+    return most, not any(e['event'] == 'start' and e['pid'] != first and e['time'] < first_end for e in entries)
+
+
+def check(args) -> int:
+    study_domain = args.zone.rstrip('.').lower()
+    names = genvhost.test_names(study_domain)
+    with tempfile.TemporaryDirectory() as directory:
+        c = Check(directory, args)
+        expect = c.expect
+
+        # the study domain has its certificate from elsewhere; an old vhosts file of the hardcoded list
+        subprocess.run([c.shim, '--issue', '-d', study_domain, '--cert-home', c.cert_home], env=c.env,
+                       stdout=subprocess.DEVNULL, check=True)
+        other = "<VirtualHost *:80>\n    ServerName other.example\n    Redirect / https://other.example/\n" \
+                "</VirtualHost>\n"
+        with open(c.out, 'w') as f:
+            f.write("".join(genvhost.gen_vhost_config(f"{name}.{study_domain}", f"/old/{name}").replace("\n", "\n    ")
+                            for name in ["ds13-dnskey13", "ds8-dnskey8", "ds16", "ds8-dnskey8"]) + "\n" + other)
+
+        returncode, elapsed, entries = c.genvhost('certs')
+        most, first_alone = concurrency(entries)
+        issued = sorted(e['name'] for e in entries if e['event'] == 'end' and e['returncode'] == 0)
+        expect(returncode == 0 and issued == sorted(names), f"all {len(names)} certificates issued")
+        expect(first_alone, "the first issuance ran alone")
+        expect(1 < most <= args.jobs or args.jobs == 1, f"up to {args.jobs} issuances at a time (most: {most})")
+        busy = sum(e['time'] * (1 if e['event'] == 'end' else -1) for e in entries)  # seconds of acme.sh processes
+        expect(busy > 1.5 * elapsed or args.jobs == 1,
+               f"faster than one after another ({elapsed:.1f}s instead of {busy:.1f}s)")
+        blocks = c.blocks()
+        generated = [name for name, _ in blocks if name != 'other.example']
+        expect(sorted(generated) == sorted([study_domain] + names) and len(set(generated)) == len(generated),
+               "a vhost for every name of the matrix and the study domain, each once")
+        expect(('other.example', other) in blocks, "the vhost of another site is kept")
+        expect(all(f"{c.cert_home}/{name}/fullchain.cer" in block for name, block in blocks if name in names),
+               "the vhosts use the certificates of acme.sh")
+
+        before = os.stat(c.out)
+        returncode, _, entries = c.genvhost('certs')
+        after = os.stat(c.out)
+        expect(returncode == 0 and not entries, "nothing to issue in a second run")
+        expect((before.st_ino, before.st_mtime_ns) == (after.st_ino, after.st_mtime_ns),
+               "the vhosts file is not touched")
+
+        # some certificates expire soon, one is lost and cannot be issued again
+        expiring, lost = names[3:6], names[10]
+        with open(os.path.join(directory, 'days.json'), 'w') as f:
+            json.dump({name: 10 for name in expiring}, f)
+        for name in expiring:
+            subprocess.run([c.shim, '--issue', '--force', '-d', name, '--cert-home', c.cert_home], env=c.env,
+                           stdout=subprocess.DEVNULL, check=True)
+        os.remove(os.path.join(directory, 'days.json'))
+        for file in os.listdir(os.path.join(c.cert_home, lost)):
+            os.remove(os.path.join(c.cert_home, lost, file))
+        os.rmdir(os.path.join(c.cert_home, lost))
+        with open(os.path.join(directory, 'fail.json'), 'w') as f:
+            json.dump([lost], f)
+        before = c.blocks()
+        returncode, _, entries = c.genvhost('certs', '--renew-days', '30')
+        invoked = sorted(e['name'] for e in entries if e['event'] == 'start')
+        expect(returncode != 0 and invoked == sorted(expiring + [lost]), "only the due certificates are issued")
+        expect(all('--force' in e['args'] for e in entries if e['event'] == 'start' and e['name'] in expiring),
+               "renewals are forced")
+        expect(c.blocks() == [block for block in before if block[0] != lost],
+               "only the vhost of the name without certificate is removed")
+        returncode, _, entries = c.genvhost('vhosts', '--without-certs')
+        expect(returncode == 0 and not entries and c.blocks()[-1][0] == lost, "--without-certs writes it again")
+
+    print("MISMATCH" if c.problems else "OK: genvhost.py issues due certificates in parallel and updates the vhosts")
+    return 1 if c.problems else 0
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'acme.sh':
+        sys.exit(fake_acme_sh(sys.argv[2:]))
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['check'])
+    parser.add_argument('--zone', default=genvhost.STUDY_DOMAIN)
+    parser.add_argument('--jobs', type=int, default=8)
+    parser.add_argument('--delay', type=float, default=.5, help="seconds per fake issuance")
+    args = parser.parse_args()
+    sys.exit({'check': check}[args.command](args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,103 +1,301 @@
-# STUDY_DOMAIN = "resolver-downgrade-attack.dedyn.io"
-# TEST_DOMAINS = [
-#   "ecdsap256sha256",
-#   "onlyrsasha256",
-#   "rsasha256",
-#   "broken",
-# ]
+"""
+Generates the Apache vhosts of the adnet study (vhosts.conf-part) and obtains their certificates with acme.sh.
 
+The test names are those of the zone matrix of addzones.py (see zonematrix.py) below --zone, each once, plus the study
+domain itself. Every name gets a vhost that also serves its subdomains (the test page loads <token>-<test>.<name>,
+see testscript.js), with the certificate acme.sh keeps for it in --cert-home (named according to acme.sh policy).
 
-STUDY_DOMAIN = "downgrade.dedyn.io"
-TEST_DOMAINS = [
-  "ds13-dnskey13",
-  "ds13-ds15-dnskey13-dnskey15",
-  "ds13-ds15-dnskey15",
-  "ds13-ds16-dnskey13-dnskey16",
-  "ds13-ds16-dnskey16",
-  "ds15-ds16-dnskey15",
-  "ds16",
-  "ds8-dnskey8",
-  "ds8-ds13-dnskey13",
-  "ds8-ds13-dnskey8",
-  "ds8-ds13-dnskey8-dnskey13",
-  "ds8-ds15-dnskey15",
-  "ds8-ds15-dnskey8-dnskey15",
-  "ds8-ds16-dnskey16",
-  "ds8-ds16-dnskey8-dnskey16",
-
-  "ds5-dnskey5",
-  "ds8-dnskey8",
-  "ds10-dnskey10",
-  "ds13-dnskey13",
-  "ds14-dnskey14",
-  "ds15-dnskey15",
-  "ds16-dnskey16",
-]
+    python3 genvhost.py [vhosts] [--out vhosts.conf-part] [--reload]
 
+writes the vhosts of the names whose certificate is there (all of them with --without-certs). Only the vhost blocks
+that differ are replaced in --out, in place: blocks of names that are no longer generated (or are there twice) are
+removed, new ones are appended, and other blocks (e.g. of other sites) are kept as they are. The file is not touched
+when nothing changed, and with --reload Apache is reloaded gracefully only when something did.
 
+    python3 genvhost.py certs [--jobs 8] [--renew-days 30] [--dry-run]
+
+first checks the certificates of the test names: missing, unreadable, not covering the name and its wildcard, or
+expiring within --renew-days. Those are issued with acme.sh (dns-01 through knot, see the README) by up to --jobs
+acme.sh processes at a time, so that their --dnssleep waits overlap; the first one runs alone, as acme.sh registers
+the account and saves the knot settings on its first issuance. The certificates are checked again afterwards, then
+the vhosts are written as above. The study domain is delegated to deSEC, not to knot, so its certificate is not
+obtained here.
+
+To try this against a local ACME server, pass e.g. --server https://127.0.0.1:14000/dir --ca-bundle pebble.minica.pem
+for pebble, with its dns-01 challenges resolved by the local knot (see the README); fakeacme.py checks it with a fake
+acme.sh.
 """
-This script assumes files/directories named according to acme.sh policy when using ZeroSSL CA.
-"""
+import argparse
+import concurrent.futures
+import datetime
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+from typing import Dict, List, NamedTuple, Optional
 
+import dns.name
+from cryptography import x509
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from zonematrix import zones as zone_matrix  # noqa: E402
+
+logging.basicConfig(level=logging.WARNING)
+
+# STUDY_DOMAIN = "resolver-downgrade-attack.dedyn.io"
+STUDY_DOMAIN = "downgrade.dedyn.io"
 
 # DOCROOT = "/var/www/resolver-downgrade-attack.dedyn.io"
 DOCROOT = "/var/www/downgrade.dedyn.io"
 LOGFILE_COMBINED = "access-downg.log"
 LOGFILE_JSON = "access-downg.json"
 LOG_FORMAT_JSON = "downg2"
-APACHE_LOG_DIR = "{APACHE_LOG_DIR}"  # hacky but does the job
-
-def gen_vhost_config(testdomain="", study_domain=STUDY_DOMAIN):
-    conflines = []
-    if testdomain == "":
-        name = study_domain
-    else:
-        name = testdomain + "." + study_domain
-    conflines.append(
-        f"""
-        <VirtualHost *:443>
-            ServerName {name}
-        """
-        )
-    if testdomain != "":
-        conflines.append(
-            f"""    ServerAlias *.{name}
-            """
-        )
-    conflines.append(
-        f"""
-            ServerAdmin webmaster@localhost
-            DocumentRoot {DOCROOT}
-            ErrorLog ${APACHE_LOG_DIR}/error.log
-            CustomLog ${APACHE_LOG_DIR}/{LOGFILE_COMBINED} combined
-            CustomLog ${APACHE_LOG_DIR}/{LOGFILE_JSON} {LOG_FORMAT_JSON}
-        """
-    )
-    conflines.append(
-        f"""
-            SSLEngine On
-            SSLCertificateFile    /etc/apache2/ssl/{name}/fullchain.cer
-            SSLCertificateKeyFile /etc/apache2/ssl/{name}/{name}.key
-            SSLCACertificateFile  /etc/apache2/ssl/{name}/ca.cer
-
-            ProxyPass        "/post/" "http://127.0.0.1:5000/post/"
-            ProxyPassReverse "/post/" "http://127.0.0.1:5000/post/"
-
-        </VirtualHost>
-        """
-        )
-    return "".join(conflines)
-    
-
-
-def gen_hosts():
-    config = []
-    config += gen_vhost_config(testdomain="", study_domain=STUDY_DOMAIN)
-    for test_domain in TEST_DOMAINS:
-        config += gen_vhost_config(testdomain=test_domain, study_domain=STUDY_DOMAIN)
-    return "".join(config)
+APACHE_LOG_DIR = "${APACHE_LOG_DIR}"  # expanded by Apache
+CERT_HOME = os.environ.get('CERT_HOME', '/etc/apache2/ssl')
+ACME_SH = os.environ.get('ACME_SH', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'acme.sh',
+                                                  'acme.sh'))  # the submodule
+
+VHOST_PATTERN = re.compile(r'^[ \t]*<VirtualHost\b.*?</VirtualHost>[ \t]*\n?', re.DOTALL | re.MULTILINE)
+SERVER_NAME_PATTERN = re.compile(r'^\s*ServerName\s+(\S+)', re.MULTILINE)
+
+
+def test_names(study_domain: str) -> List[str]:
+    """The names of the test zones below the study domain, in the order of the matrix, each once."""
+    origin = dns.name.from_text(study_domain)
+    return list(dict.fromkeys(name.to_text(omit_final_dot=True).lower() for _, _, name in zone_matrix(origin)))
+
+
+def cert_dir(cert_home: str, name: str, keylength: str) -> str:
+    """The directory of the certificate of name in the cert home of acme.sh, which has a suffix for ECC keys."""
+    return os.path.join(cert_home, name + ('_ecc' if keylength.startswith('ec') else ''))
+
+
+def gen_vhost_config(name: str, directory: str, wildcard: bool = True) -> str:
+    lines = [
+        "<VirtualHost *:443>",
+        f"    ServerName {name}",
+        *([f"    ServerAlias *.{name}"] if wildcard else []),
+        "",
+        "    ServerAdmin webmaster@localhost",
+        f"    DocumentRoot {DOCROOT}",
+        f"    ErrorLog {APACHE_LOG_DIR}/error.log",
+        f"    CustomLog {APACHE_LOG_DIR}/{LOGFILE_COMBINED} combined",
+        f"    CustomLog {APACHE_LOG_DIR}/{LOGFILE_JSON} {LOG_FORMAT_JSON}",
+        "",
+        "    SSLEngine On",
+        f"    SSLCertificateFile    {directory}/fullchain.cer",
+        f"    SSLCertificateKeyFile {directory}/{name}.key",
+        f"    SSLCACertificateFile  {directory}/ca.cer",
+        "",
+        '    ProxyPass        "/post/" "http://127.0.0.1:5000/post/"',
+        '    ProxyPassReverse "/post/" "http://127.0.0.1:5000/post/"',
+        "</VirtualHost>",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def gen_hosts(names: List[str], study_domain: str, cert_home: str, keylength: str) -> Dict[str, str]:
+    """The vhost block of each name, by name."""
+    return {name: gen_vhost_config(name, cert_dir(cert_home, name, keylength), name != study_domain) for name in names}
+
+
+def server_name(block: str) -> Optional[str]:
+    match = SERVER_NAME_PATTERN.search(block)
+    return match.group(1).lower() if match else None
+
+
+class VhostChanges(NamedTuple):
+    added: List[str]
+    changed: List[str]
+    removed: List[str]
+    unchanged: int
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.changed or self.removed)
+
+    def __str__(self) -> str:
+        return f"{len(self.added)} vhosts added, {len(self.changed)} changed, {len(self.removed)} removed, " \
+               f"{self.unchanged} unchanged"
+
+
+def update_vhosts(path: str, blocks: Dict[str, str], managed) -> VhostChanges:
+    """
+    Replaces the vhost blocks in the file at path that differ from blocks, in place, removes those of names that are
+    managed (a function of the name) but not in blocks or there twice, and appends the new ones. Writes the file only
+    if it changed.
+    """
+    text = ""
+    if os.path.exists(path):
+        with open(path) as f:
+            text = f.read()
+    added, changed, removed, seen, parts, end = [], [], [], set(), [], 0
+    for match in VHOST_PATTERN.finditer(text):
+        between, block, name = text[end:match.start()], match.group(0), server_name(match.group(0))
+        end = match.end()
+        if name in seen or (name not in blocks and name is not None and managed(name)):
+            removed.append(name)
+            parts.append(between if between.strip() else "")  # with the blank line before it
+            continue
+        if name in blocks:
+            seen.add(name)
+            if block.strip() != blocks[name].strip():
+                changed.append(name)
+                block = blocks[name]
+        parts += [between, block]
+    parts.append(text[end:])
+    content = "".join(parts)
+    for name, block in blocks.items():
+        if name not in seen:
+            added.append(name)
+            content = content.rstrip("\n") + "\n\n" + block if content.strip() else block
+    changes = VhostChanges(added, changed, removed, len(seen) - len(changed))
+    if content != text:
+        with open(f"{path}.tmp", 'w') as f:
+            f.write(content)
+        os.replace(f"{path}.tmp", path)
+    return changes
+
+
+def reload_apache() -> None:
+    for command in (["apachectl", "configtest"], ["apachectl", "graceful"]):
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        if result.returncode:
+            raise RuntimeError(f"{' '.join(command)} failed: {result.stdout.strip()}")
+    logging.warning("reloaded Apache")
+
+
+def certificate_problem(directory: str, name: str, wildcard: bool, renew_before: datetime.timedelta,
+                        now: datetime.datetime) -> Optional[str]:
+    """Why the certificate of name in directory has to be (re)issued, None if it is good."""
+    files = [f"{name}.cer", f"{name}.key", "fullchain.cer", "ca.cer"]
+    missing = [file for file in files if not os.path.exists(os.path.join(directory, file))]
+    if missing:
+        return f"missing {', '.join(missing)}"
+    try:
+        with open(os.path.join(directory, f"{name}.cer"), 'rb') as f:
+            cert = x509.load_pem_x509_certificate(f.read())
+    except ValueError as e:
+        return f"unreadable: {e}"
+    try:
+        names = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+        covered = {n.lower() for n in names.get_values_for_type(x509.DNSName)}
+    except x509.ExtensionNotFound:
+        covered = set()
+    uncovered = {name, *([f"*.{name}"] if wildcard else [])} - covered
+    if uncovered:
+        return f"does not cover {', '.join(sorted(uncovered))}"
+    expires = cert.not_valid_after_utc if hasattr(cert, 'not_valid_after_utc') else \
+        cert.not_valid_after.replace(tzinfo=datetime.timezone.utc)
+    if expires - now < renew_before:
+        return f"expires {expires:%Y-%m-%d %H:%M}"
+    return None
+
+
+class Issuance(NamedTuple):
+    name: str
+    returncode: int
+    seconds: float
+    output: str
+
+
+def issue(args, name: str, force: bool) -> Issuance:
+    command = [
+        args.acme_sh, '--issue', '--dns', 'dns_knot', '-d', name, '-d', f'*.{name}', '--server', args.server,
+        '--dnssleep', str(args.dnssleep), '--cert-home', args.cert_home, '--keylength', args.keylength,
+    ]
+    if force:  # acme.sh skips certificates it does not consider due yet
+        command.append('--force')
+    if args.ca_bundle:
+        command += ['--ca-bundle', args.ca_bundle]
+    logging.info(f"Running {command}")
+    start = time.perf_counter()
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    return Issuance(name, result.returncode, time.perf_counter() - start, result.stdout)
+
+
+def certs(args, names: List[str]) -> int:
+    """Issues the certificates of names that are due, returns the number of those that are still not good."""
+    renew_before = datetime.timedelta(days=args.renew_days)
+
+    def problem(name: str) -> Optional[str]:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return certificate_problem(cert_dir(args.cert_home, name, args.keylength), name, True, renew_before, now)
+
+    due = {name: reason for name in names for reason in [problem(name)] if reason}
+    for name, reason in due.items():
+        logging.warning(f"{name}: {reason}")
+    logging.warning(f"{len(names) - len(due)} certificates good, {len(due)} to issue")
+    if args.dry_run or not due:
+        return 0
+
+    start = time.perf_counter()
+    first, *rest = due
+    issuances = []
+
+    def done(issuance: Issuance) -> None:
+        issuances.append(issuance)
+        logging.warning(f"{issuance.name}: acme.sh exited with {issuance.returncode} after {issuance.seconds:.1f}s "
+                        f"({len(issuances)}/{len(due)})")
+
+    done(issue(args, first, not due[first].startswith('missing')))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:  # each task runs acme.sh
+        futures = [executor.submit(issue, args, name, not due[name].startswith('missing')) for name in rest]
+        for future in concurrent.futures.as_completed(futures):
+            done(future.result())
+    failed = []
+    for issuance in issuances:
+        reason = problem(issuance.name)
+        if reason:
+            failed.append(issuance.name)
+            output = "\n".join(issuance.output.strip().split("\n")[-5:])
+            logging.error(f"{issuance.name}: {reason} after acme.sh exited with {issuance.returncode}:\n{output}")
+    logging.warning(f"issued {len(due) - len(failed)} certificates in {time.perf_counter() - start:.1f}s "
+                    f"with up to {args.jobs} acme.sh processes, {len(failed)} failed")
+    return len(failed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', nargs='?', choices=['vhosts', 'certs'], default='vhosts')
+    parser.add_argument('--zone', default=os.environ.get('ZONE', STUDY_DOMAIN), help="the study domain")
+    parser.add_argument('--out', default="vhosts.conf-part", help="file with the vhosts, updated in place")
+    parser.add_argument('--cert-home', default=CERT_HOME, help="where acme.sh keeps the certificates")
+    parser.add_argument('--without-certs', action='store_true', help="write vhosts also for names without certificate")
+    parser.add_argument('--reload', action='store_true', help="reload Apache gracefully if the vhosts changed")
+    parser.add_argument('--jobs', type=int, default=8, help="parallel acme.sh processes")
+    parser.add_argument('--renew-days', type=float, default=30, help="renew certificates expiring this soon")
+    parser.add_argument('--dry-run', action='store_true', help="print the certificates to issue, and exit")
+    parser.add_argument('--acme-sh', default=ACME_SH)
+    parser.add_argument('--server', default='zerossl', help="ACME server, a name known to acme.sh or a URL")
+    parser.add_argument('--ca-bundle', help="CA certificates to trust for the ACME server, e.g. of pebble")
+    parser.add_argument('--dnssleep', type=int, default=1, help="seconds acme.sh waits for the TXT records")
+    parser.add_argument('--keylength', default='2048', help="key of the certificates, e.g. 2048 or ec-256")
+    args = parser.parse_args()
+
+    study_domain = args.zone.rstrip('.').lower()
+    names = test_names(study_domain)
+    failed = certs(args, names) if args.command == 'certs' else 0
+    if args.dry_run:
+        return
+
+    blocks = gen_hosts([study_domain] + names, study_domain, args.cert_home, args.keylength)
+    if not args.without_certs:
+        missing = [name for name in blocks if not os.path.exists(os.path.join(
+            cert_dir(args.cert_home, name, args.keylength), 'fullchain.cer'))]
+        for name in missing:
+            blocks.pop(name)
+        if missing:
+            logging.warning(f"no vhosts for {len(missing)} names without certificate: {', '.join(missing[:5])}"
+                            + (", ..." if len(missing) > 5 else ""))
+    changes = update_vhosts(args.out, blocks, lambda name: name == study_domain or name.endswith('.' + study_domain))
+    logging.warning(f"{args.out}: {changes}")
+    if changes and args.reload:
+        reload_apache()
+    if failed:
+        sys.exit(f"{failed} certificates could not be issued")
 
 
 if __name__ == "__main__":
-    with open("vhosts.conf-part", 'w') as f:
-        f.writelines([gen_hosts()])
+    main()
@@ -0,0 +1,133 @@
+"""
+Client for the RRset API of deSEC (https://desec.readthedocs.io/en/latest/dns/rrsets.html), as far as addzones.py
+needs it. DESEC_API sets the API base URL, e.g. to that of fakedesec.py.
+
+sync() brings a set of RRsets to deSEC: it compares them to the RRsets there, sends only the changed ones in chunks
+of at most DESEC_CHUNK_SIZE RRsets, and reads the RRsets back to verify them. Requests that are throttled (429) or
+fail on the server side are repeated after the time deSEC asks for, or with exponential backoff. RRsets deSEC
+rejects are reported individually; the rest of their chunk is sent again without them.
+"""
+import json
+import logging
+import os
+import time
+from typing import List, NamedTuple, Optional, Tuple
+
+import dns.exception
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+import requests
+
+logger = logging.getLogger(__name__)
+
+DESEC_API = os.environ.get('DESEC_API', 'https://desec.io/api/v1')
+DESEC_CHUNK_SIZE = int(os.environ.get('DESEC_CHUNK_SIZE', 200))
+
+RRsetKey = Tuple[str, str]  # subname, type
+
+
+def rrset_key(rrset: dict) -> RRsetKey:
+    return rrset['subname'], rrset['type']
+
+
+def same_rrset(desired: dict, current: Optional[dict]) -> bool:
+    """Whether the RRset at deSEC (None if there is none) already is as desired; empty records mean no RRset."""
+    if current is None:
+        return not desired['records']
+    records = lambda rrset: {  # noqa: E731
+        dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.from_text(rrset['type']), record)
+        for record in rrset['records']
+    }
+    try:
+        return desired['ttl'] == current['ttl'] and records(desired) == records(current)
+    except (dns.exception.DNSException, ValueError):  # a malformed record is sent, so that deSEC reports it
+        return False
+
+
+class SyncResult(NamedTuple):
+    changed: int  # RRsets that differed from those at deSEC
+    requests: int  # PATCH requests, including repeated ones
+    rejected: List[Tuple[dict, object]]  # RRsets deSEC rejected, with its error
+    mismatched: List[dict]  # RRsets that are not as desired afterwards
+
+    def __str__(self) -> str:
+        return f"{self.changed} RRsets changed in {self.requests} requests, {len(self.rejected)} rejected, " \
+               f"{len(self.mismatched)} not as desired afterwards"
+
+
+class Desec:
+
+    def __init__(self, domain: str, token: str, api: str = DESEC_API, chunk_size: int = DESEC_CHUNK_SIZE,
+                 retries: int = 8, backoff: float = 1, timeout: float = 30) -> None:
+        self.url = f"{api.rstrip('/')}/domains/{domain.rstrip('.')}/rrsets/"
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({'Authorization': f'Token {token}', 'Content-Type': 'application/json'})
+        self.requests = 0
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Sends the request, repeating it while it is throttled or fails on the server side."""
+        for attempt in range(self.retries + 1):
+            self.requests += 1
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.retries:
+                    raise
+                reason, delay = str(e), self.backoff * 2 ** attempt
+            else:
+                if response.status_code != 429 and response.status_code < 500 or attempt == self.retries:
+                    return response
+                reason = f"{response.status_code} {response.text[:200]}"
+                delay = float(response.headers.get('Retry-After') or self.backoff * 2 ** attempt)
+            logger.warning(f"deSEC {method} {url}: {reason}, again in {delay:.1f}s")
+            time.sleep(delay)
+
+    def rrsets(self) -> List[dict]:
+        """All RRsets of the domain, following the pagination of the API."""
+        rrsets, url = [], f"{self.url}?cursor="
+        while url:
+            response = self.request('GET', url)
+            response.raise_for_status()
+            rrsets += response.json()
+            url = response.links.get('next', {}).get('url')
+        return rrsets
+
+    def send(self, rrsets: List[dict]) -> List[Tuple[dict, object]]:
+        """Patches the RRsets, leaving out those deSEC rejects; returns them with their errors."""
+        response = self.request('PATCH', self.url, data=json.dumps(rrsets))
+        if response.status_code != 400:
+            response.raise_for_status()
+            return []
+        try:
+            errors = response.json()
+        except ValueError:
+            errors = response.text
+        if isinstance(errors, list) and len(errors) == len(rrsets) and any(errors):
+            # deSEC lists an error (or {}) per RRset; bulk requests are atomic, so the others were not applied either
+            rejected = [(rrset, error) for rrset, error in zip(rrsets, errors) if error]
+            rest = [rrset for rrset, error in zip(rrsets, errors) if not error]
+            return rejected + (self.send(rest) if rest else [])
+        if len(rrsets) == 1:
+            return [(rrsets[0], errors)]
+        middle = len(rrsets) // 2  # no error per RRset: find the rejected ones by halving
+        return self.send(rrsets[:middle]) + self.send(rrsets[middle:])
+
+    def sync(self, rrsets: List[dict]) -> SyncResult:
+        """Makes the RRsets at deSEC as given; other RRsets are left alone."""
+        current = {rrset_key(rrset): rrset for rrset in self.rrsets()}
+        changed = [rrset for rrset in rrsets if not same_rrset(rrset, current.get(rrset_key(rrset)))]
+        rejected, requests_before = [], self.requests
+        for start in range(0, len(changed), self.chunk_size):
+            rejected += self.send(changed[start:start + self.chunk_size])
+        for rrset, error in rejected:
+            logger.error(f"deSEC rejected {rrset['subname']} {rrset['type']}: {error}")
+        patches = self.requests - requests_before
+        if changed:
+            current = {rrset_key(rrset): rrset for rrset in self.rrsets()}
+        mismatched = [rrset for rrset in rrsets if not same_rrset(rrset, current.get(rrset_key(rrset)))]
+        return SyncResult(len(changed), patches, rejected, mismatched)
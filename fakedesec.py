@@ -0,0 +1,234 @@
+"""
+A stand-in for the RRset API of deSEC, to run addzones.py without a deSEC account: keeps the RRsets of any domain in
+memory and implements listing them (with cursor pagination) and bulk changes with PATCH. Any token is accepted.
+Like deSEC, it rejects a PATCH with invalid records as a whole, with an error per RRset, and throttles PATCH requests
+(--rate per second, answered with 429 and Retry-After); --error-rate makes a share of the requests fail with 503.
+
+    python3 fakedesec.py serve [--port 8053] [--rate 2] [--error-rate 0]
+    DESEC_API=http://127.0.0.1:8053/api/v1 DESEC_TOKEN=fake python3 addzones.py ...
+
+    python3 fakedesec.py bench [--rrsets 2000] [--invalid 3] [--chunk-size 200] [--rate 2] [--error-rate 0.1]
+
+bench syncs NS and DS RRsets for --rrsets / 2 delegations (some of them invalid) with desec.py against the stand-in,
+then changes some and syncs again, and reports the requests, time and whether the result was verified.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import dns.exception
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+
+from desec import Desec
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 500
+PATH = re.compile(r'^/api/v1/domains/([^/]+)/rrsets/$')
+
+
+class FakeDesec(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], rate: float = 0, error_rate: float = 0) -> None:
+        super().__init__(address, Handler)
+        self.domains: Dict[str, Dict[Tuple[str, str], dict]] = {}
+        self.patches: List[List[dict]] = []  # the bodies of all applied PATCH requests
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.error_rate = error_rate
+        self.next_patch = 0.0  # earliest time of the next PATCH request that is not throttled
+        self.throttled = self.errors = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/api/v1"
+
+    def rrsets(self, domain: str) -> List[dict]:
+        with self.lock:
+            return [dict(rrset) for _, rrset in sorted(self.domains.get(domain, {}).items())]
+
+    def throttle(self) -> float:
+        """Seconds to wait before the next PATCH request is accepted, 0 if it is accepted now."""
+        with self.lock:
+            now = time.monotonic()
+            if self.rate and now < self.next_patch:
+                self.throttled += 1
+                return self.next_patch - now
+            self.next_patch = now + 1 / self.rate if self.rate else 0
+            return 0
+
+    def fail(self) -> bool:
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    @staticmethod
+    def validate(rrsets: List[dict]) -> List[dict]:
+        """An error per RRset, {} for valid ones."""
+        errors, seen = [], set()
+        for rrset in rrsets:
+            error = {}
+            key = (rrset.get('subname'), rrset.get('type'))
+            if key in seen:
+                error['non_field_errors'] = ["Same subname and type as in another RRset."]
+            seen.add(key)
+            for record in rrset.get('records', []):
+                try:
+                    dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.from_text(rrset['type']), record)
+                except (dns.exception.DNSException, ValueError, KeyError) as e:
+                    error.setdefault('records', []).append(f"Record content malformed: {e}")
+            errors.append(error)
+        return errors
+
+    def patch(self, domain: str, rrsets: List[dict]) -> None:
+        keys = [(rrset['subname'], rrset['type']) for rrset in rrsets]
+        with self.lock:
+            self.patches.append(rrsets)
+            existing = self.domains.setdefault(domain, {})
+            for key, rrset in zip(keys, rrsets):
+                if rrset['records']:
+                    existing[key] = {
+                        'name': f"{rrset['subname']}.{domain}." if rrset['subname'] else f"{domain}.",
+                        'domain': domain, 'subname': rrset['subname'], 'type': rrset['type'],
+                        'ttl': rrset['ttl'], 'records': list(rrset['records']),
+                    }
+                else:
+                    existing.pop(key, None)
+
+
+class Handler(BaseHTTPRequestHandler):
+    server: FakeDesec
+
+    def reply(self, status: int, body=None, headers: Dict[str, str] = None) -> None:
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def domain(self) -> Optional[str]:
+        if not self.headers.get('Authorization', '').startswith('Token '):
+            self.reply(401, {'detail': "Invalid token."})
+            return None
+        match = PATH.match(urlparse(self.path).path)
+        if not match:
+            self.reply(404, {'detail': "Not found."})
+            return None
+        return match.group(1)
+
+    def do_GET(self):
+        domain = self.domain()
+        if domain is None:
+            return
+        rrsets = self.server.rrsets(domain)
+        query = parse_qs(urlparse(self.path).query, keep_blank_values=True)
+        if 'cursor' not in query:
+            if len(rrsets) > PAGE_SIZE:
+                return self.reply(400, {'detail': "Pagination required. Use the cursor parameter."})
+            return self.reply(200, rrsets)
+        start = int(query['cursor'][0] or 0)
+        headers = {}
+        if start + PAGE_SIZE < len(rrsets):
+            url = f"{self.server.url}/domains/{domain}/rrsets/?cursor={start + PAGE_SIZE}"
+            headers['Link'] = f'<{url}>; rel="next"'
+        self.reply(200, rrsets[start:start + PAGE_SIZE], headers)
+
+    def do_PATCH(self):
+        domain = self.domain()
+        if domain is None:
+            return
+        rrsets = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        if self.server.fail():
+            return self.reply(503, {'detail': "Service unavailable."})
+        wait = self.server.throttle()
+        if wait:
+            return self.reply(429, {'detail': "Request was throttled."}, {'Retry-After': str(math.ceil(wait))})
+        errors = self.server.validate(rrsets)
+        if any(errors):
+            return self.reply(400, errors)
+        self.server.patch(domain, rrsets)
+        self.reply(200, [rrset for rrset in rrsets if rrset['records']])
+
+    def log_message(self, format, *args):
+        logger.info(format % args)
+
+
+def delegations(count: int, seed: str) -> List[dict]:
+    """NS and DS RRsets of count delegations, with DS records depending on seed."""
+    rrsets = []
+    for i in range(count):
+        digest = hashlib.sha256(f"{seed}-{i}".encode()).hexdigest()
+        rrsets += [
+            {'subname': f"zone{i}", 'type': 'NS', 'ttl': 60, 'records': ["ns.example.com."]},
+            {'subname': f"zone{i}", 'type': 'DS', 'ttl': 60, 'records': [f"{int(digest[:4], 16)} 13 2 {digest}"]},
+        ]
+    return rrsets
+
+
+def bench(args) -> int:
+    server = FakeDesec(('127.0.0.1', 0), rate=args.rate, error_rate=args.error_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = Desec('example.com.', 'fake', api=server.url, chunk_size=args.chunk_size, backoff=.1)
+    problems = 0
+    rounds = [("initial sync", "a", 1), ("changed DS", "b", args.changed), ("no changes", "b", args.changed)]
+    for round_number, (name, seed, share) in enumerate(rounds):
+        desired = delegations(args.rrsets // 2, "a")
+        changed = int(len(desired) // 2 * share)
+        for i, rrset in enumerate(delegations(changed, seed)):
+            desired[i] = rrset
+        # other ones each round, so that later rounds also break RRsets that exist at deSEC
+        invalid = desired[1::2][round_number * args.invalid:(round_number + 1) * args.invalid]
+        for rrset in invalid:
+            rrset['records'] = ["not a DS record"]
+        throttled, errors, start = server.throttled, server.errors, time.perf_counter()
+        result = client.sync(desired)
+        elapsed = time.perf_counter() - start
+        # the invalid RRsets must be rejected, everything else applied
+        ok = sorted(r['subname'] for r, _ in result.rejected) == sorted(r['subname'] for r in invalid) and \
+            sorted(r['subname'] for r in result.mismatched) == sorted(r['subname'] for r in invalid)
+        problems += not ok
+        print(f"{name}: {result} in {elapsed:.1f}s, {server.throttled - throttled} throttled, "
+              f"{server.errors - errors} failed with 503: {'ok' if ok else 'FAILED'}")
+    server.shutdown()
+    server.server_close()
+    return 1 if problems else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['serve', 'bench'], nargs='?', default='serve')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8053)
+    parser.add_argument('--rate', type=float, default=0, help="PATCH requests per second, 0 for no limit")
+    parser.add_argument('--error-rate', type=float, default=0, help="share of requests failing with 503")
+    parser.add_argument('--rrsets', type=int, default=2000, help="bench: RRsets to sync")
+    parser.add_argument('--invalid', type=int, default=3, help="bench: invalid RRsets among them")
+    parser.add_argument('--changed', type=float, default=.1, help="bench: share of DS RRsets changed in round two")
+    parser.add_argument('--chunk-size', type=int, default=200, help="bench: RRsets per PATCH request")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.command == 'serve' else logging.CRITICAL)
+    if args.command == 'bench':
+        raise SystemExit(bench(args))
+    server = FakeDesec((args.host, args.port), rate=args.rate, error_rate=args.error_rate)
+    logger.warning(f"fake deSEC API at {server.url}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,491 @@
+"""
+Fake knotc and keymgr, to run addzones.py without a knot name server, and checks of addzones.py against them:
+
+    python3 fakeknot.py check [--zone example.com.] [--keygen-delay 0.2]
+    python3 fakeknot.py check-incremental [--zone example.com.]
+    python3 fakeknot.py check-keypool [--zone example.com.]
+
+`check` verifies that the batched provisioning of addzones.py produces the same knotc commands, keymgr calls, key
+files and delegations as the serial one. `check-incremental` runs addzones.py --incremental (with fakedesec.py)
+against an empty name server, a complete one and a partially broken one, and verifies that it only changes what is
+missing and ends up in the same state as a full provisioning. `check-keypool` fills the key pool with keypool.py,
+provisions from it, and verifies that after losing the name server storage the same keys (and DS records) return.
+
+The fakes are put on PATH as shims calling `fakeknot.py knotc` and `fakeknot.py keymgr`. They log every invocation
+to $FAKEKNOT_DIR/log.jsonl. The fake knotc keeps the zone configuration and contents in $FAKEKNOT_DIR/knot.json,
+publishes the DNSKEYs of a zone when its signing is enabled, and implements conf-read, zone-status and zone-read;
+other commands are answered with OK. The fake keymgr works with real keys: it generates one key per zone and
+algorithm during a check, so that all runs see the same keys, and sleeps --keygen-delay seconds per RSA key
+generation (a tenth of that for other algorithms) to mimic the cost of real key generation. Its DNSKEY and DS records
+are encoded without dnspython, as a cross-check of keymaterial.py (addzones.py --verify-keys).
+"""
+import argparse
+import base64
+import collections
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shlex
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Tuple
+
+import dns.name
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+
+from fakedesec import FakeDesec
+from keypool import KeyPool, generate_pem
+from zonematrix import ALGORITHMS, zones as zone_matrix
+
+RSA_ALGORITHMS = {5, 8, 10}
+READ_COMMANDS = {'conf-read', 'zone-status', 'zone-read'}
+
+
+def log(entry: dict) -> None:
+    line = json.dumps({'time': time.time(), 'pid': os.getpid(), **entry}) + "\n"
+    fd = os.open(os.path.join(os.environ['FAKEKNOT_DIR'], 'log.jsonl'), os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
+
+
+def zone_records(state: dict, zone: str) -> List[list]:
+    return state['zones'].setdefault(zone, [])
+
+
+def same_rdata(rdtype: str, a: str, b: str) -> bool:
+    parse = lambda text: dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.from_text(rdtype), text)  # noqa: E731
+    return parse(a) == parse(b)
+
+
+def knotc_command(state: dict, line: str) -> List[str]:
+    """Executes one knotc command on the state, returns the output lines."""
+    verb, *args = shlex.split(line)
+    conf = state['conf']
+    if verb == 'conf-set':
+        match = re.match(r'zone\[([^\]]+)\](?:\.([\w-]+))?$', args[0])
+        if match:
+            zone, item = match.group(1).lower(), match.group(2)
+            items = conf.setdefault(zone, {})
+            if item:
+                items[item] = " ".join(args[1:])
+            if item == 'dnssec-signing' and args[1:] == ['on']:  # publishes the DNSKEYs of the keys
+                state['zones'][zone] = [r for r in zone_records(state, zone) if r[2] != 'DNSKEY'] + [
+                    [zone, '0', 'DNSKEY', dnskey] for dnskey in dnskeys(zone)]
+        return ["OK"]
+    if verb == 'conf-read':
+        return [
+            line for zone, items in sorted(conf.items())
+            for line in [f"zone[{zone}]"] + [f"zone[{zone}].{item} = {value}" for item, value in items.items()]
+        ]
+    if verb == 'zone-status':
+        serials = {zone: [r[3].split()[2] for r in records if r[2] == 'SOA'] for zone, records in state['zones'].items()}
+        return [f"[{zone}] role: master | serial: {(serials.get(zone) or ['none'])[0]} | transaction: none | freeze: no"
+                for zone in sorted(conf)]
+    if verb in ('zone-set', 'zone-unset', 'zone-read'):
+        zone = args[0].lower()
+        if zone not in conf:
+            return ["error: (no such zone found)"]
+        owner = zone if args[1] == '@' else f"{args[1]}.{zone}"
+        records = zone_records(state, zone)
+        if verb == 'zone-set':
+            records.append([owner, args[2], args[3], " ".join(args[4:])])
+        elif verb == 'zone-unset':
+            rdtype, rdata = args[2], " ".join(args[3:])
+            records[:] = [r for r in records if not (r[0] == owner and r[2] == rdtype and same_rdata(rdtype, r[3], rdata))]
+        else:
+            return [f"[{zone}] {r[0]} {r[1]} {r[2]} {r[3]}" for r in records if r[0] == owner and r[2] == args[2]]
+    return ["OK"]
+
+
+def fake_knotc(args: List[str]) -> None:
+    commands = [shlex.join(args)] if args else [line.strip() for line in sys.stdin.read().split('\n') if line.strip()]
+    log({'tool': 'knotc', 'args': args, 'commands': commands})
+    path = os.path.join(os.environ['FAKEKNOT_DIR'], 'knot.json')
+    with open(os.path.join(os.environ['FAKEKNOT_DIR'], 'knot.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = {'conf': {}, 'zones': {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+        output = [line for command in commands for line in knotc_command(state, command)]
+        with open(path, 'w') as f:
+            json.dump(state, f)
+    print("\n".join(output))
+
+
+def public_key(pem: bytes) -> bytes:
+    """The public key field of the DNSKEY of the key in pem (RFC 3110, 6605, 8080), encoded without dnspython."""
+    key = serialization.load_pem_private_key(pem, password=None).public_key()
+    if isinstance(key, rsa.RSAPublicKey):
+        numbers = key.public_numbers()
+        exponent = numbers.e.to_bytes((numbers.e.bit_length() + 7) // 8, 'big')
+        length = bytes([len(exponent)]) if len(exponent) < 256 else b'\0' + struct.pack('!H', len(exponent))
+        return length + exponent + numbers.n.to_bytes((numbers.n.bit_length() + 7) // 8, 'big')
+    if isinstance(key, ec.EllipticCurvePublicKey):
+        return key.public_bytes(serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint)[1:]
+    return key.public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+
+
+def key_tag(rdata: bytes) -> int:
+    """RFC 4034, appendix B."""
+    tag = sum(byte << 8 if i % 2 == 0 else byte for i, byte in enumerate(rdata))
+    return (tag + (tag >> 16)) & 0xFFFF
+
+
+def owner_wire(zone: str) -> bytes:
+    return b"".join(bytes([len(label)]) + label.encode() for label in zone.lower().rstrip('.').split('.')) + b"\0"
+
+
+def kasp_dir(zone: str, directory: str = None) -> str:
+    return os.path.join(directory or os.environ['FAKEKNOT_DIR'], 'kasp', zone.lower())
+
+
+def key_algorithms(zone: str, directory: str = None) -> List[int]:
+    path = kasp_dir(zone, directory)
+    return sorted(int(a) for a in os.listdir(path)) if os.path.isdir(path) else []
+
+
+def zone_key(zone: str, algorithm: int) -> bytes:
+    with open(os.path.join(kasp_dir(zone), str(algorithm)), 'rb') as f:
+        return public_key(f.read())
+
+
+def dnskeys(zone: str) -> List[str]:
+    return [f"257 3 {a} {base64.b64encode(zone_key(zone, a)).decode()}" for a in key_algorithms(zone)]
+
+
+def new_pem(zone: str, algorithm: int) -> bytes:
+    """A new key, the same for a zone and algorithm during a check (from $FAKEKNOT_KEY_CACHE), to compare runs."""
+    path = os.path.join(os.environ['FAKEKNOT_KEY_CACHE'], f"{zone.lower()}-{algorithm}.pem")
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.{os.getpid()}", 'wb') as f:
+            f.write(generate_pem(algorithm))
+        os.replace(f"{path}.{os.getpid()}", path)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def fake_keymgr(args: List[str]) -> None:
+    zone, command, *options = args
+    log({'tool': 'keymgr', 'args': args})
+    if command in ('generate', 'import-pem'):
+        pem_file = options.pop(0) if command == 'import-pem' else None
+        algorithm = int(dict(option.split('=', 1) for option in options)['algorithm'])
+        if pem_file:
+            with open(pem_file, 'rb') as f:
+                pem = f.read()
+        else:
+            time.sleep(float(os.environ.get('FAKEKNOT_KEYGEN_DELAY', 0)) * (1 if algorithm in RSA_ALGORITHMS else .1))
+            pem = new_pem(zone, algorithm)
+        keyid = hashlib.sha1(public_key(pem)).hexdigest()
+        with open(os.path.join(os.environ['KNOT_KEYS_DIR'], f"{keyid}.pem"), 'wb') as f:
+            f.write(pem)
+        os.makedirs(kasp_dir(zone), exist_ok=True)
+        with open(os.path.join(kasp_dir(zone), str(algorithm)), 'wb') as f:
+            f.write(pem)
+        print(keyid)
+    elif command in ('list', 'dnskey', 'ds'):
+        for algorithm in key_algorithms(zone):
+            key = zone_key(zone, algorithm)
+            rdata = struct.pack('!HBB', 257, 3, algorithm) + key
+            if command == 'list':
+                print(f"{hashlib.sha1(key).hexdigest()} ksk=yes zsk=yes tag={key_tag(rdata)} algorithm={algorithm} "
+                      f"size={len(key) * 8} public-only=no")
+            elif command == 'dnskey':
+                print(f"{zone} DNSKEY 257 3 {algorithm} {base64.b64encode(key).decode()}")
+            else:
+                for digest_type, digest in [(2, hashlib.sha256), (4, hashlib.sha384)]:
+                    print(f"{zone} DS {key_tag(rdata)} {algorithm} {digest_type} "
+                          f"{digest(owner_wire(zone) + rdata).hexdigest()}")
+    else:
+        sys.exit(f"fake keymgr: unsupported command {command}")
+
+
+def zone_of(command: str) -> str:
+    match = re.search(r'"(?:zone\[)?([^"\]]+)', command)
+    return match.group(1).lower() if match else ""
+
+
+def normalize(entries: List[dict]) -> Tuple[collections.Counter, collections.Counter, Dict[str, List[str]], List[str]]:
+    """
+    Returns the knotc commands (outside of transaction framing), the keymgr calls, the order in which each zone went
+    through the provisioning steps, and errors in the transaction structure.
+    """
+    commands, keymgr, steps, errors = collections.Counter(), collections.Counter(), collections.defaultdict(list), []
+    for entry in entries:
+        if entry['tool'] == 'keymgr':
+            keymgr[tuple(entry['args'])] += 1
+            if entry['args'][1] == 'generate':
+                steps[entry['args'][0].lower()].append('keymgr generate')
+            continue
+        conf_open, zone_open = False, None
+        for command in entry['commands']:
+            verb = command.split()[0]
+            if verb in READ_COMMANDS:
+                continue
+            if verb == 'conf-begin':
+                conf_open = True
+            elif verb == 'conf-commit':
+                conf_open = False
+            elif verb == 'zone-begin':
+                zone_open = zone_of(command)
+            elif verb == 'zone-commit':
+                zone_open = None
+            else:
+                if verb.startswith('conf-') and not conf_open:
+                    errors.append(f"{command} outside of a configuration transaction")
+                if verb.startswith('zone-') and zone_open != zone_of(command):
+                    errors.append(f"{command} outside of its zone transaction")
+                commands[command] += 1
+                step = 'signing' if 'dnssec-signing" on' in command else verb
+                zone = zone_of(command)
+                if not steps[zone] or steps[zone][-1] != step:
+                    steps[zone].append(step)
+        if conf_open or zone_open:
+            errors.append("knotc session ended within a transaction")
+    return commands, keymgr, steps, errors
+
+
+def run_addzones(directory: str, args: List[str], env: dict) -> Tuple[float, List[dict], str, List[str]]:
+    """Runs addzones.py with the fake name server state in directory; returns the log entries of this run."""
+    for sub in ('keys', 'fixed-keys'):
+        os.makedirs(os.path.join(directory, sub), exist_ok=True)
+    env = dict(env, FAKEKNOT_DIR=directory, KNOT_KEYS_DIR=os.path.join(directory, 'keys'),
+               FIXED_KEYS_DIR=os.path.join(directory, 'fixed-keys'))
+    log_path = os.path.join(directory, 'log.jsonl')
+    offset = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+    addzones = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'addzones.py')
+    start = time.perf_counter()
+    stdout = subprocess.run([sys.executable, addzones, *args], env=env, check=True,
+                            stdout=subprocess.PIPE, text=True).stdout
+    elapsed = time.perf_counter() - start
+    with open(log_path) as f:
+        f.seek(offset)
+        entries = [json.loads(line) for line in f]
+    entries.sort(key=lambda e: e['time'])
+    return elapsed, entries, stdout, sorted(os.listdir(os.path.join(directory, 'fixed-keys')))
+
+
+def fake_environment(directory: str, args) -> dict:
+    """Environment for addzones.py with shims for knotc and keymgr in directory."""
+    bin_dir = os.path.join(directory, 'bin')
+    os.makedirs(bin_dir)
+    for tool in ('knotc', 'keymgr'):
+        with open(os.path.join(bin_dir, tool), 'w') as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.abspath(__file__)}" {tool} "$@"\n')
+        os.chmod(os.path.join(bin_dir, tool), 0o755)
+    return dict(os.environ, PATH=f"{bin_dir}:{os.environ['PATH']}", ZONE=args.zone, A_RR='192.0.2.1',
+                MITM_A_RR='192.0.2.53', FAKEKNOT_KEYGEN_DELAY=str(args.keygen_delay),
+                FAKEKNOT_KEY_CACHE=os.path.join(directory, 'key-cache'))
+
+
+def check(args) -> int:
+    with tempfile.TemporaryDirectory() as directory:
+        env = fake_environment(directory, args)
+        runs = {}
+        for name, addzones_args in [('serial', ['--serial']), ('batched', ['--jobs', str(args.jobs)])]:
+            elapsed, entries, stdout, fixed_keys = run_addzones(os.path.join(directory, name),
+                                                                ['--no-desec', *addzones_args], env)
+            commands, keymgr, steps, errors = normalize(entries)
+            runs[name] = dict(elapsed=elapsed, commands=commands, keymgr=keymgr, steps=steps, errors=errors,
+                              delegations=json.loads(stdout), fixed_keys=fixed_keys,
+                              knotc_processes=sum(e['tool'] == 'knotc' for e in entries))
+            print(f"{name}: {elapsed:.1f}s, {runs[name]['knotc_processes']} knotc processes, "
+                  f"{sum(commands.values())} knotc commands, {sum(keymgr.values())} keymgr calls")
+
+        serial, batched = runs['serial'], runs['batched']
+        problems = serial['errors'] + batched['errors']
+        for what in ('commands', 'keymgr', 'fixed_keys'):
+            if serial[what] != batched[what]:
+                problems.append(f"{what} differ")
+                if isinstance(serial[what], collections.Counter):
+                    for item in list((serial[what] - batched[what]).items())[:5]:
+                        problems.append(f"  only serial: {item}")
+                    for item in list((batched[what] - serial[what]).items())[:5]:
+                        problems.append(f"  only batched: {item}")
+        key = lambda rrset: (rrset['subname'], rrset['type'])  # noqa: E731
+        if sorted(serial['delegations'], key=key) != sorted(batched['delegations'], key=key):
+            problems.append("delegations differ")
+        for zone, steps in serial['steps'].items():
+            if batched['steps'].get(zone) != steps:
+                problems.append(f"steps for {zone} differ: {steps} (serial) vs {batched['steps'].get(zone)}")
+
+    for problem in problems:
+        print(problem)
+    print("MISMATCH" if problems else "OK: batched provisioning issues the same commands as serial provisioning")
+    return 1 if problems else 0
+
+
+def knot_state(directory: str) -> dict:
+    """The fake name server state in directory, in a comparable form."""
+    with open(os.path.join(directory, 'knot.json')) as f:
+        state = json.load(f)
+    return {
+        'conf': state['conf'],
+        'zones': {zone: sorted(map(tuple, records)) for zone, records in state['zones'].items()},
+        'keys': {zone: key_algorithms(zone, directory) for zone in state['conf']},
+    }
+
+
+class Scenario:
+    """Runs of addzones.py against the fake name server and fakedesec.py, and expectations on their effects."""
+
+    def __init__(self, directory: str, args) -> None:
+        self.directory = directory
+        self.env = fake_environment(directory, args)
+        self.desec = FakeDesec(('127.0.0.1', 0))
+        threading.Thread(target=self.desec.serve_forever, daemon=True).start()
+        self.env.update(DESEC_API=self.desec.url, DESEC_TOKEN='fake')
+        self.domain = args.zone.rstrip('.')
+        self.problems: List[str] = []
+
+    def expect(self, condition: bool, problem: str) -> None:
+        print(f"  {'ok' if condition else 'FAILED'}: {problem}")
+        if not condition:
+            self.problems.append(problem)
+
+    def addzones(self, name: str, *args: str) -> Tuple[str, collections.Counter, collections.Counter, int]:
+        """Runs addzones.py on the state name; returns its output, knotc commands, keys added and RRsets sent."""
+        patches = len(self.desec.patches)
+        elapsed, entries, stdout, _ = run_addzones(os.path.join(self.directory, name), list(args), self.env)
+        commands, keymgr, _, errors = normalize(entries)
+        added = collections.Counter(c for c in keymgr.elements() if c[1] in ('generate', 'import-pem'))
+        print(f"{name} {' '.join(args)}: {elapsed:.1f}s, {sum(commands.values())} knotc commands, "
+              f"{sum(added.values())} keys added ({generated(added)} generated), "
+              f"{len(self.desec.patches) - patches} PATCH requests")
+        self.problems.extend(errors)
+        return stdout, commands, added, sum(len(p) for p in self.desec.patches[patches:])
+
+    def delegations(self) -> List[dict]:
+        return [{k: v for k, v in r.items() if k not in ('name', 'domain')} for r in self.desec.rrsets(self.domain)]
+
+    def result(self, success: str) -> int:
+        self.desec.shutdown()
+        self.desec.server_close()
+        print("MISMATCH" if self.problems else f"OK: {success}")
+        return 1 if self.problems else 0
+
+
+def generated(added: collections.Counter) -> int:
+    return sum(count for call, count in added.items() if call[1] == 'generate')
+
+
+def check_incremental(args) -> int:
+    with tempfile.TemporaryDirectory() as directory:
+        scenario = Scenario(directory, args)
+        addzones, expect, domain, desec = scenario.addzones, scenario.expect, scenario.domain, scenario.desec
+
+        # reference: the state after a full provisioning
+        addzones('full', '--verify-keys', '--jobs', str(args.jobs))
+        reference = knot_state(os.path.join(directory, 'full'))
+        reference_delegations = scenario.delegations()
+        desec.domains.pop(domain)
+
+        def same_state(when: str) -> None:
+            expect(knot_state(os.path.join(directory, 'incremental')) == reference, f"name server state {when} as after a full run")
+            expect(scenario.delegations() == reference_delegations, f"delegations {when} as after a full run")
+
+        stdout, commands, added, patched = addzones('incremental', '--incremental', '--dry-run', '--jobs', str(args.jobs))
+        expect(not commands and not added and not patched, "dry run changes nothing")
+        expect(f"{len(reference['conf'])} zones to configure" in stdout, "dry run on an empty server plans all zones")
+
+        addzones('incremental', '--incremental', '--verify-keys', '--jobs', str(args.jobs))
+        same_state("after an incremental run from scratch")
+
+        stdout, *_ = addzones('incremental', '--incremental', '--dry-run')
+        expect(len(stdout.strip().split('\n')) == 1, "dry run on a complete server plans nothing")
+        _, commands, added, patched = addzones('incremental', '--incremental')
+        expect(not commands and not added and not patched, "incremental run on a complete server changes nothing")
+
+        # break things: remove zones with their keys, a DS at deSEC, and disable signing of a zone
+        state_dir = os.path.join(directory, 'incremental')
+        with open(os.path.join(state_dir, 'knot.json')) as f:
+            state = json.load(f)
+        zones = sorted(state['conf'])
+        removed, undelegated, unsigned = zones[:3], zones[3], zones[4]
+        for zone in removed:
+            state['conf'].pop(zone)
+            state['zones'].pop(zone)
+            shutil.rmtree(kasp_dir(zone, state_dir))
+        state['conf'][unsigned]['dnssec-signing'] = 'off'
+        with open(os.path.join(state_dir, 'knot.json'), 'w') as f:
+            json.dump(state, f)
+        desec.patch(domain, [{'subname': undelegated.split('.')[0], 'type': 'DS', 'ttl': 60, 'records': []}])
+
+        stdout, *_ = addzones('incremental', '--incremental', '--dry-run')
+        print("\n".join(f"    {line}" for line in stdout.strip().split('\n')))
+        planned = collections.Counter(line.split()[0] for line in stdout.strip().split('\n')[:-1])
+        keys = sum(len(reference['keys'][zone]) for zone in removed)
+        expect(planned['configure'] == 3 and planned['fill'] == 3 and planned['generate'] == keys and
+               planned['sign'] == 4, "plan covers exactly the removed zones and the unsigned zone")
+        _, _, added, patched = addzones('incremental', '--incremental', '--verify-keys')
+        expect(sum(added.values()) == keys, "only the keys of the removed zones are added")
+        expect(patched == 1, "only the missing DS is sent to deSEC")
+        same_state("after repairing")
+        return scenario.result("incremental provisioning only adds what is missing")
+
+
+def check_keypool(args) -> int:
+    with tempfile.TemporaryDirectory() as directory:
+        scenario = Scenario(directory, args)
+        state_dir = os.path.join(directory, 'pool')
+        fixed_keys = os.path.join(state_dir, 'fixed-keys')
+        os.makedirs(fixed_keys)
+        needed = sum(len(algorithms) for algorithms, _, _ in zone_matrix(dns.name.from_text(args.zone)))
+
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'keypool.py'),
+                        'fill', '--jobs', str(args.jobs)], env=dict(scenario.env, FIXED_KEYS_DIR=fixed_keys),
+                       check=True, stdout=subprocess.DEVNULL)
+        print(f"keypool.py fill: {time.perf_counter() - start:.1f}s")
+        pool = KeyPool(fixed_keys)
+        scenario.expect(sum(len(pool.available(a)) for a in ALGORITHMS) == needed, f"the pool has the {needed} keys needed")
+
+        _, _, added, _ = scenario.addzones('pool', '--verify-keys', '--jobs', str(args.jobs))
+        scenario.expect(sum(added.values()) == needed and not generated(added), "all keys are imported from the pool")
+        pool = KeyPool(fixed_keys)
+        scenario.expect(not any(pool.available(a) for a in ALGORITHMS), "the pool is used up")
+        scenario.expect(sum(len(keys) for keys in pool.manifest.values()) == needed, "the manifest binds all keys")
+        before, delegations = knot_state(state_dir), scenario.delegations()
+
+        # a rebuild of the nsa_storage volume loses the configuration, zones and keys of the name server
+        os.remove(os.path.join(state_dir, 'knot.json'))
+        shutil.rmtree(os.path.join(state_dir, 'kasp'))
+        shutil.rmtree(os.path.join(state_dir, 'keys'))
+        _, _, added, patched = scenario.addzones('pool', '--incremental', '--verify-keys', '--jobs', str(args.jobs))
+        scenario.expect(sum(added.values()) == needed and not generated(added), "after a rebuild, the same keys are imported")
+        scenario.expect(knot_state(state_dir) == before, "the name server has the same keys after a rebuild")
+        scenario.expect(not patched and scenario.delegations() == delegations, "no new DS records are sent to deSEC")
+        return scenario.result("keys are reused from the pool and the manifest")
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'knotc':
+        return fake_knotc(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'keymgr':
+        return fake_keymgr(sys.argv[2:])
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['check', 'check-incremental', 'check-keypool'])
+    parser.add_argument('--zone', default='example.com.')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--keygen-delay', type=float, default=.2, help="seconds per fake RSA key generation")
+    args = parser.parse_args()
+    sys.exit({'check': check, 'check-incremental': check_incremental, 'check-keypool': check_keypool}[args.command](args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+DNSKEY and DS records of the zones addzones.py provisions, computed in-process from the PEM files of their keys (see
+keypool.py) instead of by a keymgr process per zone and query. Keys are loaded once and the records cached per zone.
+DS records are made with the digest types keymgr ds uses, SHA-256 and SHA-384.
+"""
+import threading
+from typing import Dict, List, Optional, Set
+
+import dns.dnssec
+import dns.name
+import dns.rdataclass
+import dns.rdatatype
+import dns.rdtypes.ANY.DNSKEY
+import dns.rrset
+from cryptography.hazmat.primitives import serialization
+
+from keypool import KeyPool
+
+DS_DIGESTS = ['SHA256', 'SHA384']
+KSK_FLAGS = 257  # keys are generated with ksk=true zsk=true
+
+
+def load_dnskey(path: str, algorithm: int) -> dns.rdtypes.ANY.DNSKEY.DNSKEY:
+    with open(path, 'rb') as f:
+        key = serialization.load_pem_private_key(f.read(), password=None)
+    return dns.dnssec.make_dnskey(key.public_key(), algorithm, flags=KSK_FLAGS)
+
+
+class KeyMaterial:
+
+    def __init__(self, ttl: int = 0) -> None:
+        self.ttl = ttl
+        self.dnskeys: Dict[dns.name.Name, Dict[int, dns.rdtypes.ANY.DNSKEY.DNSKEY]] = {}
+        self.ds_cache: Dict[dns.name.Name, dns.rrset.RRset] = {}
+        self.excluded: Set[dns.name.Name] = set()  # zones with keys whose PEM files are unknown
+        self.lock = threading.Lock()
+
+    def add(self, zone: dns.name.Name, algorithm: int, path: str) -> None:
+        if zone in self.excluded:
+            return
+        dnskey = load_dnskey(path, algorithm)
+        with self.lock:
+            self.dnskeys.setdefault(zone, {})[int(algorithm)] = dnskey
+            self.ds_cache.pop(zone, None)
+
+    def load(self, zone: dns.name.Name, keys: Dict[str, int], pool: Optional[KeyPool]) -> bool:
+        """
+        Loads the keys of the zone, given as {keyid: algorithm} by keymgr list, from the manifest of the key pool.
+        If the pool does not have all of them, the zone is excluded and False returned.
+        """
+        entries = pool.manifest.get(zone.to_text(), {}) if pool else {}
+        paths = {}
+        for keyid, algorithm in keys.items():
+            entry = entries.get(str(int(algorithm)))
+            if not entry or entry['keyid'] != keyid or int(algorithm) in paths or not pool.bound(zone, algorithm):
+                self.excluded.add(zone)
+                return False
+            paths[int(algorithm)] = pool.bound(zone, algorithm)
+        for algorithm, path in paths.items():
+            self.add(zone, algorithm, path)
+        return True
+
+    def __contains__(self, zone: dns.name.Name) -> bool:
+        return zone in self.dnskeys
+
+    def dnskey(self, zone: dns.name.Name) -> dns.rrset.RRset:
+        rrset = dns.rrset.RRset(zone, dns.rdataclass.IN, dns.rdatatype.DNSKEY)
+        rrset.update_ttl(self.ttl)
+        for _, dnskey in sorted(self.dnskeys[zone].items()):
+            rrset.add(dnskey)
+        return rrset
+
+    def ds(self, zone: dns.name.Name) -> dns.rrset.RRset:
+        with self.lock:
+            rrset = self.ds_cache.get(zone)
+        if rrset is None:
+            rrset = dns.rrset.RRset(zone, dns.rdataclass.IN, dns.rdatatype.DS)
+            rrset.update_ttl(self.ttl)
+            for _, dnskey in sorted(self.dnskeys[zone].items()):
+                for digest in DS_DIGESTS:
+                    rrset.add(dns.dnssec.make_ds(zone, dnskey, digest))
+            with self.lock:
+                self.ds_cache[zone] = rrset
+        return rrset
+
+    def zones(self) -> List[dns.name.Name]:
+        return list(self.dnskeys)
@@ -0,0 +1,152 @@
+"""
+Pre-generated DNSSEC keys for addzones.py, and the manifest of which key belongs to which zone, both kept in
+FIXED_KEYS_DIR (keys/ of the repository, which survives rebuilds of the nsa_storage volume).
+
+Keys of the pool are PKCS#8 PEM files, as keymgr import-pem takes them, in pool/<algorithm>/. A zone gets the key its
+manifest entry points to, else the copy {zone}-{algorithm}.pem of an earlier run, else a key taken from the pool;
+only if there is none, keymgr generates a new one. Reusing keys keeps the DS records, so deSEC needs no new ones.
+
+    python3 keypool.py fill [--count N] [--jobs N]   # pre-generate the keys the zones below ZONE still need
+    python3 keypool.py status
+"""
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import dns.dnssec
+import dns.name
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed448, ed25519, rsa
+from tqdm import tqdm
+
+from zonematrix import ALGORITHMS, zones as zone_matrix
+
+# requirements: cryptography, dnspython, tqdm
+
+FIXED_KEYS_DIR = os.environ.get('FIXED_KEYS_DIR', '/fixed-keys')
+RSA_KEY_SIZE = 2048
+CURVES = {
+    dns.dnssec.ECDSAP256SHA256: ec.SECP256R1,
+    dns.dnssec.ECDSAP384SHA384: ec.SECP384R1,
+}
+
+
+def generate_pem(algorithm: int) -> bytes:
+    algorithm = dns.dnssec.Algorithm(algorithm)
+    if algorithm in CURVES:
+        key = ec.generate_private_key(CURVES[algorithm]())
+    elif algorithm == dns.dnssec.ED25519:
+        key = ed25519.Ed25519PrivateKey.generate()
+    elif algorithm == dns.dnssec.ED448:
+        key = ed448.Ed448PrivateKey.generate()
+    else:
+        key = rsa.generate_private_key(public_exponent=65537, key_size=RSA_KEY_SIZE)
+    return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                             serialization.NoEncryption())
+
+
+class KeyPool:
+
+    def __init__(self, directory: str = FIXED_KEYS_DIR) -> None:
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, 'manifest.json')
+        self.lock = threading.Lock()
+        self.manifest: Dict[str, Dict[str, dict]] = {}  # zone -> algorithm -> {file, keyid, bound}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def pool_dir(self, algorithm: int) -> str:
+        return os.path.join(self.directory, 'pool', str(int(algorithm)))
+
+    def available(self, algorithm: int) -> List[str]:
+        if not os.path.isdir(self.pool_dir(algorithm)):
+            return []
+        return sorted(name for name in os.listdir(self.pool_dir(algorithm)) if name.endswith('.pem'))
+
+    def fixed_path(self, zone: dns.name.Name, algorithm: int) -> str:
+        return os.path.join(self.directory, f"{zone.to_text()}-{int(algorithm)}.pem")
+
+    def bound(self, zone: dns.name.Name, algorithm: int) -> Optional[str]:
+        """The key file of the zone and algorithm, from the manifest or an earlier run."""
+        entry = self.manifest.get(zone.to_text(), {}).get(str(int(algorithm)))
+        if entry and os.path.exists(os.path.join(self.directory, entry['file'])):
+            return os.path.join(self.directory, entry['file'])
+        if os.path.exists(self.fixed_path(zone, algorithm)):
+            return self.fixed_path(zone, algorithm)
+        return None
+
+    def take(self, zone: dns.name.Name, algorithm: int) -> Optional[str]:
+        """Moves a key of the pool to the key file of the zone and algorithm; None if the pool is empty."""
+        for name in self.available(algorithm):
+            try:
+                os.rename(os.path.join(self.pool_dir(algorithm), name), self.fixed_path(zone, algorithm))
+            except FileNotFoundError:  # taken by someone else in the meantime
+                continue
+            return self.fixed_path(zone, algorithm)
+        return None
+
+    def key_for(self, zone: dns.name.Name, algorithm: int) -> Optional[str]:
+        return self.bound(zone, algorithm) or self.take(zone, algorithm)
+
+    def bind(self, zone: dns.name.Name, algorithm: int, path: str, keyid: str) -> None:
+        with self.lock:
+            self.manifest.setdefault(zone.to_text(), {})[str(int(algorithm))] = {
+                'file': os.path.relpath(path, self.directory), 'keyid': keyid, 'bound': int(time.time()),
+            }
+            with open(f"{self.manifest_path}.tmp", 'w') as f:
+                json.dump(self.manifest, f, indent=2, sort_keys=True)
+            os.replace(f"{self.manifest_path}.tmp", self.manifest_path)
+
+    def add(self, algorithm: int, pem: bytes) -> None:
+        os.makedirs(self.pool_dir(algorithm), exist_ok=True)
+        path = os.path.join(self.pool_dir(algorithm), f"{uuid.uuid4().hex}.pem")
+        with open(f"{path}.tmp", 'wb') as f:  # not taken before it is complete
+            f.write(pem)
+        os.replace(f"{path}.tmp", path)
+
+    def needed(self, zones) -> Dict[int, int]:
+        """Number of keys per algorithm the zones still need from the pool."""
+        needed = {int(algorithm): 0 for algorithm in ALGORITHMS}
+        for algorithms, _, name in zones:
+            for algorithm in algorithms:
+                if not self.bound(name, algorithm):
+                    needed[int(algorithm)] += 1
+        return {algorithm: max(0, count - len(self.available(algorithm))) for algorithm, count in needed.items()}
+
+    def fill(self, counts: Dict[int, int], jobs: int) -> None:
+        algorithms = [algorithm for algorithm, count in counts.items() for _ in range(count)]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            keys = {executor.submit(generate_pem, algorithm): algorithm for algorithm in algorithms}
+            for future in tqdm(concurrent.futures.as_completed(keys), total=len(keys)):
+                self.add(keys[future], future.result())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['fill', 'status'])
+    parser.add_argument('--count', type=int, help="keys per algorithm to add; default: what the zones still need")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    pool = KeyPool()
+    zones = zone_matrix(dns.name.from_text(os.environ['ZONE'])) if os.environ.get('ZONE') else []
+    if args.command == 'fill':
+        counts = {int(a): args.count for a in ALGORITHMS} if args.count is not None else pool.needed(zones)
+        logging.warning(f"generating keys: {counts}")
+        pool.fill(counts, args.jobs)
+    for algorithm in ALGORITHMS:
+        print(f"{algorithm.name}: {len(pool.available(algorithm))} keys in the pool"
+              + (f", {pool.needed(zones)[int(algorithm)]} more needed" if zones else ""))
+    print(f"{sum(len(keys) for keys in pool.manifest.values())} keys bound to zones")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+"""
+Checks and benchmark of the streaming join of correlate.py on a synthetic campaign: browser sessions with a token
+each look up --tests test names below the study domain through a few resolvers (A and AAAA, sometimes through two
+resolvers) and load some of them a little later. The lookups are written to request log segments (rotated every
+--rotate seconds) in the order they would arrive, i.e. up to a few seconds late in batches, plus some rows that come
+much too late and some rows of names that are not part of the study; the requests go to a downg2 JSON access log,
+with a few malformed lines. The joined sessions are compared with what was generated, and the throughput and the
+largest number of sessions held at a time (bounded by the window, not the campaign) are reported.
+
+With --follow, the logs are instead written in real time while correlate.py follows them, rotating the access log by
+renaming it halfway through.
+
+    python3 bench_correlate.py [--sessions 20000] [--tests 10] [--follow]
+"""
+import argparse
+import io
+import json
+import math
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Dict, List, Tuple
+
+import correlate
+from requestlog import SQL_INIT_STMT, SQL_INSERT_STMT, segment_path
+
+STUDY_DOMAIN = "downgrade.dedyn.io"
+TESTS = [f"mitm-ra.ds{a}-dnskey{a}" for a in (5, 8, 10, 13, 14, 15, 16)] + [
+    "mitm-ra-ds8-ds13.ds13-ds16-dnskey13-dnskey16", "mitm-rs13-ra.ds8-ds16-dnskey16", "mitm-rs15-ra.ds16",
+    "mitm-rs16-ra.ds8-ds13-dnskey13", "mitm-rs8-ra.ds15-ds16-dnskey16",
+]
+RESOLVERS = [f"192.0.2.{i}" for i in range(1, 41)]
+WINDOW, DNS_LATENESS, HTTP_LATENESS = 60, 30, 10
+TOO_LATE = 300  # seconds; rows that arrive this late are dropped as late
+
+
+class Campaign:
+    """The generated events, in the order they arrive, and the sessions the join should give."""
+
+    def __init__(self, sessions: int, tests: int, start: float, gap: float, seed: int = 1) -> None:
+        rng = random.Random(seed)
+        self.rows: List[Tuple[float, float, str, str, str]] = []  # (arrival, time, host, qname, qtype)
+        self.lines: List[Tuple[float, str]] = []  # (arrival, JSON line)
+        self.expected: Dict[Tuple[str, str], dict] = {}
+        self.late = 0
+        for i in range(sessions):
+            token = f"adn{rng.randrange(2 ** 32)}"
+            t0 = start + i * gap
+            for test in rng.sample(TESTS, min(tests, len(TESTS))):
+                name = f"{token}-{test}.{STUDY_DOMAIN}."
+                looked_up = t0 + rng.uniform(0, 2)
+                resolvers = [rng.choice(RESOLVERS)] * 2 + ([rng.choice(RESOLVERS)] if rng.random() < .2 else [])
+                lookups = []
+                for host, qtype in zip(resolvers, ['A', 'AAAA', 'A']):
+                    t = looked_up + rng.uniform(0, .2)
+                    lookups.append(t)
+                    self.rows.append((t + rng.uniform(0, 5), t, host, name, qtype))
+                # a retry that reaches the log far too late, dropped (if later rows moved the watermark on)
+                if rng.random() < .01 and t0 + TOO_LATE + WINDOW + DNS_LATENESS < start + sessions * gap:
+                    self.rows.append((looked_up + TOO_LATE, looked_up + 1, resolvers[0], name, 'A'))
+                    self.late += 1
+                loaded = rng.random() < .6
+                request_time = max(lookups) + rng.uniform(.05, 5) if loaded else None
+                if loaded:
+                    self.lines.append((request_time + rng.uniform(0, 2), json.dumps(dict(
+                        time_epoch=int(request_time * 1000), ip_client=f"198.51.100.{i % 250}", request_method='GET',
+                        host_header=name.rstrip('.').upper() if i % 7 == 0 else name.rstrip('.'),
+                        url_path='/img.png', query=f"?test={test}&tok={token}&time={int(request_time * 1000)}",
+                        status=200, user_agent='bench'))))
+                self.expected[token, test] = dict(lookups=len(lookups), resolvers=sorted(set(resolvers)),
+                                                  loaded=loaded, request_time=request_time)
+            # names the join skips: of other zones, and minimized queries without a token
+            self.rows.append((t0, t0, RESOLVERS[0], "www.ds8-dnskey8.example.com.", 'A'))
+            self.rows.append((t0, t0, RESOLVERS[0], f"ds8-dnskey8.{STUDY_DOMAIN}.", 'A'))
+            if i % 1000 == 0:
+                self.lines.append((t0, '{"time_epoch": 1, "host_header": "\\xff'))  # Apache's escaping
+        self.rows.sort()
+        self.lines.sort()
+
+
+class RequestLogWriter:
+    """Writes rows to request log segments as the SqliteLogger does, beginning a new one every `rotate` seconds."""
+
+    def __init__(self, directory: str, rotate: float) -> None:
+        self.directory = directory
+        self.rotate = rotate
+        self.con = None
+        self.segment_end = -math.inf
+
+    def write(self, arrival: float, rows: List[tuple]) -> None:
+        if arrival >= self.segment_end:
+            if self.con is not None:
+                self.con.close()
+            self.con = sqlite3.connect(segment_path(self.directory, arrival))
+            self.con.execute("PRAGMA journal_mode=WAL;")
+            self.con.execute(SQL_INIT_STMT)
+            self.segment_end = arrival + self.rotate
+        with self.con:
+            self.con.executemany(SQL_INSERT_STMT, [
+                (time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(t)), t, host, 4711, qname, qtype, 'IN', None, None)
+                for t, host, qname, qtype in rows
+            ])
+
+
+def compare(campaign: Campaign, records: List[dict], joiner: correlate.Joiner) -> int:
+    failures = 0
+    joined = {(r['token'], r['test']): r for r in records}
+    if len(joined) != len(records):
+        print(f"FAILED: {len(records) - len(joined)} sessions emitted more than once")
+        failures += 1
+    for key, expected in campaign.expected.items():
+        record = joined.get(key)
+        if record is None:
+            failures += 1
+            if failures < 5:
+                print(f"FAILED: session {key} not emitted")
+            continue
+        got = dict(lookups=record['lookups'], resolvers=sorted(record['resolvers']), loaded=record['loaded'],
+                   request_time=record['request_time'])
+        if expected['request_time'] is not None and got['request_time'] is not None:
+            got['request_time'] = expected['request_time'] if abs(
+                got['request_time'] - expected['request_time']) < .002 else got['request_time']
+        if got != expected:
+            failures += 1
+            if failures < 5:
+                print(f"FAILED: session {key}: {got} instead of {expected}")
+    if len(joined) != len(campaign.expected):
+        print(f"FAILED: {len(joined)} sessions emitted instead of {len(campaign.expected)}")
+        failures += 1
+    if joiner.stats['late_lookups'] != campaign.late:
+        print(f"FAILED: {joiner.stats['late_lookups']} late lookups instead of {campaign.late}")
+        failures += 1
+    return failures
+
+
+def batch(args, directory: str) -> int:
+    campaign = Campaign(args.sessions, args.tests, 1.7e9, args.gap)
+    writer = RequestLogWriter(directory, args.rotate)
+    batch_rows, batch_arrival = [], None
+    for arrival, t, host, qname, qtype in campaign.rows:  # in batches, as the workers hand them over
+        batch_rows.append((t, host, qname, qtype))
+        batch_arrival = batch_arrival or arrival
+        if len(batch_rows) >= 64 or arrival - batch_arrival > .5:
+            writer.write(batch_arrival, batch_rows)
+            batch_rows, batch_arrival = [], None
+    if batch_rows:
+        writer.write(batch_arrival, batch_rows)
+    access_log = os.path.join(directory, 'access-downg.json')
+    with open(access_log, 'w') as f:
+        f.writelines(line + "\n" for _, line in campaign.lines)
+
+    out = io.StringIO()
+    joiner = correlate.Joiner(WINDOW, out)
+    start = time.perf_counter()
+    correlate.run(correlate.AccessLog(access_log, [STUDY_DOMAIN], HTTP_LATENESS, False, 0),
+                  correlate.RequestLogSource(directory, [STUDY_DOMAIN], DNS_LATENESS, False, 0), joiner)
+    elapsed = time.perf_counter() - start
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    events = joiner.stats['lookups'] + joiner.stats['requests']
+    print(f"joined {events} lookups and requests into {len(records)} sessions in {elapsed:.1f}s "
+          f"({events / elapsed:.0f} events/s), at most {joiner.stats['max_sessions']} sessions held at a time; "
+          f"{joiner.stats}")
+    failures = compare(campaign, records, joiner)
+    per_second = args.tests / args.gap
+    bound = per_second * (WINDOW + DNS_LATENESS + 10)
+    if joiner.stats['max_sessions'] > bound:
+        print(f"FAILED: held up to {joiner.stats['max_sessions']} sessions, more than {bound:.0f}")
+        failures += 1
+    return failures
+
+
+def follow(args, directory: str) -> int:
+    window, dns_lateness, http_lateness, idle = 8, 6, 3, 2  # just above how late the events are generated
+    campaign = Campaign(args.sessions, args.tests, time.time() + 1, args.gap)
+    access_log = os.path.join(directory, 'access-downg.json')
+    open(access_log, 'w').close()
+    out_path = os.path.join(directory, 'joined.jsonl')
+    out = open(out_path, 'w')
+    joiner = correlate.Joiner(window, out)
+    rows = [(a, t, h, q, qt) for a, t, h, q, qt in campaign.rows if a - t < TOO_LATE]  # no waiting for those
+    campaign.late = 0
+    threading.Thread(target=correlate.run, daemon=True, args=(
+        correlate.AccessLog(access_log, [STUDY_DOMAIN], http_lateness, True, idle),
+        correlate.RequestLogSource(directory, [STUDY_DOMAIN], dns_lateness, True, idle), joiner, .05)).start()
+
+    writer = RequestLogWriter(directory, args.rotate)
+    events = sorted([(a, 'row', r) for a, *r in rows] + [(a, 'line', line) for a, line in campaign.lines],
+                    key=lambda e: e[0])
+    f = open(access_log, 'a')
+    rotated = False
+    for arrival, kind, event in events:
+        time.sleep(max(0, arrival - time.time()))
+        if kind == 'row':
+            writer.write(arrival, [tuple(event)])
+        else:
+            if not rotated and arrival > events[len(events) // 2][0]:
+                f.close()
+                os.rename(access_log, access_log + '.1')
+                f = open(access_log, 'a')
+                rotated = True
+            f.write(event[:len(event) // 2])  # as Apache may, in two writes
+            f.flush()
+            f.write(event[len(event) // 2:] + "\n")
+            f.flush()
+    f.close()
+    deadline = time.time() + window + dns_lateness + idle + 10
+    while time.time() < deadline and joiner.stats['sessions'] < len(campaign.expected):
+        time.sleep(.2)
+    out.flush()
+    records = [json.loads(line) for line in open(out_path)]
+    print(f"followed the logs for {len(records)} sessions; {joiner.stats}")
+    return compare(campaign, records, joiner)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=20000, help="browser sessions")
+    parser.add_argument('--tests', type=int, default=10, help="test names per session")
+    parser.add_argument('--gap', type=float, default=.05, help="seconds between the start of sessions")
+    parser.add_argument('--rotate', type=float, default=300, help="seconds per request log segment")
+    parser.add_argument('--follow', action='store_true', help="follow logs written in real time")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.follow:
+            failures = follow(args, directory)
+        else:
+            failures = batch(args, directory)
+    if failures:
+        raise SystemExit(f"FAILED: {failures} differences")
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
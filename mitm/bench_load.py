@@ -0,0 +1,446 @@
+"""
+Load generator and latency benchmark for the mitm proxy.
+
+Starts the stand-in authoritative server (standin_auth.py, serving the addzones.py layout) and, with --spawn, the
+proxy itself (mitm.py, in the given serving mode, with BE_EVIL set), then sends a mix of queries for mitm-* labels
+below the test zones over UDP and/or TCP, at a target rate (--qps, 0: as fast as the concurrency allows) with at most
+--concurrency queries outstanding. Reports throughput, latency percentiles, timeouts, errors and the RSS of the proxy
+processes as one JSON object per transport (on stdout or appended to --output), e.g.
+
+    python3 bench_load.py --spawn fork --transport udp,tcp --qps 2000 --concurrency 64 --duration 10
+    python3 bench_load.py --spawn async --env ADNSSEC_NUM_LOOPS=4 --output results.jsonl
+    python3 bench_load.py --target 127.0.0.1:53 --auth none --pid $(pgrep -of mitm.py)
+"""
+import argparse
+import asyncio
+import collections
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+
+from standin_auth import StandinAuth, zone_matrix
+
+# (first label, qtype, weight): a mix of plain queries and all instruction codes; {a} is an algorithm of the zone
+MIX = [
+    ('www', 'A', 20),
+    ('mitm', 'A', 5),
+    ('mitm-ra', 'A', 10),
+    ('mitm-rt', 'TXT', 10),
+    ('mitm-rs16-rd', 'DS', 5),
+    ('mitm-rs{a}', 'A', 10),
+    ('mitm-ds{a}', 'A', 10),
+    ('mitm-as15', 'A', 10),
+    ('mitm-as16-ds{a}', 'A', 5),
+    ('mitm-at', 'TXT', 5),
+    ('mitm-ms', 'A', 10),
+]
+
+
+def queries(origin: dns.name.Name, count: int, seed: int) -> List[bytes]:
+    """A pool of wire-format queries drawn from MIX over all test zones, with the DO bit set as by resolvers."""
+    rng = random.Random(seed)
+    zones = zone_matrix(origin)
+    weights = [weight for _, _, weight in MIX]
+    pool = []
+    for _ in range(count):
+        label, qtype, _ = rng.choices(MIX, weights)[0]
+        algorithms, _, zone = rng.choice(zones)
+        label = label.format(a=int(rng.choice(algorithms)))
+        q = dns.message.make_query(dns.name.Name([label.encode()]) + zone, qtype, want_dnssec=True, payload=1232)
+        pool.append(q.to_wire())
+    return pool
+
+
+class Stats:
+
+    def __init__(self) -> None:
+        self.latencies: List[float] = []
+        self.counters = collections.Counter()
+
+    def merge(self, other: dict) -> None:
+        self.latencies.extend(other['latencies'])
+        self.counters.update(other['counters'])
+
+
+class UDPClient(asyncio.DatagramProtocol):
+
+    def __init__(self) -> None:
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        future = self.pending.pop(struct.unpack('!H', data[:2])[0], None)
+        if future is not None and not future.done():
+            future.set_result(data)
+
+    async def query(self, query: bytes, timeout: float) -> bytes:
+        query_id = random.randrange(1 << 16)
+        while query_id in self.pending:
+            query_id = random.randrange(1 << 16)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[query_id] = future
+        self.transport.sendto(struct.pack('!H', query_id) + query[2:])
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(query_id, None)
+
+
+class TCPClient:
+    """A persistent connection with pipelined queries, matched to their responses by ID."""
+
+    def __init__(self, address) -> None:
+        self.address = address
+        self.writer = None
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.lock = asyncio.Lock()
+
+    async def connect(self) -> None:
+        async with self.lock:
+            if self.writer is None:
+                reader, self.writer = await asyncio.open_connection(*self.address)
+                asyncio.ensure_future(self.read_loop(reader, self.writer))
+
+    async def read_loop(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                length = struct.unpack('!H', await reader.readexactly(2))[0]
+                data = await reader.readexactly(length)
+                future = self.pending.pop(struct.unpack('!H', data[:2])[0], None)
+                if future is not None and not future.done():
+                    future.set_result(data)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            if self.writer is writer:
+                self.writer = None
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionResetError("connection closed"))
+            self.pending.clear()
+
+    async def query(self, query: bytes, timeout: float) -> bytes:
+        await self.connect()
+        query_id = random.randrange(1 << 16)
+        while query_id in self.pending:
+            query_id = random.randrange(1 << 16)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[query_id] = future
+        self.writer.write(struct.pack('!HH', len(query), query_id) + query[2:])
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(query_id, None)
+
+
+async def tcp_query(address, query: bytes, timeout: float) -> bytes:
+    async def exchange():
+        reader, writer = await asyncio.open_connection(*address)
+        try:
+            writer.write(struct.pack('!H', len(query)) + query)
+            length = struct.unpack('!H', await reader.readexactly(2))[0]
+            return await reader.readexactly(length)
+        finally:
+            writer.close()
+    return await asyncio.wait_for(exchange(), timeout)
+
+
+async def generate(address, transport: str, pool: List[bytes], qps: float, concurrency: int, duration: float,
+                   timeout: float, tcp_connections: int) -> dict:
+    stats = {'latencies': [], 'counters': collections.Counter()}
+    loop = asyncio.get_running_loop()
+    udp = None
+    if transport == 'udp':
+        _, udp = await loop.create_datagram_endpoint(UDPClient, remote_addr=address)
+    tcp = [TCPClient(address) for _ in range(tcp_connections)]
+    start = loop.time()
+    end = start + duration
+    interval = concurrency / qps if qps else 0
+
+    async def worker(i: int):
+        rng = random.Random(i)
+        next_send = start + interval * i / concurrency
+        while True:
+            if interval:
+                delay = next_send - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                next_send = max(next_send + interval, loop.time() - interval)
+            if loop.time() >= end:
+                return
+            query = rng.choice(pool)
+            sent = time.perf_counter()
+            stats['counters']['sent'] += 1
+            try:
+                if udp:
+                    response = await udp.query(query, timeout)
+                elif tcp:
+                    response = await tcp[i % len(tcp)].query(query, timeout)
+                else:
+                    response = await tcp_query(address, query, timeout)
+            except asyncio.TimeoutError:
+                stats['counters']['timeouts'] += 1
+                continue
+            except (OSError, asyncio.IncompleteReadError):
+                stats['counters']['errors'] += 1
+                continue
+            stats['latencies'].append(time.perf_counter() - sent)
+            stats['counters']['received'] += 1
+            flags = struct.unpack('!H', response[2:4])[0]
+            if flags & dns.flags.TC:
+                stats['counters']['truncated'] += 1
+            stats['counters'][f'rcode_{dns.rcode.to_text(flags & 0xf)}'] += 1
+
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    if udp:
+        udp.transport.close()
+    for client in tcp:
+        if client.writer is not None:
+            client.writer.close()
+    return stats
+
+
+def generator_process(results: multiprocessing.Queue, *args) -> None:
+    stats = asyncio.run(generate(*args))
+    stats['counters'] = dict(stats['counters'])
+    results.put(stats)
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def process_tree(pid: int) -> List[int]:
+    children = collections.defaultdict(list)
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children[ppid].append(int(entry))
+    tree, todo = [], [pid]
+    while todo:
+        p = todo.pop()
+        tree.append(p)
+        todo.extend(children[p])
+    return tree
+
+
+def rss(pid: int) -> int:
+    """Resident set size in bytes, 0 if the process is gone."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+class RSSSampler(threading.Thread):
+    """Samples the RSS of a process and its descendants (the proxy workers) while the load runs."""
+
+    def __init__(self, pid: Optional[int], interval: float = .5) -> None:
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_total = 0
+        self.peak_worker = 0
+        self.last: Dict[int, int] = {}
+        self.stopped = threading.Event()
+
+    def sample(self) -> None:
+        self.last = {p: rss(p) for p in process_tree(self.pid)}
+        self.peak_total = max(self.peak_total, sum(self.last.values()))
+        self.peak_worker = max([self.peak_worker, *self.last.values()])
+
+    def run(self):
+        while self.pid and not self.stopped.wait(self.interval):
+            self.sample()
+
+    def result(self) -> Optional[dict]:
+        if not self.pid:
+            return None
+        self.sample()
+        return {
+            'processes': len(self.last),
+            'total_bytes': sum(self.last.values()),
+            'peak_total_bytes': self.peak_total,
+            'peak_worker_bytes': self.peak_worker,
+        }
+
+
+def wait_ready(address, origin: dns.name.Name, timeout: float = 15) -> None:
+    probe = dns.message.make_query(dns.name.Name([b'www']) + zone_matrix(origin)[0][2], 'A').to_wire()
+    deadline = time.monotonic() + timeout
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.settimeout(.5)
+        while time.monotonic() < deadline:
+            try:
+                s.sendto(probe, address)
+                s.recv(65535)
+                return
+            except OSError:
+                time.sleep(.2)
+    raise TimeoutError(f"no answer from {address[0]}:{address[1]}")
+
+
+def run_load(args, address, transport: str, pool: List[bytes], pid: Optional[int]) -> dict:
+    results = multiprocessing.Queue()
+    per_process = max(args.concurrency // args.processes, 1)
+    qps = args.qps / args.processes
+    if args.warmup:
+        warmup = [multiprocessing.Process(target=generator_process, args=(
+            results, address, transport, pool, qps, per_process, args.warmup, args.timeout, args.tcp_connections))
+            for _ in range(args.processes)]
+        for p in warmup:
+            p.start()
+        for _ in warmup:
+            results.get()
+        for p in warmup:
+            p.join()
+
+    sampler = RSSSampler(pid)
+    sampler.start()
+    generators = [multiprocessing.Process(target=generator_process, args=(
+        results, address, transport, pool, qps, per_process, args.duration, args.timeout, args.tcp_connections))
+        for _ in range(args.processes)]
+    start = time.perf_counter()
+    for p in generators:
+        p.start()
+    stats = Stats()
+    for _ in generators:
+        stats.merge(results.get())
+    elapsed = time.perf_counter() - start
+    for p in generators:
+        p.join()
+    sampler.stopped.set()
+
+    latencies = sorted(stats.latencies)
+    counters = stats.counters
+    return {
+        'time': time.time(),
+        'mode': args.spawn or args.mode,
+        'transport': transport,
+        'target_qps': args.qps,
+        'concurrency': per_process * args.processes,
+        'tcp_connections': args.tcp_connections if transport == 'tcp' else None,
+        'duration': args.duration,
+        'sent': counters['sent'],
+        'received': counters['received'],
+        'timeouts': counters['timeouts'],
+        'errors': counters['errors'],
+        'truncated': counters['truncated'],
+        'rcodes': {k[len('rcode_'):]: v for k, v in sorted(counters.items()) if k.startswith('rcode_')},
+        'throughput_qps': counters['received'] / elapsed,
+        'latency_ms': {
+            name: (value * 1000 if value is not None else None) for name, value in [
+                ('p50', percentile(latencies, 50)),
+                ('p99', percentile(latencies, 99)),
+                ('p999', percentile(latencies, 99.9)),
+                ('max', latencies[-1] if latencies else None),
+                ('mean', sum(latencies) / len(latencies) if latencies else None),
+            ]
+        },
+        'rss': sampler.result(),
+        'env': dict(args.env),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--zone', default='example.com.')
+    parser.add_argument('--auth', default='127.0.0.1:5300',
+                        help="address to run the stand-in auth server on, 'none' to use a running name server")
+    parser.add_argument('--target', default='127.0.0.1:5353', help="address of the mitm proxy")
+    parser.add_argument('--spawn', metavar='MODE', help="start mitm.py in this ADNSSEC_SERVE_MODE on --target")
+    parser.add_argument('--env', action='append', default=[], type=lambda s: tuple(s.split('=', 1)),
+                        help="KEY=VALUE environment for the spawned proxy, repeatable")
+    parser.add_argument('--pid', type=int, help="pid of an already running proxy, for RSS measurements")
+    parser.add_argument('--mode', default=None, help="label for the results if the proxy is not spawned")
+    parser.add_argument('--transport', default='udp', help="udp, tcp or udp,tcp")
+    parser.add_argument('--qps', type=float, default=0, help="target rate over all generators, 0: unlimited")
+    parser.add_argument('--concurrency', type=int, default=32, help="maximum queries outstanding")
+    parser.add_argument('--processes', type=int, default=1, help="generator processes")
+    parser.add_argument('--tcp-connections', type=int, default=0,
+                        help="persistent, pipelined TCP connections per generator process, 0: one per query")
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=1)
+    parser.add_argument('--timeout', type=float, default=2)
+    parser.add_argument('--pool', type=int, default=10000, help="number of distinct queries")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="append results as JSON lines to this file instead of printing them")
+    args = parser.parse_args()
+
+    origin = dns.name.from_text(args.zone)
+    host, port = args.target.rsplit(':', 1)
+    address = (host, int(port))
+    standin, proxy, pid = None, None, args.pid
+    auth_env = {}
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            if args.auth != 'none':
+                auth_host, auth_port = args.auth.rsplit(':', 1)
+                auth_env = dict(AUTH_NS_HOST=auth_host, AUTH_NS_PORT=auth_port)
+                standin = multiprocessing.Process(
+                    target=StandinAuth(origin).serve, args=(auth_host, int(auth_port)), daemon=True)
+                standin.start()
+            if args.spawn:
+                env = dict(
+                    os.environ, ADNSSEC_SERVE_MODE=args.spawn, ADNSSEC_HOST=address[0], ADNSSEC_PORT=str(address[1]),
+                    BE_EVIL='1', ADNSSEC_LOG_LEVEL='WARNING', ADNSSEC_LOG_DIR=directory, ADNSSEC_DUMP_FILE='',
+                    **auth_env,
+                )
+                env.update(args.env)
+                proxy = subprocess.Popen(
+                    [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mitm.py')],
+                    env=env, start_new_session=True, stdout=subprocess.DEVNULL,
+                )
+                pid = proxy.pid
+            wait_ready(address, origin)
+
+            pool = queries(origin, args.pool, args.seed)
+            for transport in args.transport.split(','):
+                result = run_load(args, address, transport, pool, pid)
+                line = json.dumps(result)
+                if args.output:
+                    with open(args.output, 'a') as f:
+                        f.write(line + '\n')
+                print(line if not args.output else
+                      f"{result['mode']} {transport}: {result['throughput_qps']:.0f} q/s, "
+                      f"p50 {result['latency_ms']['p50']} ms, p99 {result['latency_ms']['p99']} ms, "
+                      f"{result['timeouts']} timeouts", flush=True)
+        finally:
+            if proxy is not None:
+                os.killpg(proxy.pid, signal.SIGTERM)
+                proxy.wait()
+            if standin is not None:
+                standin.terminate()
+
+
+if __name__ == '__main__':
+    main()
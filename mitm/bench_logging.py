@@ -0,0 +1,79 @@
+"""
+Benchmark of the logging cost on the per-query path of mitm.py (parse_query and finalize, without network I/O), in
+queries per second for several log levels and dump sampling settings. Log output goes to /dev/null and dumps to a
+temporary file, so the numbers show formatting and serialization cost rather than terminal or docker log throughput.
+
+    python3 bench_logging.py [--seconds 2]
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+
+import dns.message
+
+os.environ.setdefault("AUTH_NS_HOST", "127.0.0.1")
+import mitm  # noqa: E402
+from bench_filters import responses  # noqa: E402
+from dumps import Dumper  # noqa: E402
+from requestlog import RequestLog  # noqa: E402
+
+SETTINGS = [
+    # (log level, dump 1 in N queries, always dumped qname prefixes)
+    ("DEBUG", 1, ()),
+    ("INFO", 1, ()),
+    ("WARNING", 1, ()),
+    ("WARNING", 100, ()),
+    ("WARNING", 100, ("mitm-ms",)),
+    ("WARNING", 0, ()),
+]
+
+
+class Discard:
+    """Stands in for the request log queue; the SqliteLogger is not part of this benchmark."""
+
+    def put(self, batch, block=True):
+        pass
+
+
+def run(pairs, seconds: float) -> float:
+    count, start = 0, time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for query, answer in pairs:
+            q = mitm.parse_query(query, "192.0.2.1", 4711)
+            mitm.finalize(q, answer, query, "192.0.2.1", 4711)
+        count += len(pairs)
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=2)
+    parser.add_argument('--engine', choices=['dnspython', 'wire'], default='dnspython')
+    args = parser.parse_args()
+
+    devnull = open(os.devnull, "w")
+    for handler in logging.getLogger().handlers:
+        handler.setStream(devnull)
+    mitm.BE_EVIL = True
+    mitm.FILTER_ENGINE = args.engine
+    mitm.REQUEST_LOG = RequestLog(Discard(), multiprocessing.Value('Q', 0))
+
+    pairs = []
+    for answer in responses():
+        a = dns.message.from_wire(answer)
+        pairs.append((dns.message.make_query(a.question[0].name, 'A', want_dnssec=True).to_wire(), answer))
+
+    print(f"{'level':10}{'sample':>8}  {'prefixes':12}{'queries/s':>12}")
+    with tempfile.TemporaryDirectory() as directory:
+        for level, sample, prefixes in SETTINGS:
+            logging.getLogger().setLevel(level)
+            mitm.DUMPER = Dumper(os.path.join(directory, "dumps.jsonl"), sample, prefixes)
+            qps = run(pairs, args.seconds)
+            print(f"{level:10}{sample:>8}  {','.join(prefixes) or '-':12}{qps:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""
+Benchmark of the cost of the metrics (see metrics.py): recording on the per-query path of mitm.py (digest with a
+stand-in upstream pool, so without network I/O) with and without instrumentation, taking snapshots in a worker, and
+merging and rendering the snapshots of many workers in the MetricsServer. Finally, a MetricsServer is started and the
+counts it serves are checked against the queries a few worker processes answered, also when a pid is reused and
+after the processes exited.
+
+    python3 bench_metrics.py [--seconds 2] [--engine dnspython|wire] [--workers 200]
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+import urllib.request
+
+import dns.message
+
+os.environ.setdefault("AUTH_NS_HOST", "127.0.0.1")
+import metrics  # noqa: E402
+import mitm  # noqa: E402
+from bench_filters import responses  # noqa: E402
+from bench_logging import Discard  # noqa: E402
+from requestlog import RequestLog  # noqa: E402
+
+INSTRUMENTS = ['QUERIES', 'QUERY_SECONDS', 'UPSTREAM_SECONDS', 'ANSWERS', 'REWRITES']
+
+
+class StandInPool:
+    """Answers from memory instead of the auth NS."""
+
+    def __init__(self, answers) -> None:
+        self.answers = answers
+
+    def query(self, wire: bytes) -> bytes:
+        return self.answers[wire[2:]]
+
+
+class Null:
+    """A metric that records nothing, to measure the path without instrumentation."""
+
+    def labels(self, *values):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+def run(queries, seconds: float) -> float:
+    count, start = 0, time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for query in queries:
+            mitm.digest(query, "192.0.2.1", 4711)
+        count += len(queries)
+    return count / (time.perf_counter() - start)
+
+
+def instrumentation(q: dns.message.Message) -> None:
+    """The metrics digest() and finalize() record for an upstream answer that was rewritten."""
+    start = time.perf_counter()
+    mitm.QUERIES.labels('udp').inc()
+    upstream_start = time.perf_counter()
+    mitm.UPSTREAM_SECONDS.observe(time.perf_counter() - upstream_start)
+    mitm.ANSWERS.labels('yes').inc()
+    mitm.count_rewrites(q)
+    mitm.QUERY_SECONDS.labels('udp').observe(time.perf_counter() - start)
+
+
+def per_call(function, number: int = 200000) -> float:
+    start = time.perf_counter()
+    for _ in range(number):
+        function()
+    return (time.perf_counter() - start) / number
+
+
+def worker(queries, repetitions: int) -> None:
+    for _ in range(repetitions):
+        for query in queries:
+            mitm.digest(query, "192.0.2.1", 4711)
+    metrics.REPORTER.report()
+
+
+def served(port: int, expected: str, failure: str) -> str:
+    """The metrics served, once they include the line expected."""
+    text = ""
+    for _ in range(50):
+        time.sleep(.1)
+        try:
+            text = urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics").read().decode()
+        except OSError:
+            continue
+        if expected in text.splitlines():
+            return text
+    raise SystemExit(f"FAILED: {failure}:\n{text}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=2, help="per run; the best of three runs counts")
+    parser.add_argument('--engine', choices=['dnspython', 'wire'], default='dnspython')
+    parser.add_argument('--workers', type=int, default=200, help="worker snapshots merged by the server")
+    parser.add_argument('--port', type=int, default=9153)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    mitm.BE_EVIL = True
+    mitm.FILTER_ENGINE = args.engine
+    mitm.REQUEST_LOG = RequestLog(Discard(), multiprocessing.Value('Q', 0))
+    answers, queries = {}, []
+    for answer in responses():
+        a = dns.message.from_wire(answer)
+        query = dns.message.make_query(a.question[0].name, 'A', want_dnssec=True).to_wire()
+        answers[query[2:]] = answer
+        queries.append(query)
+    mitm.UPSTREAM_POOL = StandInPool(answers)
+
+    counter, histogram = metrics.REGISTRY.metrics['mitm_queries_total'], metrics.REGISTRY.metrics['mitm_query_seconds']
+    print(f"counter labels().inc(): {per_call(lambda: counter.labels('udp').inc()) * 1e9:.0f} ns")
+    print(f"histogram labels().observe(): {per_call(lambda: histogram.labels('udp').observe(.0012)) * 1e9:.0f} ns")
+
+    saved = {name: getattr(mitm, name) for name in INSTRUMENTS}
+    instrumented = bare = 0
+    for _ in range(3):  # alternating, so that both see the same conditions
+        instrumented = max(instrumented, run(queries, args.seconds))
+        for name in INSTRUMENTS:
+            setattr(mitm, name, Null())
+        bare = max(bare, run(queries, args.seconds))
+        for name, metric in saved.items():
+            setattr(mitm, name, metric)
+    print(f"digest without metrics: {bare:.0f} queries/s, with metrics: {instrumented:.0f} queries/s")
+    q = max((dns.message.from_wire(query) for query in queries), key=lambda q: len(q.question[0].name.labels[0]))
+    cost = per_call(lambda: instrumentation(q), 20000)
+    print(f"metrics of a query ({q.question[0].name.labels[0].decode()}): {cost * 1e6:.1f} us, "
+          f"{cost * instrumented * 100:.2f}% of the time per query")
+
+    snapshot = metrics.REGISTRY.snapshot()
+    print(f"snapshot of a worker: {per_call(metrics.REGISTRY.snapshot, 2000) * 1e6:.0f} us")
+    snapshots = [snapshot] * args.workers
+    print(f"merging and rendering {args.workers} snapshots: "
+          f"{per_call(lambda: metrics.render(metrics.merge(snapshots)), 20) * 1e3:.1f} ms")
+
+    # end to end: worker processes report to a MetricsServer, whose sums are checked
+    snapshots_queue = multiprocessing.Queue(maxsize=1024)
+    metrics.REPORTER = metrics.Reporter(metrics.REGISTRY, snapshots_queue)
+    for metric in metrics.REGISTRY.metrics.values():
+        metric.children.clear()
+    metrics.RETIRE_AFTER = 1  # in the server process
+    server = metrics.MetricsServer(snapshots_queue, '127.0.0.1', args.port)
+    server.start()
+    processes = [multiprocessing.Process(target=worker, args=(queries, 10)) for _ in range(4)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    expected = 4 * 10 * len(queries)
+    text = served(args.port, f'mitm_queries_total{{transport="udp"}} {expected}',
+                  f"the server does not count {expected} queries")
+    print(f"OK: the server counts the {expected} queries of 4 worker processes")
+
+    # a worker that exits, a new one with its pid, and a late snapshot of the first: counters only go up
+    pid = next(pid for pid in range(2 ** 22 - 1, 0, -1) if not metrics.alive(pid))
+    for started, count in [(1.0, 5), (2.0, 3), (1.0, 7)]:
+        snapshots_queue.put((pid, started, {'mitm_queries_total': (
+            'counter', "Queries received", ('transport',), (), {('udp',): count})}))
+    served(args.port, f'mitm_queries_total{{transport="udp"}} {expected + 8}',
+           "snapshots of a reused pid are not added up")
+    text = served(args.port, 'mitm_metrics_processes 0', "exited processes are not retired")
+    if f'mitm_queries_total{{transport="udp"}} {expected + 8}' not in text:
+        raise SystemExit(f"FAILED: retiring exited processes changed the counts:\n{text}")
+    snapshots_queue.put(None)
+    server.join()
+    print("OK: the counts of exited processes are kept when their pids are reused or they are retired")
+    print("\n".join(line for line in text.splitlines() if not line.startswith(('#', 'mitm_query_seconds_bucket',
+                                                                                 'mitm_upstream_seconds_bucket'))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Checks and benchmark of the offline validator (validate.py) against the stand-in auth NS signing for real
+(standin_auth.py --sign, started here unless --auth is given).
+
+First, the verdicts of answers whose outcome is known are checked: plain answers validate, dropped, replaced or
+modified signatures make them bogus unless a signature of another supported algorithm of the zone remains, zones whose
+DS algorithms are all unsupported are insecure, and zones without a DNSKEY of a supported DS algorithm are bogus.
+Then the throughput of the process pool is measured on a pool of --distinct queries of the load mix (bench_load.py)
+over all test zones, validated once each (every answer new) and as --count queries drawn from the pool (repeated
+answers, as in a request log), with the upstream answers fetched beforehand.
+
+    python3 bench_validate.py [--distinct 2000] [--count 50000] [--processes 1,4]
+"""
+import argparse
+import logging
+import multiprocessing
+import random
+import sys
+import time
+
+import dns.message
+import dns.name
+
+import validate
+from bench_load import queries, wait_ready
+from standin_auth import StandinAuth
+from upstream import UpstreamPool
+
+ORIGIN = dns.name.from_text('example.com.')
+ALL = validate.ALGORITHMS
+# (first label, zone, qtype, supported algorithms, expected upstream verdict, expected final verdict)
+CASES = [
+    ('www', 'ds13-dnskey13', 'A', ALL, 'secure', 'secure'),
+    ('mitm', 'ds8-ds13-dnskey8-dnskey13', 'A', ALL, 'secure', 'secure'),
+    ('mitm-ds13', 'ds13-dnskey13', 'A', ALL, 'secure', 'bogus'),
+    ('mitm-ds13', 'ds8-ds13-dnskey8-dnskey13', 'A', ALL, 'secure', 'secure'),
+    ('mitm-ds13', 'ds8-ds13-dnskey8-dnskey13', 'A', [13], 'secure', 'bogus'),
+    ('mitm-ds13', 'ds8-ds13-dnskey8-dnskey13', 'A', [8], 'secure', 'secure'),
+    ('mitm-ra', 'ds15-dnskey15', 'A', ALL, 'secure', 'bogus'),
+    ('mitm-rt', 'ds16-dnskey16', 'TXT', ALL, 'secure', 'bogus'),
+    ('mitm-at', 'ds10-dnskey10', 'TXT', ALL, 'secure', 'bogus'),
+    ('mitm-ms', 'ds14-dnskey14', 'A', ALL, 'secure', 'bogus'),
+    ('mitm-rs13', 'ds8-dnskey8', 'A', ALL, 'secure', 'bogus'),
+    ('mitm-as15', 'ds8-dnskey8', 'A', ALL, 'secure', 'secure'),
+    ('mitm-as13', 'ds13-dnskey13', 'A', ALL, 'secure', 'secure'),  # the valid RRSIG is still there
+    ('mitm-rs16-rd', 'ds5-dnskey5', 'DS', ALL, 'secure', 'bogus'),
+    ('mitm-rs16-rd', 'ds5-dnskey5', 'A', ALL, 'secure', 'bogus'),  # referral with DS
+    ('www.mitm-rs16-rd', 'ds5-dnskey5', 'A', ALL, 'secure', 'secure'),
+    ('www', 'ds5-dnskey5', 'A', [8, 13], 'insecure', 'insecure'),
+    ('mitm-ds5', 'ds5-ds8-dnskey5-dnskey8', 'A', [5], 'secure', 'bogus'),
+    ('www', 'ds13', 'A', ALL, 'bogus', 'bogus'),
+    ('www', 'ds8-ds13-dnskey8', 'A', ALL, 'secure', 'secure'),
+    ('www', 'ds8-ds13-dnskey8', 'A', [13], 'bogus', 'bogus'),
+    ('nx', 'ds15-dnskey15', 'MX', ALL, 'secure', 'secure'),
+]
+
+
+def item(query: bytes, upstream: bytes = None) -> validate.Item:
+    q = dns.message.from_wire(query)
+    question = q.question[0]
+    filtered = question.name[0].lower().startswith(b'mitm')
+    return validate.Item('bench', q.id, time.time(), question.name.to_text(), dns.rdatatype.to_text(question.rdtype),
+                         None, filtered, query, upstream, None)
+
+
+def check_cases(auth) -> int:
+    failures = 0
+    for label, zone, qtype, algorithms, expected_upstream, expected_final in CASES:
+        qname = dns.name.from_text(f'{label}.{zone}', ORIGIN)
+        query = dns.message.make_query(qname, qtype, want_dnssec=True).to_wire()
+        row = validate.Validator(auth, ORIGIN, algorithms).row(item(query))
+        ok = (row['upstream_verdict'], row['final_verdict']) == (expected_upstream, expected_final)
+        failures += not ok
+        print(f"{'OK' if ok else 'FAILED'}: {qname} {qtype} with algorithms {','.join(map(str, algorithms))}: "
+              f"upstream {row['upstream_verdict']}, final {row['final_verdict']} {row['final_algorithms']} "
+              f"{row['final_reason']}"[:200])
+    return failures
+
+
+def measure(items, processes: int, auth) -> float:
+    start = time.perf_counter()
+    verdicts, stats = validate.run(items, None, processes, auth, ORIGIN)
+    elapsed = time.perf_counter() - start
+    print(f"  {processes} processes: {len(items) / elapsed:.0f} queries/s ({2 * len(items) / elapsed:.0f} answers/s); "
+          + ", ".join(f"{k}={v}" for k, v in sorted(stats.items())))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--auth', help="address of an auth NS signing for real, default: start one on 127.0.0.1:5301")
+    parser.add_argument('--distinct', type=int, default=2000, help="queries in the pool")
+    parser.add_argument('--count', type=int, default=50000, help="queries drawn from the pool")
+    parser.add_argument('--processes', default=f"1,{multiprocessing.cpu_count()}")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    host, _, port = (args.auth or '127.0.0.1:5301').rpartition(':')
+    auth = host, int(port)
+    if not args.auth:
+        multiprocessing.Process(target=StandinAuth(ORIGIN, sign=True).serve, args=auth, daemon=True).start()
+    wait_ready(auth, ORIGIN)
+
+    failures = check_cases(auth)
+
+    pool = UpstreamPool(*auth, size=1, timeout=2)
+    distinct = [item(query, pool.query(query)) for query in queries(ORIGIN, args.distinct, args.seed)]
+    rng = random.Random(args.seed)
+    repeated = [rng.choice(distinct) for _ in range(args.count)]
+    for processes in sorted({int(p) for p in args.processes.split(',')}):
+        print(f"{len(distinct)} distinct queries:")
+        measure(distinct, processes, auth)
+        print(f"{len(repeated)} queries drawn from them:")
+        measure(repeated, processes, auth)
+    if failures:
+        sys.exit(f"FAILED: {failures} verdicts not as expected")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+Cache of upstream answers in front of the upstream pool, per worker process.
+
+Answers are keyed on the normalized question (lowercase qname, qtype, qclass) plus the EDNS version and the DO and
+CD bits of the query and, for answers the upstream sent over UDP, the payload size it was asked with (it may leave
+out records that do not fit without setting TC), and kept for the smallest TTL in the answer, but at least
+`ttl_floor` (the test zones are served with TTL 0) and at most `ttl_max` seconds. TTLs in cached answers are not
+decremented. Only NOERROR and NXDOMAIN answers that are not truncated are cached. Entries are evicted in LRU order
+once their total size exceeds `max_bytes`.
+
+On a hit, the ID, RD flag and question (with the case of the query, e.g. for 0x20) of the cached answer are replaced
+by those of the query. The filtered answer and its first changed byte can be kept in the entry as well, so repeated
+queries skip filtering, too. forget_filtered() makes those filtered so far stale without taking the lock, so that it
+can be called from a signal handler.
+"""
+import collections
+import logging
+import struct
+import threading
+import time
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import dns.flags
+import dns.message
+import dns.rcode
+
+logger = logging.getLogger(__name__)
+
+TYPE_OPT = 41
+ENTRY_OVERHEAD = 200  # rough size in bytes of an entry besides its answers
+
+
+class CacheEntry:
+    __slots__ = ('upstream', 'expires', 'filtered', 'generation')
+
+    def __init__(self, upstream: bytes, expires: float) -> None:
+        self.upstream = upstream
+        self.expires = expires
+        self.filtered: Optional[Tuple[bytes, Optional[int]]] = None  # (final answer, first changed byte)
+        self.generation = 0  # of the cache when the filtered answer was set
+
+    def size(self) -> int:
+        return ENTRY_OVERHEAD + len(self.upstream) + (len(self.filtered[0]) if self.filtered else 0)
+
+
+class CacheKey(NamedTuple):
+    qname: str
+    qtype: int
+    qclass: int
+    edns: int
+    do: bool
+    cd: bool
+    payload: Optional[int]  # the UDP payload size the upstream was asked with, None over TCP
+
+
+def skip_name(wire: bytes, pos: int) -> int:
+    while True:
+        length = wire[pos]
+        if length == 0:
+            return pos + 1
+        if length & 0xC0 == 0xC0:
+            return pos + 2
+        pos += length + 1
+
+
+def min_ttl(wire: bytes) -> Optional[int]:
+    """The smallest TTL of all RRs but OPT; None for an answer without RRs or a malformed one."""
+    try:
+        qdcount, ancount, nscount, arcount = struct.unpack_from('!HHHH', wire, 4)
+        pos = 12
+        for _ in range(qdcount):
+            pos = skip_name(wire, pos) + 4
+        ttl = None
+        for _ in range(ancount + nscount + arcount):
+            pos = skip_name(wire, pos)
+            rdtype, _, rr_ttl, rdlength = struct.unpack_from('!HHIH', wire, pos)
+            pos += 10 + rdlength
+            if rdtype != TYPE_OPT:
+                ttl = rr_ttl if ttl is None else min(ttl, rr_ttl)
+        if pos > len(wire):
+            return None
+        return ttl
+    except (IndexError, struct.error):
+        return None
+
+
+def question_end(wire: bytes) -> int:
+    return skip_name(wire, 12) + 4
+
+
+def patch(answer: bytes, query: bytes) -> bytes:
+    """Gives answer the ID, RD flag and question of query; the questions differ at most in case."""
+    end = question_end(query)
+    flags = (answer[2] & ~(dns.flags.RD >> 8)) | (query[2] & (dns.flags.RD >> 8))
+    return query[:2] + bytes((flags,)) + answer[3:12] + query[12:end] + answer[end:]
+
+
+class ResponseCache:
+
+    def __init__(self, max_bytes: int, ttl_floor: float = 0, ttl_max: float = 3600, log_interval: float = 60) -> None:
+        self.max_bytes = max_bytes
+        self.ttl_floor = ttl_floor
+        self.ttl_max = ttl_max
+        self.entries: Dict[CacheKey, CacheEntry] = collections.OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.generation = 0  # filtered answers of earlier generations are stale
+        self.hits = self.misses = self.expired = self.evicted = self.uncacheable = 0
+        self.log_interval = log_interval
+        self.last_logged = time.monotonic()
+
+    @staticmethod
+    def key(q: dns.message.Message, payload: Optional[int] = None) -> Optional[CacheKey]:
+        if len(q.question) != 1:
+            return None
+        question = q.question[0]
+        return CacheKey(question.name.to_text().lower(), question.rdtype, question.rdclass, q.edns,
+                        bool(q.ednsflags & dns.flags.DO), bool(q.flags & dns.flags.CD), payload)
+
+    def get(self, key: CacheKey) -> Optional[CacheEntry]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.expires <= time.monotonic():
+                self.remove(key)
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+        self.maybe_log()
+        return entry
+
+    def put(self, key: CacheKey, query: bytes, upstream: bytes) -> Optional[CacheEntry]:
+        """Caches the upstream answer to query if it is cacheable; returns its entry."""
+        flags = struct.unpack_from('!H', upstream, 2)[0] if len(upstream) >= 12 else dns.flags.TC
+        ttl = min_ttl(upstream)
+        end = question_end(query)
+        if flags & dns.flags.TC or flags & 0xf not in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN) or ttl is None or \
+                upstream[4:6] != b'\x00\x01' or upstream[12:end].lower() != query[12:end].lower():
+            self.uncacheable += 1
+            return None
+        ttl = min(max(ttl, self.ttl_floor), self.ttl_max)
+        if ttl <= 0:
+            self.uncacheable += 1
+            return None
+        entry = CacheEntry(upstream, time.monotonic() + ttl)
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = entry
+            self.bytes += entry.size()
+            self.evict()
+        return entry
+
+    def filtered(self, entry: CacheEntry) -> Optional[Tuple[bytes, Optional[int]]]:
+        """The filtered answer of the entry, unless it is stale."""
+        filtered = entry.filtered
+        return filtered if filtered is not None and entry.generation == self.generation else None
+
+    def set_filtered(self, key: CacheKey, entry: CacheEntry, final_answer: bytes,
+                     first_changed_byte: Optional[int]) -> None:
+        with self.lock:
+            if self.filtered(entry) is not None:
+                return
+            cached = self.entries.get(key) is entry
+            if cached and entry.filtered is not None:
+                self.bytes -= len(entry.filtered[0])
+            entry.filtered, entry.generation = (final_answer, first_changed_byte), self.generation
+            if cached:
+                self.bytes += len(final_answer)
+                self.evict()
+
+    def forget_filtered(self) -> None:
+        """
+        Makes the filtered answers stale, e.g. after the filter settings changed; upstream answers stay cached. Stale
+        answers are replaced when their entry is filtered again. Safe in a signal handler: the lock is not taken.
+        """
+        self.generation += 1
+
+    def remove(self, key: CacheKey) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size()
+
+    def evict(self) -> None:
+        while self.bytes > self.max_bytes and self.entries:
+            key = next(iter(self.entries))
+            self.remove(key)
+            self.evicted += 1
+
+    def maybe_log(self) -> None:
+        now = time.monotonic()
+        if self.log_interval and now - self.last_logged >= self.log_interval:
+            self.last_logged = now
+            logger.warning(f"response cache stats: entries={len(self.entries)}, bytes={self.bytes}, "
+                           f"hits={self.hits}, misses={self.misses}, expired={self.expired}, "
+                           f"evicted={self.evicted}, uncacheable={self.uncacheable}")
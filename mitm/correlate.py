@@ -0,0 +1,419 @@
+"""
+Streaming join of the web server log of the adnet study with the request log of the mitm proxy: for every name a
+resolver looked up for a test, whether the browser then loaded it.
+
+The test page (adnet-study/testscript.js) loads https://<token>-<test>.<study domain>/img.png for every test name,
+e.g. mitm-ra.ds8-dnskey8, with a token per browser session, so the name the browser's resolver looks up (the qname in
+the request log) is the host it then requests (host_header in the JSON access log written in the downg2 format, see
+adnet-study/genvhost.py). Both logs are read incrementally, the access log line by line (following it as it grows and
+across rotation with --follow), the request log segment by segment by id (including the segments begun later), always
+from the one that is behind in time, and the lookups and requests are collected in a session per (token, test).
+
+A session is emitted as one JSON line when the watermark, the earliest time up to which both logs are assumed to be
+complete, passes its first lookup (or request) by --window seconds: the browser had that long to load the name. The
+watermark of a log trails the latest time read from it by its lateness (--dns-lateness: rows are written in batches
+by several workers; --http-lateness: Apache logs a request when it is done); with --follow, a log that has been idle
+for --idle seconds is assumed complete up to the current time minus its lateness. Lookups and requests that arrive
+after their session would have been emitted are counted as late and dropped, so the memory used is bounded by the
+sessions begun within --window plus the lateness, not by the length of the campaign.
+
+    python3 correlate.py /var/log/apache2/access-downg.json /data [--follow] [--out joined.jsonl]
+
+Each line has the token and the test (split into the instructions and the zone), the lookups (count, first and last
+time, resolver addresses and qtypes), and whether the name was loaded (with the time, client, status and delay of
+the first request). Names outside the --study-domains and names without a token (e.g. of resolvers that minimize
+query names) are skipped.
+"""
+import argparse
+import heapq
+import json
+import logging
+import math
+import os
+import re
+import sqlite3
+import sys
+import time
+import urllib.parse
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from replay import timestamp
+from requestlog import LOG_DB_TABLE_NAME, SEGMENT_SLACK, list_segments
+
+logger = logging.getLogger(__name__)
+
+STUDY_DOMAINS = ["downgrade.dedyn.io", "resolver-downgrade-attack.dedyn.io"]
+TOKEN_PATTERN = re.compile(r'^(adn|ses)?[0-9]+$')  # e.g. adn3698285940 (ses... and plain numbers in older sessions)
+CHUNK_SIZE = 1000
+STATS_INTERVAL = 60  # seconds between logged statistics
+
+Key = Tuple[str, str]  # (token, test)
+
+
+class Lookup(NamedTuple):
+    time: float
+    key: Key
+    host: str
+    qtype: str
+
+
+class Request(NamedTuple):
+    time: float
+    key: Key
+    client: str
+    status: Optional[int]
+    path: str
+
+
+def split_name(name: str, study_domains: Iterable[str]) -> Optional[Key]:
+    """(token, test) of a name <token>-<test>.<study domain>, None for other names."""
+    name = name.lower().partition(':')[0].rstrip('.')  # a Host header may have a port
+    for domain in study_domains:
+        if name.endswith('.' + domain):
+            first, _, rest = name[:-len(domain) - 1].partition('.')
+            token, _, test = first.partition('-')
+            if test and TOKEN_PATTERN.match(token):
+                return token, f"{test}.{rest}" if rest else test
+            return None
+    return None
+
+
+class Source:
+    """A log read in chunks, with the watermark up to which it is assumed to be complete."""
+
+    def __init__(self, lateness: float, follow: bool, idle: float) -> None:
+        self.lateness = lateness
+        self.follow = follow
+        self.idle = idle
+        self.latest = -math.inf  # latest time read
+        self.progressed = False  # whether the last read moved on, even if everything it read was skipped
+        self.last_data = time.monotonic()
+        self.exhausted = False  # without --follow, once everything is read
+        self.skipped = 0
+
+    def watermark(self) -> float:
+        if self.exhausted:
+            return math.inf
+        watermark = self.latest - self.lateness
+        if self.follow and time.monotonic() - self.last_data > self.idle:
+            watermark = max(watermark, time.time() - self.lateness)
+        return watermark
+
+    def poll(self, limit: int) -> list:
+        self.progressed = False
+        events = self.read(limit)
+        if events:
+            self.latest = max(self.latest, max(event.time for event in events))
+            self.progressed = True
+        if self.progressed:
+            self.last_data = time.monotonic()
+        return events
+
+    def read(self, limit: int) -> list:
+        raise NotImplementedError
+
+
+class AccessLog(Source):
+    """The JSON lines of an Apache log in the downg2 format, followed across rotation (by rename or truncation)."""
+
+    def __init__(self, path: str, study_domains: List[str], lateness: float, follow: bool, idle: float) -> None:
+        super().__init__(lateness, follow, idle)
+        self.path = path
+        self.study_domains = study_domains
+        self.file = None
+        self.inode = None
+        self.partial = b''
+        self.malformed = 0
+
+    def open(self) -> bool:
+        try:
+            self.file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return False
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        self.partial = b''
+        return True
+
+    def rotated(self) -> bool:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return stat.st_ino != self.inode or stat.st_size < self.file.tell()
+
+    def read(self, limit: int) -> List[Request]:
+        if self.file is None and not self.open():
+            self.exhausted = not self.follow
+            return []
+        requests = []
+        lines = 0
+        while lines < limit:
+            line = self.file.readline()
+            if not line:
+                break
+            if not line.endswith(b'\n'):  # a line still being written
+                self.partial += line
+                continue
+            line, self.partial = self.partial + line, b''
+            lines += 1
+            self.progressed = True
+            request = self.parse(line)
+            if request is not None:
+                requests.append(request)
+        if lines == 0:
+            if not self.follow:
+                if self.partial:  # the last line, without a newline
+                    request = self.parse(self.partial)
+                    self.partial = b''
+                    if request is not None:
+                        requests.append(request)
+                self.exhausted = True
+            elif self.rotated():  # the old file is read to its end, continue with the new one
+                logger.info(f"{self.path} was rotated, reopening it")
+                self.file.close()
+                self.open()
+        return requests
+
+    def parse(self, line: bytes) -> Optional[Request]:
+        try:
+            fields = json.loads(line)
+            t = int(fields['time_epoch']) / 1000
+        except (ValueError, KeyError, TypeError):  # Apache escapes bytes as \xhh, which is not JSON
+            self.malformed += 1
+            return None
+        key = split_name(fields.get('host_header', ''), self.study_domains)
+        if key is None:
+            params = dict(urllib.parse.parse_qsl(fields.get('query', '').lstrip('?')))
+            if 'tok' in params and 'test' in params:
+                key = params['tok'], params['test'].lower()
+        if key is None:
+            self.skipped += 1
+            return None
+        try:
+            status = int(fields.get('status'))
+        except (TypeError, ValueError):
+            status = None
+        return Request(t, key, fields.get('ip_client', ''), status, fields.get('url_path', ''))
+
+
+class RequestLogSource(Source):
+    """The rows of the request log segments in a directory for names of the study domains, by id."""
+
+    def __init__(self, directory: str, study_domains: List[str], lateness: float, follow: bool, idle: float,
+                 start: Optional[float] = None) -> None:
+        super().__init__(lateness, follow, idle)
+        self.directory = directory
+        self.study_domains = study_domains
+        self.start = start
+        self.positions: Dict[str, int] = {}  # last id read per segment
+        self.done: Set[str] = set()
+        self.connections: Dict[str, sqlite3.Connection] = {}
+        self.where = " OR ".join(["qname LIKE ?"] * len(study_domains))
+        self.params = tuple(f"%.{domain}." for domain in study_domains)
+
+    def query(self, path: str, limit: int) -> List[tuple]:
+        con = self.connections.get(path)
+        if con is None:
+            con = self.connections[path] = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        return con.execute(
+            f"SELECT id, timestamp, host, qname, qtype FROM {LOG_DB_TABLE_NAME} "
+            f"WHERE id > ? AND timestamp >= ? AND ({self.where}) ORDER BY id LIMIT ?",
+            (self.positions.get(path, 0), self.start or 0, *self.params, limit)).fetchall()
+
+    def finish(self, path: str) -> None:
+        self.done.add(path)
+        con = self.connections.pop(path, None)
+        if con is not None:
+            con.close()
+
+    def read(self, limit: int) -> List[Lookup]:
+        segments = [(start, path) for start, path in list_segments(self.directory) if path not in self.done]
+        if self.start is not None:  # segments that ended before start (see requestlog.select_segments)
+            for (_, path), (next_start, _) in zip(segments, segments[1:]):
+                if next_start + SEGMENT_SLACK <= self.start:
+                    self.finish(path)
+        for i, (_, path) in enumerate(segments):
+            if path in self.done:
+                continue
+            try:
+                rows = self.query(path, limit)
+            except sqlite3.DatabaseError as e:  # e.g. a segment just created, without the table yet
+                logger.debug(f"cannot read {path}: {e}")
+                rows = []
+            if rows:
+                self.positions[path] = rows[-1][0]
+                self.latest = max(self.latest, max(row[1] for row in rows))  # also if all of them are skipped
+                self.progressed = True
+                lookups = []
+                for _, t, host, qname, qtype in rows:
+                    key = split_name(qname, self.study_domains)
+                    if key is None:
+                        self.skipped += 1
+                    else:
+                        lookups.append(Lookup(t, key, host, qtype))
+                return lookups
+            # read to the end; no more rows are written to it once the next segment is older than the slack
+            if i + 1 < len(segments) and (not self.follow or segments[i + 1][0] + SEGMENT_SLACK < time.time()):
+                self.finish(path)
+        if not self.follow and all(path in self.done for _, path in segments[:-1]):
+            self.exhausted = True
+            for path in list(self.connections):
+                self.finish(path)
+        return []
+
+
+class Session:
+    __slots__ = ('key', 'lookups', 'first_lookup', 'last_lookup', 'resolvers', 'qtypes', 'requests', 'first_request')
+
+    def __init__(self, key: Key) -> None:
+        self.key = key
+        self.lookups = 0
+        self.first_lookup = self.last_lookup = None
+        self.resolvers: Dict[str, int] = {}
+        self.qtypes: Set[str] = set()
+        self.requests = 0
+        self.first_request: Optional[Request] = None
+
+    def record(self) -> dict:
+        token, test = self.key
+        instructions, _, zone = test.rpartition('.')
+        request = self.first_request
+        return dict(
+            token=token, test=test, instructions=instructions, zone=zone,
+            lookups=self.lookups, first_lookup=self.first_lookup, last_lookup=self.last_lookup,
+            resolvers=sorted(self.resolvers, key=self.resolvers.get, reverse=True), qtypes=sorted(self.qtypes),
+            loaded=request is not None, requests=self.requests,
+            request_time=request and request.time, client=request and request.client,
+            status=request and request.status,
+            delay=request.time - self.first_lookup if request is not None and self.lookups else None,
+        )
+
+
+class Joiner:
+    """Collects lookups and requests per (token, test) and emits each session once the watermark passed its window."""
+
+    def __init__(self, window: float, out) -> None:
+        self.window = window
+        self.out = out
+        self.sessions: Dict[Key, Session] = {}
+        self.deadlines: List[Tuple[float, Key]] = []  # heap
+        self.watermark = -math.inf
+        self.stats = dict(lookups=0, requests=0, late_lookups=0, late_requests=0, sessions=0, loaded=0,
+                          not_loaded=0, requests_without_lookup=0, max_sessions=0)
+
+    def session(self, key: Key, t: float, kind: str) -> Optional[Session]:
+        session = self.sessions.get(key)
+        if session is None:
+            if t + self.window < self.watermark:  # its session would have been emitted already
+                self.stats[f'late_{kind}'] += 1
+                return None
+            session = self.sessions[key] = Session(key)
+            heapq.heappush(self.deadlines, (t + self.window, key))
+            self.stats['max_sessions'] = max(self.stats['max_sessions'], len(self.sessions))
+        return session
+
+    def lookup(self, lookup: Lookup) -> None:
+        self.stats['lookups'] += 1
+        session = self.session(lookup.key, lookup.time, 'lookups')
+        if session is None:
+            return
+        if not session.lookups:
+            session.first_lookup = session.last_lookup = lookup.time
+        session.lookups += 1
+        session.first_lookup = min(session.first_lookup, lookup.time)
+        session.last_lookup = max(session.last_lookup, lookup.time)
+        session.resolvers[lookup.host] = session.resolvers.get(lookup.host, 0) + 1
+        session.qtypes.add(lookup.qtype)
+
+    def request(self, request: Request) -> None:
+        self.stats['requests'] += 1
+        session = self.session(request.key, request.time, 'requests')
+        if session is None:
+            return
+        session.requests += 1
+        if session.first_request is None or request.time < session.first_request.time:
+            session.first_request = request
+
+    def advance(self, watermark: float) -> None:
+        self.watermark = max(self.watermark, watermark)
+        while self.deadlines and self.deadlines[0][0] <= self.watermark:
+            _, key = heapq.heappop(self.deadlines)
+            self.emit(self.sessions.pop(key))
+
+    def emit(self, session: Session) -> None:
+        record = session.record()
+        self.stats['sessions'] += 1
+        self.stats['loaded' if record['loaded'] else 'not_loaded'] += 1
+        if not session.lookups:
+            self.stats['requests_without_lookup'] += 1
+        self.out.write(json.dumps(record) + "\n")
+
+
+def run(access_log: AccessLog, request_log: RequestLogSource, joiner: Joiner, poll_interval: float = 1,
+        stats_interval: float = STATS_INTERVAL) -> None:
+    """Reads from the log that is behind until both are exhausted (never, when following them)."""
+    handlers = {id(access_log): joiner.request, id(request_log): joiner.lookup}
+    next_stats = time.monotonic() + stats_interval
+    while not (access_log.exhausted and request_log.exhausted):
+        progressed = False
+        for source in sorted((access_log, request_log), key=lambda s: math.inf if s.exhausted else s.latest):
+            if source.exhausted:
+                continue
+            events = source.poll(CHUNK_SIZE)
+            handler = handlers[id(source)]
+            for event in events:
+                handler(event)
+            if source.progressed:
+                progressed = True
+                break  # which of them is behind now?
+        joiner.advance(min(access_log.watermark(), request_log.watermark()))
+        if time.monotonic() >= next_stats:
+            next_stats = time.monotonic() + stats_interval
+            log_stats(access_log, request_log, joiner)
+            joiner.out.flush()
+        if not progressed and not (access_log.exhausted and request_log.exhausted):
+            if not access_log.follow:
+                continue
+            time.sleep(poll_interval)
+    joiner.advance(math.inf)
+    log_stats(access_log, request_log, joiner)
+
+
+def log_stats(access_log: AccessLog, request_log: RequestLogSource, joiner: Joiner) -> None:
+    logger.info(f"{', '.join(f'{k}={v}' for k, v in joiner.stats.items())}, pending={len(joiner.sessions)}, "
+                f"watermark={joiner.watermark:.1f}, skipped requests={access_log.skipped}, malformed lines="
+                f"{access_log.malformed}, skipped lookups={request_log.skipped}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('access_log', help="JSON access log of the study's vhosts (downg2 format)")
+    parser.add_argument('log_dir', help="request log directory of the mitm proxy")
+    parser.add_argument('--out', help="JSON lines file to append the sessions to, default: stdout")
+    parser.add_argument('--study-domains', default=",".join(STUDY_DOMAINS))
+    parser.add_argument('--window', type=float, default=60, help="seconds the browser has to load a looked up name")
+    parser.add_argument('--dns-lateness', type=float, default=30, help="seconds request log rows may come late")
+    parser.add_argument('--http-lateness', type=float, default=10, help="seconds access log lines may come late")
+    parser.add_argument('--follow', action='store_true', help="keep following both logs as they grow")
+    parser.add_argument('--idle', type=float, default=30,
+                        help="with --follow, seconds after which a log without news is assumed complete up to now")
+    parser.add_argument('--start', type=timestamp, help="lookups from this time (timestamp or ISO format) on")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    study_domains = [domain.strip().lower().rstrip('.') for domain in args.study_domains.split(',') if domain]
+    access_log = AccessLog(args.access_log, study_domains, args.http_lateness, args.follow, args.idle)
+    request_log = RequestLogSource(args.log_dir, study_domains, args.dns_lateness, args.follow, args.idle, args.start)
+    out = open(args.out, 'a') if args.out else sys.stdout
+    try:
+        run(access_log, request_log, Joiner(args.window, out))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        out.flush()
+        if args.out:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Full text dumps of queries and answers, kept out of the logs: dumping every message costs more than forwarding it.
+
+A Dumper selects 1 in `sample` queries (0: none) plus all queries whose qname starts with one of `qname_prefixes`,
+and appends one JSON object per selected query to a JSON lines file. All worker processes append to the same file;
+each dump is written with a single write() on a file opened in append mode, so lines do not interleave.
+
+Once the file has `max_bytes` (0: no limit), it is renamed to <path>.1 (and <path>.1 to <path>.2 and so on, keeping
+`keep` of them) by the first process to notice, under a lock; the others notice that the file they write to is full
+and was rotated, and reopen <path>.
+"""
+import fcntl
+import itertools
+import json
+import logging
+import os
+import time
+from typing import Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Dumper:
+
+    def __init__(self, path: Optional[str], sample: int = 1000, qname_prefixes: Iterable[str] = (),
+                 max_bytes: int = 0, keep: int = 3) -> None:
+        self.path = path
+        self.sample = sample if path else 0
+        self.qname_prefixes = tuple(p.lower() for p in qname_prefixes if p) if path else ()
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.counter = itertools.count()
+        self.fd = None
+
+    @classmethod
+    def from_env(cls) -> 'Dumper':
+        return cls(
+            os.environ.get("ADNSSEC_DUMP_FILE", "/data/dumps.jsonl") or None,
+            sample=int(os.environ.get("ADNSSEC_DUMP_SAMPLE", 1000)),
+            qname_prefixes=os.environ.get("ADNSSEC_DUMP_QNAME_PREFIXES", "").split(","),
+            max_bytes=int(os.environ.get("ADNSSEC_DUMP_MAX_BYTES", 2 ** 30)),
+            keep=int(os.environ.get("ADNSSEC_DUMP_KEEP", 3)),
+        )
+
+    def wants(self, qname: str) -> bool:
+        """Decides whether the query for qname is dumped; cheap enough to be called for every query."""
+        if self.sample and next(self.counter) % self.sample == 0:
+            return True
+        return bool(self.qname_prefixes) and qname.lower().startswith(self.qname_prefixes)
+
+    def dump(self, **fields) -> None:
+        fields = {'time': time.time(), 'pid': os.getpid(), **fields}
+        try:
+            if self.fd is None:  # opened lazily, in the worker process
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            elif self.max_bytes and os.fstat(self.fd).st_size >= self.max_bytes:
+                self.rotate()
+            os.write(self.fd, (json.dumps(fields) + "\n").encode())
+        except OSError as e:
+            logger.warning("Failed to write dump to %s: %s", self.path, e)
+
+    def rotate(self) -> None:
+        """Rotates the file, unless another process did since this one opened it; then reopens it."""
+        with open(f"{self.path}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                current = os.stat(self.path).st_ino
+            except FileNotFoundError:
+                current = None
+            if current == os.fstat(self.fd).st_ino:
+                for i in range(self.keep - 1, 0, -1):
+                    if os.path.exists(f"{self.path}.{i}"):
+                        os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+                if self.keep:
+                    os.replace(self.path, f"{self.path}.1")
+                else:
+                    os.remove(self.path)
+                logger.info("Rotated dumps %s", self.path)
+            os.close(self.fd)
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
@@ -0,0 +1,205 @@
+"""
+Exports the request log (all segments in the log directory, see requestlog.py) to a columnar dataset for the analysis
+notebooks, decoding the logged queries once instead of on every notebook run.
+
+Rows are read in chunks and written as Parquet (or Arrow IPC/Feather) files, partitioned by the hour of the query:
+
+    <out>/day=2021-10-01/hour=14/part-<segment>-<first id>.parquet
+
+Besides the logged columns (without mdump, unless --with-mdump is given), each row carries the decoded query: the
+first label and the zone, the mitm instruction codes, the query ID, RD/CD/DO flags, EDNS version and payload size and
+the EDNS client subnet. The export is incremental: the highest exported id per segment is kept in
+<out>/_export_state.json, and re-running the export only processes newer rows.
+
+    python3 export.py [--log-dir /data] [--out /data/export] [--format parquet|feather]
+
+In the notebooks, the dataset is loaded with pd.read_parquet('<out>') (or pyarrow.dataset for Feather files).
+Requires pyarrow.
+"""
+import argparse
+import collections
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+from typing import Dict, Iterator, List, Optional
+
+import dns.edns
+import dns.flags
+import dns.message
+
+from requestlog import LOG_DB_TABLE_NAME, list_segments
+
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+STATE_FILE_NAME = "_export_state.json"  # files starting with _ are ignored when reading the dataset
+COLUMNS = "id, date, timestamp, host, port, qname, qtype, qclass, first_changed_byte, mdump"
+
+
+def schema(with_mdump: bool):
+    fields = [
+        ('segment', pyarrow.string()),
+        ('id', pyarrow.int64()),
+        ('date', pyarrow.string()),
+        ('timestamp', pyarrow.float64()),
+        ('host', pyarrow.string()),
+        ('port', pyarrow.int32()),
+        ('qname', pyarrow.string()),
+        ('qtype', pyarrow.string()),
+        ('qclass', pyarrow.string()),
+        ('first_changed_byte', pyarrow.int32()),
+        ('label', pyarrow.string()),
+        ('zone', pyarrow.string()),
+        ('instructions', pyarrow.list_(pyarrow.string())),
+        ('query_id', pyarrow.int32()),
+        ('rd', pyarrow.bool_()),
+        ('cd', pyarrow.bool_()),
+        ('do', pyarrow.bool_()),
+        ('edns', pyarrow.int16()),
+        ('payload', pyarrow.int32()),
+        ('client_subnet', pyarrow.string()),
+        ('parse_error', pyarrow.string()),
+    ]
+    if with_mdump:
+        fields.append(('mdump', pyarrow.binary()))
+    return pyarrow.schema(fields)
+
+
+def decode(qname: str, mdump: Optional[bytes]) -> dict:
+    """The fields of the query that the notebooks would otherwise extract with dnspython."""
+    label, _, zone = qname.partition('.')
+    label = label.lower()
+    fields = {
+        'label': label,
+        'zone': zone.lower(),
+        'instructions': label.split('-')[1:] if label.startswith('mitm') else [],
+        'query_id': None, 'rd': None, 'cd': None, 'do': None, 'edns': None, 'payload': None,
+        'client_subnet': None, 'parse_error': None,
+    }
+    if not mdump:
+        return fields
+    try:
+        q = dns.message.from_wire(mdump)
+    except Exception as e:
+        fields['parse_error'] = f"{type(e).__name__}: {e}"
+        return fields
+    fields.update(
+        query_id=q.id,
+        rd=bool(q.flags & dns.flags.RD),
+        cd=bool(q.flags & dns.flags.CD),
+        do=bool(q.ednsflags & dns.flags.DO),
+        edns=q.edns if q.edns >= 0 else None,
+        payload=q.payload if q.edns >= 0 else None,
+    )
+    for option in q.options:
+        if isinstance(option, dns.edns.ECSOption):
+            fields['client_subnet'] = f"{option.address}/{option.srclen}"
+    return fields
+
+
+def read_chunks(path: str, after_id: int, chunk_size: int) -> Iterator[List[tuple]]:
+    con = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        cursor = con.execute(f"SELECT {COLUMNS} FROM {LOG_DB_TABLE_NAME} WHERE id > ? ORDER BY id", (after_id,))
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        con.close()
+
+
+class Exporter:
+
+    def __init__(self, out: str, file_format: str = "parquet", with_mdump: bool = False) -> None:
+        self.out = out
+        self.file_format = file_format
+        self.with_mdump = with_mdump
+        self.schema = schema(with_mdump)
+        self.state_path = os.path.join(out, STATE_FILE_NAME)
+        self.state: Dict[str, int] = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+
+    def save_state(self) -> None:
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.state_path)
+
+    def export_segment(self, path: str, chunk_size: int) -> int:
+        segment = os.path.basename(path)
+        exported = 0
+        for rows in read_chunks(path, self.state.get(segment, 0), chunk_size):
+            partitions = collections.defaultdict(list)
+            for row_id, date, timestamp, host, port, qname, qtype, qclass, first_changed_byte, mdump in rows:
+                record = dict(
+                    segment=segment, id=row_id, date=date, timestamp=timestamp, host=host, port=port, qname=qname,
+                    qtype=qtype, qclass=qclass, first_changed_byte=first_changed_byte, **decode(qname, mdump),
+                )
+                if self.with_mdump:
+                    record['mdump'] = mdump
+                hour = datetime.datetime.fromtimestamp(timestamp)
+                partitions[hour.strftime("day=%Y-%m-%d"), hour.strftime("hour=%H")].append(record)
+            for (day, hour), records in sorted(partitions.items()):
+                self.write(os.path.join(self.out, day, hour), f"part-{segment[:-len('.sqlite3')]}-{records[0]['id']}",
+                           records)
+            # files are written before the state is advanced: an interrupted export at worst re-writes a chunk
+            self.state[segment] = rows[-1][0]
+            self.save_state()
+            exported += len(rows)
+        return exported
+
+    def write(self, directory: str, name: str, records: List[dict]) -> None:
+        os.makedirs(directory, exist_ok=True)
+        table = pyarrow.Table.from_pydict({field: [r[field] for r in records] for field in self.schema.names},
+                                          schema=self.schema)
+        if self.file_format == "parquet":
+            pyarrow.parquet.write_table(table, os.path.join(directory, name + ".parquet"), compression="zstd")
+        else:
+            pyarrow.feather.write_feather(table, os.path.join(directory, name + ".arrow"), compression="zstd")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--log-dir', default=os.environ.get("ADNSSEC_LOG_DIR", "/data"))
+    parser.add_argument('--out', default=None, help="output directory, default: <log dir>/export")
+    parser.add_argument('--format', choices=['parquet', 'feather'], default='parquet')
+    parser.add_argument('--chunk-size', type=int, default=50000, help="rows per read and (at most) per output file")
+    parser.add_argument('--with-mdump', action='store_true', help="also export the raw query bytes")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if pyarrow is None:
+        sys.exit("export.py requires pyarrow (pip install pyarrow)")
+
+    out = args.out or os.path.join(args.log_dir, "export")
+    os.makedirs(out, exist_ok=True)
+    exporter = Exporter(out, args.format, args.with_mdump)
+    start, total = time.perf_counter(), 0
+    for _, path in list_segments(args.log_dir):
+        try:
+            exported = exporter.export_segment(path, args.chunk_size)
+        except sqlite3.DatabaseError as e:
+            logger.warning(f"Skipping unreadable request log segment {path}: {e}")
+            continue
+        if exported:
+            logger.info(f"Exported {exported} rows from {os.path.basename(path)}")
+        total += exported
+    logger.info(f"Exported {total} new rows to {out} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
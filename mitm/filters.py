@@ -0,0 +1,269 @@
+"""
+Rewrite rules the mitm proxy applies to upstream answers.
+
+The rules are selected by the first label of the query name, e.g. mitm-rs16-rd: the label is split on '-' and each
+part is an instruction code followed by an optional argument. Labels are compiled once into an immutable Plan and
+cached, as study traffic reuses a small set of labels over and over.
+"""
+import functools
+import logging
+import os
+from typing import Any, Callable, List, NamedTuple, Optional, Tuple
+
+import dns.dnssec
+import dns.message
+import dns.rdtypes.ANY.DS
+import dns.rdtypes.ANY.RRSIG
+import dns.rdtypes.ANY.TXT
+import dns.rdtypes.IN.A
+import dns.rrset
+
+IN = dns.rdataclass.from_text("IN")
+TXT = dns.rdatatype.from_text("TXT")
+A = dns.rdatatype.from_text("A")
+RRSIG = dns.rdatatype.from_text("RRSIG")
+DS = dns.rdatatype.from_text("DS")
+
+IP_A_EVIL = os.environ.get('IP_A_EVIL', '127.6.6.6')
+PLAN_CACHE_SIZE = int(os.environ.get('ADNSSEC_PLAN_CACHE_SIZE', 1024))
+
+logger = logging.getLogger(__name__)
+
+
+class InstructionError(ValueError):
+    pass
+
+
+def replace_rrsig_algo(section: List, replace_with: int):
+    rrsigs = [rrset for rrset in section if rrset.rdtype == RRSIG]
+    for rrsig in rrsigs:
+        new_rrsig = dns.rrset.RRset(name=rrsig.name, rdclass=rrsig.rdclass, rdtype=rrsig.rdtype, covers=rrsig.covers)
+        section[section.index(rrsig)] = new_rrsig
+        for rr in rrsig:
+            new_rrsig.add(dns.rdtypes.ANY.RRSIG.RRSIG(
+                rdclass=rr.rdclass,
+                rdtype=rr.rdtype,
+                type_covered=rr.type_covered,
+                algorithm=replace_with,
+                labels=rr.labels,
+                original_ttl=rr.original_ttl,
+                expiration=rr.expiration,
+                inception=rr.inception,
+                key_tag=rr.key_tag,
+                signer=rr.signer,
+                signature=rr.signature,
+            ))
+
+
+def replace_a(section, *args):
+    a_rrsets = [rrset for rrset in section if rrset.rdtype == A]
+    for a in a_rrsets:
+        new_a = dns.rrset.RRset(name=a.name, rdclass=a.rdclass, rdtype=a.rdtype, covers=a.covers)
+        section[section.index(a)] = new_a
+        new_a.add(dns.rdtypes.IN.A.A(
+            rdclass=a[0].rdclass,
+            rdtype=a[0].rdtype,
+            address=IP_A_EVIL,
+        ))
+
+
+def replace_txt(section, *args):
+    txt_rrsets = [rrset for rrset in section if rrset.rdtype == TXT]
+    for txt_rrset in txt_rrsets:
+        new_txt = dns.rrset.RRset(name=txt_rrset.name, rdclass=txt_rrset.rdclass, rdtype=txt_rrset.rdtype, covers=txt_rrset.covers)
+        section[section.index(txt_rrset)] = new_txt
+        for txt in txt_rrset:
+            new_txt.add(dns.rdtypes.ANY.TXT.TXT(
+                rdclass=txt_rrset.rdclass,
+                rdtype=txt_rrset.rdtype,
+                strings=tuple((b"evil " * ((len(t) // 5) + 1))[:len(t)] for t in txt.strings),
+            ))
+
+
+def replace_ds(section, *args):
+    # replaces any DS RRset with values defined below
+    ds_rrsets = [rrset for rrset in section if rrset.rdtype == DS]
+    for ds_rrset in ds_rrsets:
+        new_ds = dns.rrset.RRset(name=ds_rrset.name, rdclass=ds_rrset.rdclass, rdtype=ds_rrset.rdtype, covers=ds_rrset.covers)
+        section[section.index(ds_rrset)] = new_ds
+        for key_tag, algorithm, digest_type, digest in [
+            (18351, 13, 2, bytes.fromhex("bd638ab1d0259d76c435acfeab0028adbd273a358d154549565812f333454303")),
+            (18351, 13, 4, bytes.fromhex("000c3f7da476c17bccff160f7536ba4df5980b030ff65cc8c64c82dadd561dfd5fdd6b253fdf20f9147bcb5d002eef07")),
+        ]:
+            new_ds.add(dns.rdtypes.ANY.DS.DS(
+                rdclass=ds_rrset.rdclass,
+                rdtype=ds_rrset.rdtype,
+                key_tag=key_tag,
+                algorithm=algorithm,
+                digest_type=digest_type,
+                digest=digest,
+            ))
+
+
+def drop_rrsigs(section, algorithm: dns.dnssec.Algorithm):
+    rrsigs = [rrset for rrset in section if rrset.rdtype == RRSIG]
+    for rrsig in rrsigs:
+        new_rrsig = dns.rrset.RRset(name=rrsig.name, rdclass=rrsig.rdclass, rdtype=rrsig.rdtype, covers=rrsig.covers)
+        for rr in rrsig:
+            if rr.algorithm != algorithm:
+                new_rrsig.add(dns.rdtypes.ANY.RRSIG.RRSIG(
+                    rdclass=rr.rdclass,
+                    rdtype=rr.rdtype,
+                    type_covered=rr.type_covered,
+                    algorithm=rr.algorithm,
+                    labels=rr.labels,
+                    original_ttl=rr.original_ttl,
+                    expiration=rr.expiration,
+                    inception=rr.inception,
+                    key_tag=rr.key_tag,
+                    signer=rr.signer,
+                    signature=rr.signature,
+                ))
+        if len(new_rrsig) > 0:
+            section[section.index(rrsig)] = new_rrsig
+        else:
+            section.remove(rrsig)
+
+
+def add_bogus_rrsig(section, algorithm: dns.dnssec.Algorithm):
+    rrsigs = [rrset for rrset in section if rrset.rdtype == RRSIG]
+    for rrsig in rrsigs:
+        new_rrsig = dns.rrset.RRset(name=rrsig.name, rdclass=rrsig.rdclass, rdtype=rrsig.rdtype, covers=rrsig.covers)
+        section[section.index(rrsig)] = new_rrsig
+        for rr in rrsig:
+            new_rrsig.add(dns.rdtypes.ANY.RRSIG.RRSIG(
+                rdclass=rr.rdclass,
+                rdtype=rr.rdtype,
+                type_covered=rr.type_covered,
+                algorithm=rr.algorithm,
+                labels=rr.labels,
+                original_ttl=rr.original_ttl,
+                expiration=rr.expiration,
+                inception=rr.inception,
+                key_tag=rr.key_tag,
+                signer=rr.signer,
+                signature=rr.signature,
+            ))
+        new_rrsig.add(dns.rdtypes.ANY.RRSIG.RRSIG(
+            rdclass=rr.rdclass,
+            rdtype=rr.rdtype,
+            type_covered=rr.type_covered,
+            algorithm=algorithm,
+            labels=rr.labels,
+            original_ttl=rr.original_ttl,
+            expiration=rr.expiration,
+            inception=rr.inception,
+            key_tag=rr.key_tag,
+            signer=rr.signer,
+            signature=b"\xff" * 24,
+        ))
+
+
+def add_bogus_txt(section, *args):
+    txts = [rrset for rrset in section if rrset.rdtype == TXT]
+    for txt in txts:
+        new_txt = dns.rrset.RRset(name=txt.name, rdclass=txt.rdclass, rdtype=txt.rdtype, covers=txt.covers)
+        section[section.index(txt)] = new_txt
+        for rr in txt:
+            new_txt.add(dns.rdtypes.ANY.TXT.TXT(
+                rdclass=rr.rdclass,
+                rdtype=rr.rdtype,
+                strings=rr.strings,
+            ))
+        new_txt.add(dns.rdtypes.ANY.TXT.TXT(
+            rdclass=rr.rdclass,
+            rdtype=rr.rdtype,
+            strings=(b"evil",),
+        ))
+
+
+def modify_signatures(section, *args):
+    rrsigs = [rrset for rrset in section if rrset.rdtype == RRSIG]
+    for rrsig in rrsigs:
+        new_rrsig = dns.rrset.RRset(name=rrsig.name, rdclass=rrsig.rdclass, rdtype=rrsig.rdtype, covers=rrsig.covers)
+        section[section.index(rrsig)] = new_rrsig
+        for rr in rrsig:
+            s = rr.signature
+            new_rrsig.add(dns.rdtypes.ANY.RRSIG.RRSIG(
+                rdclass=rr.rdclass,
+                rdtype=rr.rdtype,
+                type_covered=rr.type_covered,
+                algorithm=rr.algorithm,
+                labels=rr.labels,
+                original_ttl=rr.original_ttl,
+                expiration=rr.expiration,
+                inception=rr.inception,
+                key_tag=rr.key_tag,
+                signer=rr.signer,
+                signature=s[:-1] + bytes([s[-1] ^ 0x1]),  # flip last bit
+            ))
+
+
+def algorithm(arg: str) -> dns.dnssec.Algorithm:
+    return dns.dnssec.Algorithm(int(arg))
+
+
+# instruction code -> (rewrite function, argument parser); a rewrite function of None is a no-op
+INSTRUCTION_CODES = {
+    'rs': (replace_rrsig_algo, int),
+    'ra': (replace_a, None),
+    'rt': (replace_txt, None),
+    'rd': (replace_ds, None),
+    'ds': (drop_rrsigs, algorithm),
+    'as': (add_bogus_rrsig, algorithm),
+    'at': (add_bogus_txt, None),
+    'ms': (modify_signatures, None),
+    'mitm': (None, None),
+}
+ACTION_CODES = {action: code for code, (action, _) in INSTRUCTION_CODES.items() if action is not None}
+
+
+class Plan(NamedTuple):
+    label: str
+    actions: Tuple[Tuple[Callable[[List, Any], None], Any], ...]
+    unknown: Tuple[str, ...]
+
+    def apply(self, a: dns.message.Message) -> None:
+        for section in (a.answer, a.authority, a.additional):
+            for action, arg in self.actions:
+                action(section, arg)
+
+
+@functools.lru_cache(maxsize=PLAN_CACHE_SIZE)
+def compile_plan(label: str) -> Plan:
+    """
+    Compiles a lowercase first label into a Plan. Raises InstructionError if an instruction has a malformed
+    argument; parts that match no instruction code are collected in Plan.unknown.
+    """
+    actions, unknown = [], []
+    for instruction in label.split('-'):
+        for code, (action, parse) in INSTRUCTION_CODES.items():
+            if instruction.startswith(code):
+                break
+        else:
+            unknown.append(instruction)
+            continue
+        if action is None:
+            continue
+        arg = instruction[len(code):]
+        try:
+            arg = parse(arg) if parse else None
+        except ValueError as e:
+            raise InstructionError(f"Malformed instruction {instruction!r} in {label!r}: {e}") from e
+        actions.append((action, arg))
+    if unknown:
+        logger.warning(f"Unknown instruction code(s) {', '.join(unknown)} in {label!r}")
+    return Plan(label, tuple(actions), tuple(unknown))
+
+
+def get_plan(a: dns.message.Message) -> Optional[Plan]:
+    qname = a.question[0].name
+    if not qname[0].lower().startswith(b'mitm'):
+        return None
+    return compile_plan(qname[0].decode().lower())
+
+
+def filter_response(a: dns.message.Message) -> None:
+    plan = get_plan(a)
+    if plan is not None:
+        plan.apply(a)
@@ -0,0 +1,304 @@
+"""
+Metrics of the mitm proxy in the Prometheus text exposition format.
+
+Every process (the workers and the SqliteLogger) records counters and histograms in its own REGISTRY: plain
+increments of Python numbers, no locks or shared memory on the query path (as with UpstreamStats, increments from
+several threads may rarely be lost). REPORTER sends snapshots of the cumulative values through a bounded queue to the
+MetricsServer process, at most every ADNSSEC_METRICS_INTERVAL seconds; call maybe_report() periodically. The server
+keeps the latest snapshot per process (pid and start time, as pids are reused) and serves their sum on
+http://ADNSSEC_METRICS_HOST:ADNSSEC_METRICS_PORT/metrics. The last snapshot of a process that exited (its pid is reused,
+or it is gone and has not reported for RETIRE_AFTER seconds) is added to a retired total that stays in the sum, so
+counters do not go backwards when workers are replaced; snapshots that arrive from it later are dropped.
+"""
+import bisect
+import http.server
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from multiprocessing import Process
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = os.environ.get('ADNSSEC_METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('ADNSSEC_METRICS_PORT', 0))  # 0: no metrics server
+METRICS_INTERVAL = float(os.environ.get('ADNSSEC_METRICS_INTERVAL', 1))  # seconds between snapshots of a process
+RETIRE_AFTER = 10  # seconds without snapshots after which the process of an exited pid is retired
+
+LATENCY_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self) -> None:
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def snapshot(self) -> float:
+        return self.value
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # per bucket, not cumulative; the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def snapshot(self) -> Tuple[Tuple[int, ...], float]:
+        return tuple(self.counts), self.sum
+
+
+class Metric:
+    """A counter or histogram with a child per combination of label values."""
+
+    def __init__(self, kind: str, name: str, help: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.children: Dict[tuple, object] = {}
+
+    def labels(self, *values: str):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = Counter() if self.kind == 'counter' else Histogram(self.buckets)
+        return child
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+
+Snapshot = Dict[str, tuple]  # name -> (kind, help, labelnames, buckets, {label values: value})
+
+
+class Registry:
+
+    def __init__(self) -> None:
+        self.metrics: Dict[str, Metric] = {}
+        self.functions: List[Tuple[Metric, Callable[[], Dict[str, float]]]] = []
+
+    def add(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"metric {metric.name} already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Metric:
+        return self.add(Metric('counter', name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Metric:
+        return self.add(Metric('histogram', name, help, labelnames, buckets))
+
+    def counter_function(self, name: str, help: str, labelname: str, function: Callable[[], Dict[str, float]]) -> None:
+        """A counter with one label whose values are read from function() when a snapshot is taken."""
+        self.functions.append((self.add(Metric('counter', name, help, (labelname,))), function))
+
+    def snapshot(self) -> Snapshot:
+        for metric, function in self.functions:
+            for value, count in function().items():
+                metric.labels(value).value = count
+        return {
+            name: (metric.kind, metric.help, metric.labelnames, metric.buckets,
+                   {labels: child.snapshot() for labels, child in list(metric.children.items())})
+            for name, metric in self.metrics.items() if metric.children
+        }
+
+
+class Reporter:
+
+    def __init__(self, registry: Registry, snapshots: Optional[multiprocessing.Queue], interval: float = 1) -> None:
+        self.registry = registry
+        self.snapshots = snapshots
+        self.interval = interval
+        self.next_report = 0.0
+        self.pid, self.started = None, None  # of the process reporting, set again in a forked child
+
+    def maybe_report(self) -> None:
+        if self.snapshots is not None and time.monotonic() >= self.next_report:
+            self.report()
+
+    def report(self) -> None:
+        if self.snapshots is None:
+            return
+        self.next_report = time.monotonic() + self.interval
+        if self.pid != os.getpid():
+            self.pid, self.started = os.getpid(), time.time()
+        try:
+            self.snapshots.put((self.pid, self.started, self.registry.snapshot()), block=False)
+        except queue.Full:
+            logger.debug("metrics queue full, skipping snapshot")
+
+
+REGISTRY = Registry()
+REPORTER = Reporter(REGISTRY, multiprocessing.Queue(maxsize=1024) if METRICS_PORT else None, METRICS_INTERVAL)
+
+
+def merge(snapshots: List[Snapshot]) -> Snapshot:
+    merged: Snapshot = {}
+    for snapshot in snapshots:
+        for name, (kind, help, labelnames, buckets, values) in snapshot.items():
+            total = merged.setdefault(name, (kind, help, labelnames, buckets, {}))[4]
+            for labels, value in values.items():
+                if labels not in total:
+                    total[labels] = value
+                elif kind == 'counter':
+                    total[labels] += value
+                else:
+                    counts, sum_ = total[labels]
+                    total[labels] = tuple(a + b for a, b in zip(counts, value[0])), sum_ + value[1]
+    return merged
+
+
+def escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def label_text(labelnames: Tuple[str, ...], values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(labelnames, values)] + ([extra] if extra else [])
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def render(snapshot: Snapshot, gauges: Dict[str, Tuple[str, float]] = None) -> str:
+    lines = []
+    for name, (kind, help, labelnames, buckets, values) in sorted(snapshot.items()):
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+        for labels, value in sorted(values.items()):
+            if kind == 'counter':
+                lines.append(f"{name}{label_text(labelnames, labels)} {number(value)}")
+                continue
+            counts, sum_ = value
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ['+Inf'], counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{name}_bucket{label_text(labelnames, labels, le)} {cumulative}")
+            lines.append(f"{name}_sum{label_text(labelnames, labels)} {number(sum_)}")
+            lines.append(f"{name}_count{label_text(labelnames, labels)} {cumulative}")
+    for name, (help, value) in sorted((gauges or {}).items()):
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name} {number(value)}"]
+    return "\n".join(lines) + "\n"
+
+
+def alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class MetricsServer(Process):
+    """
+    Collects the snapshots of all processes from the queue and serves their sum over HTTP, together with gauges of the
+    request log: batches waiting in its queue and records dropped. A None on the queue stops the server.
+    """
+
+    def __init__(self, snapshots: multiprocessing.Queue, host: str = METRICS_HOST, port: int = METRICS_PORT,
+                 log_queue: multiprocessing.Queue = None, dropped: multiprocessing.Value = None) -> None:
+        super(MetricsServer, self).__init__()
+        self.snapshots = snapshots
+        self.host = host
+        self.port = port
+        self.log_queue = log_queue
+        self.dropped = dropped
+        self.latest: Dict[Tuple[int, float], Tuple[float, Snapshot]] = {}  # (pid, start) -> (received, snapshot)
+        self.retired: Snapshot = {}  # sum of the last snapshots of processes that exited
+        self.retired_processes: Set[Tuple[int, float]] = set()
+        self.lock = threading.Lock()
+
+    def gauges(self) -> Iterator[Tuple[str, Tuple[str, float]]]:
+        yield 'mitm_metrics_processes', ("Processes that reported metrics", len(self.latest))
+        if self.log_queue is not None:
+            try:
+                yield 'mitm_request_log_queue_batches', ("Batches in the request log queue", self.log_queue.qsize())
+            except NotImplementedError:  # macOS
+                pass
+        if self.dropped is not None:
+            yield 'mitm_request_log_dropped_records', ("Records dropped as the request log queue was full",
+                                                       self.dropped.value)
+
+    def exposition(self) -> str:
+        with self.lock:
+            snapshots = [self.retired] + [snapshot for _, snapshot in self.latest.values()]
+        return render(merge(snapshots), dict(self.gauges()))
+
+    def receive(self, pid: int, started: float, snapshot: Snapshot) -> None:
+        with self.lock:
+            if (pid, started) in self.retired_processes:
+                return
+            for process in [process for process in self.latest if process[0] == pid and process[1] != started]:
+                self.retire(process)  # the pid was reused
+            self.latest[pid, started] = time.monotonic(), snapshot
+
+    def retire_exited(self) -> None:
+        now = time.monotonic()
+        with self.lock:
+            for process, (received, _) in list(self.latest.items()):
+                if now - received > RETIRE_AFTER and not alive(process[0]):
+                    self.retire(process)
+
+    def retire(self, process: Tuple[int, float]) -> None:
+        _, snapshot = self.latest.pop(process)
+        self.retired = merge([self.retired, snapshot])
+        self.retired_processes.add(process)
+
+    def run(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = server.exposition().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f"metrics request from {self.client_address[0]}: {format % args}")
+
+        httpd = http.server.ThreadingHTTPServer((self.host, self.port), Handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        logger.warning(f"MetricsServer: serving metrics on http://{self.host}:{self.port}/metrics")
+        next_check = 0.0
+        while True:
+            try:
+                item = self.snapshots.get(timeout=RETIRE_AFTER / 2)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                self.receive(*item)
+            if time.monotonic() >= next_check:
+                next_check = time.monotonic() + RETIRE_AFTER / 2
+                self.retire_exited()
+        httpd.shutdown()
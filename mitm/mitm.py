@@ -1,326 +1,403 @@
-import datetime
+import asyncio
+import base64
+import collections
+import concurrent.futures
 import logging
 import multiprocessing
 import os
+import signal
 import socket
 import socketserver
-import sqlite3
 import struct
+import threading
 import time
 import traceback
-from multiprocessing import Manager, Process
-from typing import Optional, List
+from typing import Optional, Tuple
 
 import dns.dnssec
 import dns.message
-import dns.query
-import dns.rdtypes.ANY
-import dns.rrset
 
-HOST, PORT = "0.0.0.0", 53
+import filters
+import wire
+from cache import CacheEntry, CacheKey, ResponseCache, patch
+from dumps import Dumper
+from filters import ACTION_CODES, InstructionError, filter_response, get_plan
+from metrics import METRICS_PORT, REGISTRY, REPORTER, MetricsServer
+from requestlog import Record, RequestLog, SqliteLogger
+from supervisor import Supervisor, load_config
+from upstream import AsyncUpstreamPool, UpstreamError, UpstreamPool, UpstreamStats, is_truncated
+
+HOST, PORT = os.environ.get("ADNSSEC_HOST", "0.0.0.0"), int(os.environ.get("ADNSSEC_PORT", 53))
+SERVE_MODE = os.environ.get("ADNSSEC_SERVE_MODE", "fork")
+CONFIG_PATH = os.environ.get("ADNSSEC_CONFIG")  # KEY=VALUE lines read on start and SIGHUP, see supervisor.py
+PIN_CPUS = os.environ.get("ADNSSEC_PIN_CPUS", "1") not in ("", "0")
+DRAIN_TIMEOUT = float(os.environ.get("ADNSSEC_DRAIN_TIMEOUT", 10))  # seconds to answer queries in flight on SIGTERM
 BE_EVIL = bool(os.environ.get("BE_EVIL", False))
-LOG_DB_NAME = f'/data/requests_{datetime.datetime.now().isoformat()}.sqlite3'.replace(":", "_")
-
-MANAGER = Manager()
-REQUESTS_QUEUE = MANAGER.Queue()
-LOG_DB_TABLE_NAME = "requests"
-SQL_INIT_STMT = (
-    f"CREATE TABLE IF NOT EXISTS {LOG_DB_TABLE_NAME} ("
-    f"id integer PRIMARY KEY, "
-    f"date text NOT NULL, "
-    f"timestamp real NOT NULL, "
-    f"host text NOT NULL, "
-    f"port integer NOT NULL, "
-    f"qname text NOT NULL, "
-    f"qtype text NOT NULL, "
-    f"qclass text NOT NULL, "
-    f"first_changed_byte integer NULL, "
-    f"mdump blob"
-    f");"
-)
-SQL_INSERT_STMT = (
-    f'INSERT INTO {LOG_DB_TABLE_NAME} (date, timestamp, host, port, qname, qtype, qclass, first_changed_byte, mdump) '
-    f'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);'
+LOG_DB_DIR = os.environ.get("ADNSSEC_LOG_DIR", "/data")  # one requests_<start time>.sqlite3 segment per hour
+
+REQUESTS_QUEUE = multiprocessing.Queue(maxsize=int(os.environ.get("ADNSSEC_LOG_QUEUE_SIZE", 1024)))  # in batches
+DROPPED_RECORDS = multiprocessing.Value('Q', 0)
+REQUEST_LOG = RequestLog(
+    REQUESTS_QUEUE, DROPPED_RECORDS,
+    batch_size=int(os.environ.get("ADNSSEC_LOG_BATCH_SIZE", 64)),
+    flush_interval=float(os.environ.get("ADNSSEC_LOG_FLUSH_INTERVAL", .5)),
+    policy=os.environ.get("ADNSSEC_LOG_QUEUE_POLICY", "drop"),
 )
 
-IN = dns.rdataclass.from_text("IN")
-TXT = dns.rdatatype.from_text("TXT")
-A = dns.rdatatype.from_text("A")
-RRSIG = dns.rdatatype.from_text("RRSIG")
-DS = dns.rdatatype.from_text("DS")
 
-logging.basicConfig(level=logging.DEBUG)
+def configure_logging() -> None:
+    # ADNSSEC_LOG_LEVEL sets the root level, ADNSSEC_LOG_LEVELS overrides it per logger, e.g. "upstream=INFO,wire=DEBUG"
+    # (DEBUG logs every query and answer, for investigations; see also ADNSSEC_DUMP_SAMPLE in dumps.py)
+    logging.getLogger().setLevel(os.environ.get("ADNSSEC_LOG_LEVEL", "INFO").upper())
+    for name, _, level in (item.partition("=") for item in os.environ.get("ADNSSEC_LOG_LEVELS", "").split(",") if item):
+        logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+
+logging.basicConfig()
+configure_logging()
 logger = logging.getLogger(__name__)
+DUMPER = Dumper.from_env()  # text dumps of sampled queries and answers, see dumps.py
 
 auth_ns_addr = socket.gethostbyname(os.environ.get('AUTH_NS_HOST', 'ns'))
 auth_ns_port = int(os.environ.get('AUTH_NS_PORT', 53))
-IP_A_EVIL = os.environ.get('IP_A_EVIL', '127.6.6.6')
-
-
-def indent(s, l=4):
-    return " " * l + s.replace("\n", "\n" + " " * l)
-
-
-def filter_response(a: dns.message.QueryMessage):
-    qname = a.question[0].name
-    if not qname[0].lower().startswith(b'mitm'):
-        return
-
-    def replace_rrsig_algo(section: List, replace_with):
-        replace_with = int(replace_with)
-        rrsigs = [rrset for rrset in section if rrset.rdtype == RRSIG]
-        for rrsig in rrsigs:
-            new_rrsig = dns.rrset.RRset(name=rrsig.name, rdclass=rrsig.rdclass, rdtype=rrsig.rdtype, covers=rrsig.covers)
-            section[section.index(rrsig)] = new_rrsig
-            for rr in rrsig:
-                new_rrsig.add(dns.rdtypes.ANY.RRSIG.RRSIG(
-                    rdclass=rr.rdclass,
-                    rdtype=rr.rdtype,
-                    type_covered=rr.type_covered,
-                    algorithm=replace_with,
-                    labels=rr.labels,
-                    original_ttl=rr.original_ttl,
-                    expiration=rr.expiration,
-                    inception=rr.inception,
-                    key_tag=rr.key_tag,
-                    signer=rr.signer,
-                    signature=rr.signature,
-                ))
-
-    def replace_a(section, *args):
-        a_rrsets = [rrset for rrset in section if rrset.rdtype == A]
-        for a in a_rrsets:
-            new_a = dns.rrset.RRset(name=a.name, rdclass=a.rdclass, rdtype=a.rdtype, covers=a.covers)
-            section[section.index(a)] = new_a
-            new_a.add(dns.rdtypes.IN.A.A(
-                rdclass=a[0].rdclass,
-                rdtype=a[0].rdtype,
-                address=IP_A_EVIL,
-            ))
-
-    def replace_txt(section, *args):
-        txt_rrsets = [rrset for rrset in section if rrset.rdtype == TXT]
-        for txt_rrset in txt_rrsets:
-            new_txt = dns.rrset.RRset(name=txt_rrset.name, rdclass=txt_rrset.rdclass, rdtype=txt_rrset.rdtype, covers=txt_rrset.covers)
-            section[section.index(txt_rrset)] = new_txt
-            for txt in txt_rrset:
-                new_txt.add(dns.rdtypes.ANY.TXT.TXT(
-                    rdclass=txt_rrset.rdclass,
-                    rdtype=txt_rrset.rdtype,
-                    strings=tuple((b"evil " * ((len(t) // 5) + 1))[:len(t)] for t in txt.strings),
-                ))
-
-    def replace_ds(section, *args):
-        # replaces any DS RRset with values defined below
-        ds_rrsets = [rrset for rrset in section if rrset.rdtype == DS]
-        for ds_rrset in ds_rrsets:
-            new_ds = dns.rrset.RRset(name=ds_rrset.name, rdclass=ds_rrset.rdclass, rdtype=ds_rrset.rdtype, covers=ds_rrset.covers)
-            section[section.index(ds_rrset)] = new_ds
-            for key_tag, algorithm, digest_type, digest in [
-                (18351, 13, 2, bytes.fromhex("bd638ab1d0259d76c435acfeab0028adbd273a358d154549565812f333454303")),
-                (18351, 13, 4, bytes.fromhex("000c3f7da476c17bccff160f7536ba4df5980b030ff65cc8c64c82dadd561dfd5fdd6b253fdf20f9147bcb5d002eef07")),
-            ]:
-                new_ds.add(dns.rdtypes.ANY.DS.DS(
-                    rdclass=ds_rrset.rdclass,
-                    rdtype=ds_rrset.rdtype,
-                    key_tag=key_tag,
-                    algorithm=algorithm,
-                    digest_type=digest_type,
-                    digest=digest,
-                ))
-
-    def drop_rrsigs(section, algorithm):
-        algorithm = dns.dnssec.Algorithm(int(algorithm))
-        rrsigs = [rrset for rrset in section if rrset.rdtype == RRSIG]
-        for rrsig in rrsigs:
-            new_rrsig = dns.rrset.RRset(name=rrsig.name, rdclass=rrsig.rdclass, rdtype=rrsig.rdtype, covers=rrsig.covers)
-            for rr in rrsig:
-                if rr.algorithm != algorithm:
-                    new_rrsig.add(dns.rdtypes.ANY.RRSIG.RRSIG(
-                        rdclass=rr.rdclass,
-                        rdtype=rr.rdtype,
-                        type_covered=rr.type_covered,
-                        algorithm=rr.algorithm,
-                        labels=rr.labels,
-                        original_ttl=rr.original_ttl,
-                        expiration=rr.expiration,
-                        inception=rr.inception,
-                        key_tag=rr.key_tag,
-                        signer=rr.signer,
-                        signature=rr.signature,
-                    ))
-            if len(new_rrsig) > 0:
-                section[section.index(rrsig)] = new_rrsig
-            else:
-                section.remove(rrsig)
-
-    def add_bogus_rrsig(section, algorithm):
-        algorithm = dns.dnssec.Algorithm(int(algorithm))
-        rrsigs = [rrset for rrset in section if rrset.rdtype == RRSIG]
-        for rrsig in rrsigs:
-            new_rrsig = dns.rrset.RRset(name=rrsig.name, rdclass=rrsig.rdclass, rdtype=rrsig.rdtype, covers=rrsig.covers)
-            section[section.index(rrsig)] = new_rrsig
-            for rr in rrsig:
-                new_rrsig.add(dns.rdtypes.ANY.RRSIG.RRSIG(
-                    rdclass=rr.rdclass,
-                    rdtype=rr.rdtype,
-                    type_covered=rr.type_covered,
-                    algorithm=rr.algorithm,
-                    labels=rr.labels,
-                    original_ttl=rr.original_ttl,
-                    expiration=rr.expiration,
-                    inception=rr.inception,
-                    key_tag=rr.key_tag,
-                    signer=rr.signer,
-                    signature=rr.signature,
-                ))
-            new_rrsig.add(dns.rdtypes.ANY.RRSIG.RRSIG(
-                rdclass=rr.rdclass,
-                rdtype=rr.rdtype,
-                type_covered=rr.type_covered,
-                algorithm=algorithm,
-                labels=rr.labels,
-                original_ttl=rr.original_ttl,
-                expiration=rr.expiration,
-                inception=rr.inception,
-                key_tag=rr.key_tag,
-                signer=rr.signer,
-                signature=b"\xff" * 24,
-            ))
-
-    def add_bogus_txt(section, *args):
-        txts = [rrset for rrset in section if rrset.rdtype == TXT]
-        for txt in txts:
-            new_txt = dns.rrset.RRset(name=txt.name, rdclass=txt.rdclass, rdtype=txt.rdtype, covers=txt.covers)
-            section[section.index(txt)] = new_txt
-            for rr in txt:
-                new_txt.add(dns.rdtypes.ANY.TXT.TXT(
-                    rdclass=rr.rdclass,
-                    rdtype=rr.rdtype,
-                    strings=rr.strings,
-                ))
-            new_txt.add(dns.rdtypes.ANY.TXT.TXT(
-                rdclass=rr.rdclass,
-                rdtype=rr.rdtype,
-                strings=(b"evil",),
-            ))
-
-    def modify_signatures(section, *args):
-        rrsigs = [rrset for rrset in section if rrset.rdtype == RRSIG]
-        for rrsig in rrsigs:
-            new_rrsig = dns.rrset.RRset(name=rrsig.name, rdclass=rrsig.rdclass, rdtype=rrsig.rdtype, covers=rrsig.covers)
-            section[section.index(rrsig)] = new_rrsig
-            for rr in rrsig:
-                s = rr.signature
-                new_rrsig.add(dns.rdtypes.ANY.RRSIG.RRSIG(
-                    rdclass=rr.rdclass,
-                    rdtype=rr.rdtype,
-                    type_covered=rr.type_covered,
-                    algorithm=rr.algorithm,
-                    labels=rr.labels,
-                    original_ttl=rr.original_ttl,
-                    expiration=rr.expiration,
-                    inception=rr.inception,
-                    key_tag=rr.key_tag,
-                    signer=rr.signer,
-                    signature=s[:-1] + bytes([s[-1] ^ 0x1]),  # flip last bit
-                ))
-
-    instruction_codes = {
-        'rs': replace_rrsig_algo,
-        'ra': replace_a,
-        'rt': replace_txt,
-        'rd': replace_ds,
-        'ds': drop_rrsigs,
-        'as': add_bogus_rrsig,
-        'at': add_bogus_txt,
-        'ms': modify_signatures,
-        'mitm': lambda *args: None,  # no-op
-    }
-
-    actions = [
-        (f, instruction[len(ic):])
-        for instruction in qname[0].decode().lower().split('-')
-        for ic, f in instruction_codes.items()
-        if instruction.startswith(ic)
-    ]
-
-    def filter_section(section):
-        for action, arg in actions:
-            action(section, arg)
-        return section
-
-    a.answer = filter_section(a.answer)
-    a.authority = filter_section(a.authority)
-    a.additional = filter_section(a.additional)
-
-
-def digest(message: bytes, host: str, port: int) -> Optional[bytes]:
-    logger.debug(f"accepted packet at pid {os.getpid()}")
+FILTER_ENGINE = os.environ.get('ADNSSEC_FILTER_ENGINE', 'dnspython')  # or 'wire', see wire.py
+UPSTREAM_POOL_SIZE = int(os.environ.get('ADNSSEC_UPSTREAM_POOL_SIZE', 0))  # 0: new connection per query
+UPSTREAM_UDP = bool(os.environ.get('ADNSSEC_UPSTREAM_UDP', False))
+UPSTREAM_STATS = UpstreamStats(log_interval=float(os.environ.get('ADNSSEC_UPSTREAM_STATS_INTERVAL', 60)))
+UPSTREAM_POOL = None  # created per worker process (and event loop), see upstream_pool()
+UPSTREAM_POOL_LOCK = threading.Lock()
+CACHE_BYTES = int(os.environ.get('ADNSSEC_CACHE_BYTES', 0))  # 0: no response cache, see cache.py
+RESPONSE_CACHE = ResponseCache(
+    CACHE_BYTES,
+    ttl_floor=float(os.environ.get('ADNSSEC_CACHE_TTL_FLOOR', 0)),
+    ttl_max=float(os.environ.get('ADNSSEC_CACHE_TTL_MAX', 3600)),
+    log_interval=float(os.environ.get('ADNSSEC_UPSTREAM_STATS_INTERVAL', 60)),
+) if CACHE_BYTES else None
+CACHE_FILTERED = bool(os.environ.get('ADNSSEC_CACHE_FILTERED', False))  # also cache the filtered answers
+TCP_IDLE_TIMEOUT = float(os.environ.get('ADNSSEC_TCP_IDLE_TIMEOUT', 10))  # seconds without queries in flight
+TCP_MAX_PIPELINE = int(os.environ.get('ADNSSEC_TCP_MAX_PIPELINE', 16))  # queries in flight per connection
+TCP_MAX_CONNECTIONS_PER_CLIENT = int(os.environ.get('ADNSSEC_TCP_MAX_CONNECTIONS_PER_CLIENT', 64))  # per process
+TCP_WORKERS = int(os.environ.get('ADNSSEC_TCP_WORKERS', 32))  # threads forwarding TCP queries, per process
+# UDP answers are truncated to the client's EDNS payload size (512 without EDNS), capped at ADNSSEC_UDP_MAX_PAYLOAD;
+# ADNSSEC_UDP_TRUNCATE=0 sends them whole, as before, even if they will be fragmented
+UDP_MAX_PAYLOAD = int(os.environ.get('ADNSSEC_UDP_MAX_PAYLOAD', 1232))
+UDP_TRUNCATE = os.environ.get('ADNSSEC_UDP_TRUNCATE', '1') not in ('', '0')
+
+# served by the MetricsServer on ADNSSEC_METRICS_PORT, see metrics.py
+QUERIES = REGISTRY.counter('mitm_queries_total', "Queries received", ('transport',))
+QUERY_SECONDS = REGISTRY.histogram('mitm_query_seconds', "Time from receiving a query to its answer", ('transport',))
+QUERY_ERRORS = REGISTRY.counter('mitm_query_errors_total', "Queries left unanswered, by error", ('error',))
+UPSTREAM_SECONDS = REGISTRY.histogram('mitm_upstream_seconds', "Latency of queries forwarded to the auth NS")
+ANSWERS = REGISTRY.counter('mitm_answers_total', "Answers, by whether filtering changed them", ('changed',))
+REWRITES = REGISTRY.counter('mitm_rewrites_total', "Rewrite instructions applied, by instruction code", ('code',))
+OVERSIZED = REGISTRY.counter('mitm_udp_oversized_total', "UDP answers larger than the client's payload size, by "
+                             "action: truncated (TC set), trimmed (additional data dropped) or sent whole", ('action',))
+TRUNCATED = REGISTRY.counter('mitm_udp_truncated_total', "UDP answers sent with TC set, by who set it", ('by',))
+REGISTRY.counter_function('mitm_upstream_events_total', "Upstream pool events, see UpstreamStats", 'event',
+                          UPSTREAM_STATS.as_dict)
+
+
+def configure() -> None:
+    """Applies the settings that can change at runtime from the environment: BE_EVIL, IP_A_EVIL, the filter engine
+    and the log levels. Filtered answers in the response cache are dropped, as they may no longer be right."""
+    global BE_EVIL, FILTER_ENGINE
+    BE_EVIL = bool(os.environ.get("BE_EVIL", False))
+    FILTER_ENGINE = os.environ.get('ADNSSEC_FILTER_ENGINE', 'dnspython')
+    filters.IP_A_EVIL = os.environ.get('IP_A_EVIL', '127.6.6.6')
+    configure_logging()
+    if RESPONSE_CACHE is not None:
+        RESPONSE_CACHE.forget_filtered()
+    logger.warning(f"configured pid {os.getpid()}: BE_EVIL={BE_EVIL}, IP_A_EVIL={filters.IP_A_EVIL}, "
+                   f"filter engine {FILTER_ENGINE}")
+
+
+def reload(*args) -> None:
+    if load_config(CONFIG_PATH):
+        configure()
+
+
+def parse_query(message: bytes, host: str, port: int) -> Optional[dns.message.Message]:
     m = dns.message.from_wire(message)
     if m.opcode() != dns.opcode.Opcode.QUERY:
-        logger.warning(f"Message from {host}:{port} wasn't a query: {dns.opcode.to_text(m.opcode())}")
+        logger.warning("Message from %s:%s wasn't a query: %s", host, port, dns.opcode.to_text(m.opcode()))
         return
     q = m
-    logger.debug(f"Query {q.id} from {host}:{port}")
-    logger.info(indent(q.to_text()))
-    logger.debug(f"Forwarding query {q.id} from {host}:{port} ...")
-    a = dns.query.tcp(q, where=auth_ns_addr, port=auth_ns_port, timeout=1)
-    upstream_answer = a.to_wire()
-    logger.debug(f"Received upstream answer for {q.id}, {host}:{port} ...")
-    logger.info(indent(a.to_text()))
+    logger.debug("Forwarding query %s from %s:%s at pid %s ...", q.id, host, port, os.getpid())
+    return q
+
+
+def rewrite(upstream_answer: bytes) -> Tuple[bytes, Optional[int]]:
+    """Filters the upstream answer if BE_EVIL; returns the final answer and the first byte changed by filtering."""
+    if FILTER_ENGINE == "wire":
+        try:
+            final_answer, first_changed_byte = wire.filter_response(upstream_answer) if BE_EVIL else \
+                wire.unchanged(upstream_answer)
+        except wire.WireFallback as e:
+            logger.debug("Falling back to dnspython filter: %s", e)
+        else:
+            return final_answer, first_changed_byte
+
+    a = dns.message.from_wire(upstream_answer)
+    upstream_answer = a.to_wire(want_shuffle=False)
 
     if BE_EVIL:
         filter_response(a)
 
     # analysis upstream answer vs final answer
-    final_answer = a.to_wire()
+    final_answer = a.to_wire(want_shuffle=False)
     common_prefix_length = len(os.path.commonprefix((upstream_answer, final_answer)))
     first_changed_byte = common_prefix_length if common_prefix_length < len(final_answer) else None
     # same_length = len(upstream_answer) == len(final_answer)
     # identical_bytes = sum(x == y for x, y in zip(upstream_answer, final_answer))
-    logger.debug(f"First changed byte in filtered response: {first_changed_byte}")
+    return final_answer, first_changed_byte
 
-    logger.debug(f"Forwarding answer {q.id} for {host}:{port} ...")
-    logger.info(indent(a.to_text()))
 
-    REQUESTS_QUEUE.put((time.time(), m, host, port, first_changed_byte, message))  # for SQLite3 Logging
+def count_rewrites(q: dns.message.Message) -> None:
+    try:
+        plan = get_plan(q)
+    except InstructionError:
+        return
+    if plan is not None:
+        for action, _ in plan.actions:
+            REWRITES.labels(ACTION_CODES[action]).inc()
+
+
+def lookup(q: dns.message.Message, payload: Optional[int]) -> Tuple[Optional[CacheKey], Optional[CacheEntry]]:
+    """The cache key and entry of q; payload is the UDP payload size of the upstream query, if sent over UDP."""
+    if RESPONSE_CACHE is None:
+        return None, None
+    key = RESPONSE_CACHE.key(q, payload if UPSTREAM_UDP else None)
+    return key, RESPONSE_CACHE.get(key) if key is not None else None
+
+
+def finalize(q: dns.message.Message, upstream_answer: Optional[bytes], message: bytes, host: str, port: int,
+             key: Optional[CacheKey] = None, entry: Optional[CacheEntry] = None) -> bytes:
+    """Filters and logs the upstream answer, or the one of the cache entry if given."""
+    if entry is not None:
+        upstream_answer = patch(entry.upstream, message)
+    elif key is not None:
+        entry = RESPONSE_CACHE.put(key, message, upstream_answer)
+
+    filtered = RESPONSE_CACHE.filtered(entry) if entry is not None else None
+    if filtered is not None:
+        final_answer, first_changed_byte = patch(filtered[0], message), filtered[1]
+    else:
+        final_answer, first_changed_byte = rewrite(upstream_answer)
+        if entry is not None and CACHE_FILTERED:
+            RESPONSE_CACHE.set_filtered(key, entry, final_answer, first_changed_byte)
+    logger.debug("Forwarding answer %s for %s:%s, first changed byte %s ...", q.id, host, port, first_changed_byte)
+    ANSWERS.labels('no' if first_changed_byte is None else 'yes').inc()
+    if BE_EVIL and q.question:
+        count_rewrites(q)
+
+    if q.question:  # for SQLite3 Logging
+        question = q.question[0]
+        qname = str(question.name)
+        REQUEST_LOG.log(Record(
+            time.time(), host, port, qname, dns.rdatatype.to_text(question.rdtype),
+            dns.rdataclass.to_text(question.rdclass), first_changed_byte, message,
+        ))
+        if DUMPER.wants(qname):
+            DUMPER.dump(
+                host=host, port=port, qname=qname, id=q.id, first_changed_byte=first_changed_byte,
+                query=q.to_text(), upstream=dns.message.from_wire(upstream_answer).to_text(),
+                final=dns.message.from_wire(final_answer).to_text() if first_changed_byte is not None else None,
+                # the exact bytes, for validate.py
+                upstream_wire=base64.b64encode(upstream_answer).decode(),
+                final_wire=base64.b64encode(final_answer).decode(),
+            )
     return final_answer
 
 
+def udp_payload(q: dns.message.Message) -> int:
+    """The size a UDP answer to q may have (RFC 6891 section 6.2.5)."""
+    if q.edns < 0:
+        return 512
+    return max(512, min(q.payload, UDP_MAX_PAYLOAD))
+
+
+def fit_udp(answer: bytes, payload: int) -> bytes:
+    if len(answer) > payload:
+        if not UDP_TRUNCATE:
+            OVERSIZED.labels('sent').inc()
+            return answer
+        answer, tc = wire.truncate(answer, payload)
+        OVERSIZED.labels('truncated' if tc else 'trimmed').inc()
+        if tc:
+            TRUNCATED.labels('mitm').inc()
+    elif is_truncated(answer):
+        TRUNCATED.labels('upstream').inc()
+    return answer
+
+
+def upstream_pool():
+    global UPSTREAM_POOL
+    if UPSTREAM_POOL is None:
+        with UPSTREAM_POOL_LOCK:  # the first queries of a worker arrive on several handler threads at once
+            if UPSTREAM_POOL is None:
+                pool_class = AsyncUpstreamPool if SERVE_MODE == "async" else UpstreamPool
+                UPSTREAM_POOL = pool_class(auth_ns_addr, auth_ns_port, size=UPSTREAM_POOL_SIZE, timeout=1,
+                                           udp=UPSTREAM_UDP, stats=UPSTREAM_STATS)
+    return UPSTREAM_POOL
+
+
+def digest(message: bytes, host: str, port: int, transport: str = 'udp') -> Optional[bytes]:
+    start = time.perf_counter()
+    QUERIES.labels(transport).inc()
+    q = parse_query(message, host, port)
+    if q is None:
+        return
+    payload = udp_payload(q) if transport == 'udp' else None
+    key, entry = lookup(q, payload)
+    upstream_answer = None
+    if entry is None:
+        upstream_start = time.perf_counter()
+        if payload and UPSTREAM_UDP:
+            upstream_answer = upstream_pool().query(wire.set_payload(message, payload), truncated_ok=True)
+        else:
+            upstream_answer = upstream_pool().query(message)
+        UPSTREAM_SECONDS.observe(time.perf_counter() - upstream_start)
+    answer = finalize(q, upstream_answer, message, host, port, key, entry)
+    if payload:
+        answer = fit_udp(answer, payload)
+    QUERY_SECONDS.labels(transport).observe(time.perf_counter() - start)
+    return answer
+
+
+async def digest_async(message: bytes, host: str, port: int, transport: str = 'udp') -> Optional[bytes]:
+    """Like digest(), but forwards to the auth NS without blocking the event loop."""
+    start = time.perf_counter()
+    QUERIES.labels(transport).inc()
+    q = parse_query(message, host, port)
+    if q is None:
+        return
+    payload = udp_payload(q) if transport == 'udp' else None
+    key, entry = lookup(q, payload)
+    upstream_answer = None
+    if entry is None:
+        upstream_start = time.perf_counter()
+        if payload and UPSTREAM_UDP:
+            upstream_answer = await upstream_pool().query(wire.set_payload(message, payload), truncated_ok=True)
+        else:
+            upstream_answer = await upstream_pool().query(message)
+        UPSTREAM_SECONDS.observe(time.perf_counter() - upstream_start)
+    answer = finalize(q, upstream_answer, message, host, port, key, entry)
+    if payload:
+        answer = fit_udp(answer, payload)
+    QUERY_SECONDS.labels(transport).observe(time.perf_counter() - start)
+    return answer
+
+
+def query_error(e: Exception) -> str:
+    return 'timeout' if isinstance(e, dns.exception.Timeout) else 'upstream'
+
+
 class ReusePortServer:
+    draining = False
+    reload_requested = False  # set on SIGHUP, applied between requests: the handler may hold locks, e.g. of the cache
 
     def server_bind(self):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         super().server_bind()
 
+    def service_actions(self):
+        super().service_actions()
+        if self.reload_requested:
+            self.reload_requested = False
+            reload()
+        REQUEST_LOG.maybe_flush()
+        REPORTER.maybe_report()
+
+    def request_reload(self, *args):
+        self.reload_requested = True
+
+    def drain(self):
+        """Called on SIGTERM, from a thread other than the one in serve_forever."""
+        self.draining = True
+        self.shutdown()
+
 
 class ReusingUDPServer(ReusePortServer, socketserver.UDPServer):
     pass
 
 
-class ReusingTCPServer(ReusePortServer, socketserver.TCPServer):
-    pass
+class ReusingTCPServer(ReusePortServer, socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """One thread per connection; the queries of all connections are forwarded by a shared pool of threads."""
+    daemon_threads = True
+    block_on_close = False
+    request_queue_size = 128
+
+    def __init__(self, *args, **kwargs):
+        # before binding: TCPServer.__init__ calls server_close() if that fails
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=TCP_WORKERS)
+        self.connections = collections.Counter()
+        self.connections_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def verify_request(self, request, client_address):
+        with self.connections_lock:
+            if self.connections[client_address[0]] >= TCP_MAX_CONNECTIONS_PER_CLIENT:
+                logger.warning(f"Refusing TCP connection from {client_address[0]}: "
+                               f"{TCP_MAX_CONNECTIONS_PER_CLIENT} connections open")
+                return False
+            self.connections[client_address[0]] += 1
+        return True
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)  # answer the queries in flight
+
+    def connection_closed(self, client_address):
+        with self.connections_lock:
+            self.connections[client_address[0]] -= 1
+            if not self.connections[client_address[0]]:
+                del self.connections[client_address[0]]
+
+
+def recv_exactly(sock: socket.socket, length: int) -> Optional[bytes]:
+    """Reads exactly length bytes; None if the connection is closed (or times out) before the first byte."""
+    buf = bytearray()
+    while len(buf) < length:
+        try:
+            chunk = sock.recv(length - len(buf))
+        except socket.timeout:
+            if buf:
+                raise ConnectionError("timeout within a message")
+            raise
+        if not chunk:
+            if buf:
+                raise ConnectionError("connection closed within a message")
+            return None
+        buf += chunk
+    return bytes(buf)
 
 
 class Handler(socketserver.BaseRequestHandler):
     SERVER = None
+    TRANSPORT = None
 
     @classmethod
     def serve(cls):
         logger.warning(f"starting {cls.SERVER} in pid {os.getpid()}...")
         with cls.SERVER((HOST, PORT), cls) as server:
+            signal.signal(signal.SIGHUP, server.request_reload)
+            signal.signal(signal.SIGTERM, lambda *args: threading.Thread(target=server.drain).start())
             server.serve_forever()
+            logger.warning(f"draining {cls.SERVER} in pid {os.getpid()}...")
+        REQUEST_LOG.flush()
+        REPORTER.report()
 
     def digest(self, data):
         try:
-            return digest(data, self.client_address[0], self.client_address[1])
-        except dns.exception.Timeout:
+            return digest(data, self.client_address[0], self.client_address[1], self.TRANSPORT)
+        except (dns.exception.Timeout, UpstreamError) as e:
+            QUERY_ERRORS.labels(query_error(e)).inc()
             logger.error(traceback.format_exc())
 
 
 class UDPHandler(Handler):
     SERVER = ReusingUDPServer
+    TRANSPORT = 'udp'
 
     def handle(self):
         data = self.request[0]
@@ -330,66 +407,216 @@ class UDPHandler(Handler):
 
 
 class TCPHandler(Handler):
+    """
+    Serves the queries of one connection (RFC 7766): up to TCP_MAX_PIPELINE queries are forwarded concurrently and
+    answered as they complete, possibly out of order. The connection is closed after TCP_IDLE_TIMEOUT seconds
+    without queries in flight.
+    """
     SERVER = ReusingTCPServer
+    TRANSPORT = 'tcp'
 
     def handle(self):
         # self.request is the TCP socket connected to the client
-        length = struct.unpack('!h', self.request.recv(2))[0]
-        data = self.request.recv(length)
-        response = self.digest(data)
-        if response is not None:
-            length = struct.pack('!h', len(response))
-            self.request.sendall(length + response)
+        self.request.settimeout(TCP_IDLE_TIMEOUT)
+        self.write_lock = threading.Lock()
+        self.pipeline = threading.BoundedSemaphore(TCP_MAX_PIPELINE)
+        in_flight = set()
+        try:
+            while True:
+                try:
+                    prefix = recv_exactly(self.request, 2)
+                except socket.timeout:
+                    if in_flight:
+                        continue
+                    break
+                if prefix is None:
+                    break
+                data = recv_exactly(self.request, struct.unpack('!H', prefix)[0])
+                if data is None or self.server.draining:
+                    break
+                self.pipeline.acquire()
+                future = self.server.executor.submit(self.answer, data)
+                in_flight.add(future)
+                future.add_done_callback(in_flight.discard)
+        except OSError as e:  # includes ConnectionError
+            logger.debug("TCP connection from %s:%s: %s", self.client_address[0], self.client_address[1], e)
+        concurrent.futures.wait(list(in_flight))
+
+    def answer(self, data: bytes) -> None:
+        try:
+            response = self.digest(data)
+            if response is not None:
+                with self.write_lock:
+                    self.request.sendall(struct.pack('!H', len(response)) + response)
+        except OSError:
+            pass  # the client is gone
+        except Exception:
+            QUERY_ERRORS.labels('other').inc()
+            logger.error(f"Error handling query from {self.client_address[0]}:{self.client_address[1]}\n"
+                         f"{traceback.format_exc()}")
+        finally:
+            self.pipeline.release()
+
+    def finish(self):
+        self.server.connection_closed(self.client_address)
+
+
+class AsyncHandler:
+    """
+    Serves UDP and TCP from a single event loop, one coroutine per query.
+    Several loops (processes) can bind the same port thanks to SO_REUSEPORT.
+    """
+
+    @staticmethod
+    async def digest(data, host, port, transport):
+        try:
+            return await digest_async(data, host, port, transport)
+        except (dns.exception.Timeout, UpstreamError) as e:
+            QUERY_ERRORS.labels(query_error(e)).inc()
+            logger.error(traceback.format_exc())
+        except Exception:
+            QUERY_ERRORS.labels('other').inc()
+            logger.error(f"Error handling query from {host}:{port}\n{traceback.format_exc()}")
 
+    class UDPProtocol(asyncio.DatagramProtocol):
 
-class SqliteLogger(Process):
-    def __init__(self, db_name=LOG_DB_NAME) -> None:
-        super(SqliteLogger, self).__init__()
-        self.con = sqlite3.connect(db_name)
-        self.cur = self.con.cursor()
-        self.cur.execute(SQL_INIT_STMT)
+        def __init__(self):
+            self.transport = None
+            self.draining = False
+            self.in_flight = set()
 
-    def run(self):
-        while True:
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def datagram_received(self, data, addr):
+            if self.draining:
+                return
+            task = asyncio.ensure_future(self.handle(data, addr))
+            self.in_flight.add(task)
+            task.add_done_callback(self.in_flight.discard)
+
+        async def handle(self, data, addr):
+            response = await AsyncHandler.digest(data, addr[0], addr[1], 'udp')
+            if response is not None:
+                self.transport.sendto(response, addr)
+
+    tcp_connections = collections.Counter()  # open connections per client address
+    tcp_tasks = set()  # of the open connections
+    tcp_idle = set()  # of those, the ones waiting for the next query, cancelled to drain them
+    draining = False
+
+    @classmethod
+    async def handle_tcp(cls, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serves the queries of one connection, as TCPHandler does."""
+        host, port = writer.get_extra_info('peername')[:2]
+        if cls.tcp_connections[host] >= TCP_MAX_CONNECTIONS_PER_CLIENT:
+            logger.warning(f"Refusing TCP connection from {host}: {TCP_MAX_CONNECTIONS_PER_CLIENT} connections open")
+            writer.close()
+            return
+        cls.tcp_connections[host] += 1
+        task = asyncio.current_task()
+        cls.tcp_tasks.add(task)
+        pipeline = asyncio.Semaphore(TCP_MAX_PIPELINE)
+        in_flight = set()
+
+        async def answer(data: bytes):
             try:
-                timestamp, message, host, port, first_changed_byte, message_bytes = REQUESTS_QUEUE.get()
-                date = str(datetime.datetime.fromtimestamp(timestamp))
-                query = message.question[0]
-                qname = str(query.name)
-                qtype = dns.rdatatype.to_text(query.rdtype)
-                qclass = dns.rdataclass.to_text(query.rdclass)
-                logger.debug(
-                    f"date={date}({type(date)}), "
-                    f"timestamp={timestamp}({type(timestamp)}), "
-                    f"host={host}({type(host)}), "
-                    f"port={port}({type(port)}), "
-                    f"qname={qname}({type(qname)}), "
-                    f"qclass={qclass}({type(qclass)}, "
-                    f"first_changed_byte={first_changed_byte}({type(first_changed_byte)}, "
-                    f"len(message_bytes)={len(message_bytes)}"
-                )
-                self.cur.execute(
-                    SQL_INSERT_STMT,
-                    (date, timestamp, host, port, qname, qtype, qclass, first_changed_byte, message_bytes),
-                )
-                self.con.commit()
-            except Exception as e:
-                logger.warning(f"SqliteLogger: {str(e)}")
+                response = await cls.digest(data, host, port, 'tcp')
+                if response is not None:
+                    writer.write(struct.pack('!H', len(response)) + response)
+                    await writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                pipeline.release()
+
+        try:
+            while not cls.draining:
+                cls.tcp_idle.add(task)
+                try:
+                    prefix = await asyncio.wait_for(reader.readexactly(2), TCP_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    if in_flight:
+                        continue
+                    break
+                finally:
+                    cls.tcp_idle.discard(task)
+                data = await reader.readexactly(struct.unpack('!H', prefix)[0])
+                await pipeline.acquire()
+                answer_task = asyncio.ensure_future(answer(data))
+                in_flight.add(answer_task)
+                answer_task.add_done_callback(in_flight.discard)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            if in_flight:
+                await asyncio.wait(in_flight)
+            cls.tcp_tasks.discard(task)
+            cls.tcp_connections[host] -= 1
+            if not cls.tcp_connections[host]:
+                del cls.tcp_connections[host]
+            writer.close()
+
+    @staticmethod
+    async def flush_request_log():
+        while True:
+            await asyncio.sleep(REQUEST_LOG.flush_interval)
+            REQUEST_LOG.maybe_flush()
+            REPORTER.maybe_report()
+
+    @classmethod
+    async def main(cls):
+        loop = asyncio.get_running_loop()
+        asyncio.ensure_future(cls.flush_request_log())
+        stop = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+        loop.add_signal_handler(signal.SIGHUP, reload)
+        transport, udp = await loop.create_datagram_endpoint(cls.UDPProtocol, local_addr=(HOST, PORT),
+                                                             reuse_port=True)
+        server = await asyncio.start_server(cls.handle_tcp, HOST, PORT, reuse_port=True)
+        await stop.wait()
+
+        # drain: take no new queries or connections, answer the queries in flight
+        logger.warning(f"draining asyncio UDP/TCP server in pid {os.getpid()}...")
+        server.close()
+        udp.draining = cls.draining = True
+        for task in cls.tcp_idle:
+            task.cancel()
+        pending = udp.in_flight | cls.tcp_tasks
+        if pending:
+            await asyncio.wait(pending, timeout=DRAIN_TIMEOUT)
+        transport.close()
+        REQUEST_LOG.flush()
+        REPORTER.report()
+
+    @classmethod
+    def serve(cls):
+        logger.warning(f"starting asyncio UDP/TCP server in pid {os.getpid()}...")
+        asyncio.run(cls.main())
 
 
 if __name__ == "__main__":
-    num_processes = int(os.environ.get("ADNSSEC_NUM_PROCESSES", 100))
-    processes = [
-        multiprocessing.Process(target=handler)
-        for handler in [TCPHandler.serve, UDPHandler.serve]
-        for _ in range(num_processes)
-    ]
-    sqliteLogger = SqliteLogger()
+    if SERVE_MODE == "async":
+        num_loops = int(os.environ.get("ADNSSEC_NUM_LOOPS", os.cpu_count()))
+        handlers = [AsyncHandler.serve] * num_loops
+    else:
+        num_processes = int(os.environ.get("ADNSSEC_NUM_PROCESSES", 100))
+        handlers = [TCPHandler.serve, UDPHandler.serve] * num_processes
+    sqliteLogger = SqliteLogger(
+        LOG_DB_DIR, REQUESTS_QUEUE, DROPPED_RECORDS,
+        rotate_interval=float(os.environ.get("ADNSSEC_LOG_ROTATE_INTERVAL", 3600)),
+        rotate_size=int(os.environ.get("ADNSSEC_LOG_ROTATE_SIZE", 0)),
+    )
     sqliteLogger.start()
-    for p in processes:
-        logger.info(f"Starting {p} from pid {os.getpid()}")
-        p.start()
-    for p in processes:
-        p.join()
-    REQUESTS_QUEUE.join()
-    sqliteLogger.close()
+    metricsServer = MetricsServer(REPORTER.snapshots, log_queue=REQUESTS_QUEUE, dropped=DROPPED_RECORDS) \
+        if METRICS_PORT else None
+    if metricsServer:
+        metricsServer.start()
+    # each worker is pinned to a CPU, started again if it dies, and reloads or drains on SIGHUP or SIGTERM
+    Supervisor(handlers, pin_cpus=PIN_CPUS, drain_timeout=DRAIN_TIMEOUT + 5, config_path=CONFIG_PATH,
+               configure=configure).run()
+    REQUESTS_QUEUE.put(None)
+    sqliteLogger.join()
+    if metricsServer:
+        REPORTER.snapshots.put(None)
+        metricsServer.join()
@@ -0,0 +1,403 @@
+"""
+Replays recorded traffic from the request log (the raw queries in its mdump column, see requestlog.py) against a
+mitm proxy, and compares the results of two replays, e.g. of two builds of the proxy.
+
+    python3 replay.py run /data [more logs ...] --target 127.0.0.1:53 --speed 10 --out before.sqlite3
+    python3 replay.py diff before.sqlite3 after.sqlite3
+
+`run` streams the rows of the given request logs (directories of segments or single segment files; several logs are
+merged by timestamp), optionally restricted to --start/--end, and re-sends the queries at their original inter-arrival
+times divided by --speed, or as fast as --max-in-flight allows with --speed 0. The queries of an original client
+address are sent by one of --clients simulated clients, each with its own UDP socket (or pipelined TCP connection)
+that rewrites the message IDs to be unique while in flight, as the upstream pool does. The query, response bytes,
+rcode and latency (or error) of every row are written to a new SQLite file, together with the row's first_changed_byte
+from the replayed log. With --target-log, the replayed queries are then looked up in the target proxy's own request
+log (by client port and query bytes) for the first_changed_byte of the build under test.
+
+`diff` compares two such files row by row (they must replay the same rows): throughput and latency of both runs,
+responses that differ (with the offset of their first differing byte) and differing first_changed_byte. It exits
+with 1 if any of them differ. Answers that legitimately change between runs (e.g. zones re-signed in the meantime)
+show up as differences, too.
+"""
+import argparse
+import asyncio
+import collections
+import datetime
+import heapq
+import logging
+import os
+import sqlite3
+import sys
+import time
+import zlib
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import dns.exception
+
+from bench_load import percentile
+from requestlog import LOG_DB_TABLE_NAME, Timestamp, read_requests, time_range_condition
+from upstream import AsyncTCPConnection, AsyncUDPChannel, UpstreamError, UpstreamStats
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = "id, timestamp, host, qname, qtype, first_changed_byte, mdump"
+SQL_INIT_STMTS = (
+    "CREATE TABLE replies ("
+    "seq integer PRIMARY KEY, "  # position of the row in the replayed logs
+    "segment text NOT NULL, "
+    "source_id integer NOT NULL, "  # id of the row in its segment
+    "timestamp real NOT NULL, "  # of the original query
+    "qname text NOT NULL, "
+    "qtype text NOT NULL, "
+    "client integer NOT NULL, "
+    "client_port integer NULL, "
+    "sent real NOT NULL, "  # seconds since the start of the replay
+    "latency real NULL, "
+    "rcode integer NULL, "
+    "tc integer NULL, "
+    "query blob NOT NULL, "
+    "response blob NULL, "
+    "error text NULL, "
+    "logged_first_changed_byte integer NULL, "  # in the replayed request log
+    "first_changed_byte integer NULL"  # in the target's request log, with --target-log
+    ");",
+    "CREATE TABLE run (key text PRIMARY KEY, value text);",
+)
+SQL_INSERT_STMT = "INSERT INTO replies VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL);"
+
+Row = Tuple[float, str, int, str, str, str, Optional[int], Optional[bytes]]
+"""(timestamp, segment, id, host, qname, qtype, first_changed_byte, mdump) of a request log row."""
+
+
+def log_rows(path: str, start: Timestamp = None, end: Timestamp = None) -> Iterator[Row]:
+    """The rows of a request log directory (see read_requests) or of a single segment file, in id order."""
+    if os.path.isdir(path):
+        rows = read_requests(path, start, end, columns=COLUMNS)
+    else:
+        rows = segment_rows(path, start, end)
+    for segment, row_id, timestamp, host, qname, qtype, first_changed_byte, mdump in rows:
+        yield timestamp, segment, row_id, host, qname, qtype, first_changed_byte, mdump
+
+
+def segment_rows(path: str, start: Timestamp, end: Timestamp) -> Iterator[tuple]:
+    con = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        cursor = con.execute(
+            f"SELECT {COLUMNS} FROM {LOG_DB_TABLE_NAME} WHERE {time_range_condition(start, end)} ORDER BY id")
+        for row in cursor:
+            yield (os.path.basename(path), *row)
+    finally:
+        con.close()
+
+
+def merged_rows(paths: List[str], start: Timestamp = None, end: Timestamp = None) -> Iterator[Row]:
+    """
+    The rows of all logs, merged by timestamp. Within a log, id order is timestamp order up to the batching of the
+    workers; rows that come a little out of order are sent as soon as they are read.
+    """
+    return heapq.merge(*(log_rows(path, start, end) for path in paths), key=lambda row: row[0])
+
+
+class Client:
+    """A simulated client: one UDP socket or pipelined TCP connection to the target, opened again if it breaks."""
+
+    def __init__(self, host: str, port: int, transport: str, stats: UpstreamStats) -> None:
+        self.host, self.port = host, port
+        self.transport = transport
+        self.stats = stats
+        self.channel = None
+        self.lock: Optional[asyncio.Lock] = None  # created in the event loop
+
+    async def connect(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.channel is None or self.channel.closed:
+                if self.transport == 'tcp':
+                    self.channel = await AsyncTCPConnection.connect(self.host, self.port, 5, self.stats)
+                else:
+                    self.channel = await AsyncUDPChannel.connect(self.host, self.port, self.stats)
+        return self.channel
+
+    async def query(self, wire: bytes, timeout: float) -> Tuple[bytes, int]:
+        """The response, and the local port the query was sent from."""
+        channel = self.channel
+        if channel is None or channel.closed:
+            channel = await self.connect()
+        transport = channel.writer.transport if self.transport == 'tcp' else channel.transport
+        return await channel.query(wire, timeout), transport.get_extra_info('sockname')[1]
+
+    def close(self) -> None:
+        if self.channel is not None:
+            if self.transport == 'tcp':
+                self.channel.close()
+            else:
+                self.channel.transport.close()
+
+
+class Results:
+    """The replies of a replay, written to a new SQLite file in batches."""
+
+    def __init__(self, path: str, batch_size: int = 1000) -> None:
+        if os.path.exists(path):
+            raise FileExistsError(f"{path} exists, not overwriting the results of an earlier replay")
+        self.con = sqlite3.connect(path)
+        for statement in SQL_INIT_STMTS:
+            self.con.execute(statement)
+        self.batch: List[tuple] = []
+        self.batch_size = batch_size
+
+    def add(self, reply: tuple) -> None:
+        self.batch.append(reply)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        with self.con:
+            self.con.executemany(SQL_INSERT_STMT, self.batch)
+        self.batch = []
+
+    def set_run(self, **values) -> None:
+        with self.con:
+            self.con.executemany("INSERT OR REPLACE INTO run VALUES (?, ?)", [(k, str(v)) for k, v in values.items()])
+
+    def close(self) -> None:
+        self.flush()
+        self.con.close()
+
+
+class Replay:
+
+    def __init__(self, target: Tuple[str, int], results: Results, clients: int = 64, transport: str = 'udp',
+                 speed: float = 1, max_in_flight: int = 10000, timeout: float = 2) -> None:
+        self.stats = UpstreamStats(log_interval=0)
+        self.clients = [Client(*target, transport, self.stats) for _ in range(clients)]
+        self.results = results
+        self.speed = speed
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.outcomes = collections.Counter()
+        self.lags: List[float] = []  # seconds by which sends missed their time, with speed > 0
+        self.started = self.finished = 0.0
+
+    def client_of(self, host: str) -> int:
+        return zlib.crc32(host.encode()) % len(self.clients)
+
+    async def send(self, seq: int, row: Row, sent: float, slots: asyncio.Semaphore) -> None:
+        timestamp, segment, row_id, host, qname, qtype, first_changed_byte, mdump = row
+        number = self.client_of(host)
+        response = latency = error = port = None
+        start = time.perf_counter()
+        try:
+            response, port = await self.clients[number].query(mdump, self.timeout)
+            latency = time.perf_counter() - start
+        except dns.exception.Timeout:
+            error = 'timeout'
+        except (OSError, UpstreamError, asyncio.TimeoutError) as e:
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            slots.release()
+        self.outcomes['answered' if error is None else error.split(':')[0]] += 1
+        self.results.add((
+            seq, segment, row_id, timestamp, qname, qtype, number, port, sent, latency,
+            response[3] & 0xf if response else None, bool(response[2] & 0x02) if response else None,
+            mdump, response, error, first_changed_byte,
+        ))
+
+    async def run(self, rows: Iterator[Row], progress_interval: float = 10) -> None:
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.max_in_flight)
+        tasks = set()
+        first_timestamp = None
+        self.started = loop.time()
+        next_progress = self.started + progress_interval
+        for seq, row in enumerate(rows):
+            mdump = row[7]
+            if not mdump or len(mdump) < 12:
+                self.outcomes['skipped'] += 1
+                continue
+            if self.speed:
+                if first_timestamp is None:
+                    first_timestamp = row[0]
+                due = self.started + (row[0] - first_timestamp) / self.speed
+                now = loop.time()
+                if due > now:
+                    await asyncio.sleep(due - now)
+                elif now - due > .001:
+                    self.lags.append(now - due)
+            await slots.acquire()
+            now = loop.time()
+            task = asyncio.ensure_future(self.send(seq, row, now - self.started, slots))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            if now >= next_progress:
+                next_progress = now + progress_interval
+                logger.info(f"{seq + 1} rows in {now - self.started:.0f}s, {len(tasks)} in flight: "
+                            f"{dict(self.outcomes)}")
+        if tasks:
+            await asyncio.wait(tasks)
+        self.finished = loop.time()
+        for client in self.clients:
+            client.close()
+
+    def summary(self) -> Dict[str, float]:
+        duration = self.finished - self.started
+        sent = sum(count for outcome, count in self.outcomes.items() if outcome != 'skipped')
+        return dict(duration=round(duration, 3), sent=sent, qps=round(sent / duration, 1) if duration else 0,
+                    late_sends=len(self.lags), max_lag=round(max(self.lags, default=0), 3), **self.outcomes)
+
+
+def annotate(path: str, target_log: str, start: float, end: float) -> Tuple[int, int]:
+    """
+    Sets first_changed_byte of the replies from the target proxy's request log. A replayed query is logged with the
+    port of its client and the message ID it was sent with, so rows are matched by port and the query bytes after the
+    ID, in order. Returns the numbers of replies and of those found in the log.
+    """
+    logged = collections.defaultdict(collections.deque)
+    for _, port, first_changed_byte, mdump in read_requests(target_log, start, end,
+                                                          columns="port, first_changed_byte, mdump"):
+        if mdump:
+            logged[port, mdump[2:]].append(first_changed_byte)
+    con = sqlite3.connect(path)
+    updates, total = [], 0
+    for seq, port, query in con.execute("SELECT seq, client_port, query FROM replies WHERE response IS NOT NULL "
+                                        "ORDER BY seq"):
+        total += 1
+        found = logged.get((port, query[2:]))
+        if found:
+            updates.append((found.popleft(), seq))
+    with con:
+        con.executemany("UPDATE replies SET first_changed_byte = ? WHERE seq = ?", updates)
+        con.execute("INSERT OR REPLACE INTO run VALUES ('annotated', ?)", (str(len(updates)),))
+    con.close()
+    return total, len(updates)
+
+
+def run(args) -> None:
+    host, _, port = args.target.rpartition(':')
+    try:
+        results = Results(args.out)
+    except FileExistsError as e:
+        raise SystemExit(e)
+    replay = Replay((host, int(port)), results, args.clients, args.transport, args.speed, args.max_in_flight,
+                    args.timeout)
+    rows = merged_rows(args.paths, args.start, args.end)
+    if args.limit:
+        rows = (row for _, row in zip(range(args.limit), rows))
+    started = time.time()
+    try:
+        asyncio.run(replay.run(rows))
+    finally:
+        summary = replay.summary()
+        results.set_run(target=args.target, transport=args.transport, speed=args.speed, clients=args.clients,
+                        logs=" ".join(args.paths), started=started, **summary)
+        results.close()
+    logger.warning(f"replayed to {args.target}: {summary}")
+    if args.target_log:
+        time.sleep(args.log_delay)  # for the target to write out its request log batches
+        total, found = annotate(args.out, args.target_log, started - 1, time.time())
+        logger.warning(f"found {found} of {total} answered queries in the request log in {args.target_log}")
+
+
+def load(path: str) -> Tuple[Dict[str, str], List[float]]:
+    con = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        info = dict(con.execute("SELECT key, value FROM run"))
+        latencies = [row[0] for row in con.execute("SELECT latency FROM replies WHERE latency IS NOT NULL "
+                                                   "ORDER BY latency")]
+    finally:
+        con.close()
+    return info, latencies
+
+
+def diff(a: str, b: str, examples: int = 10) -> int:
+    """Prints the comparison of two replays; returns the number of rows that differ."""
+    for path in (a, b):
+        info, latencies = load(path)
+        print(f"{path}: {info.get('sent')} queries to {info.get('target')} in {float(info.get('duration', 0)):.1f}s "
+              f"({info.get('qps')} qps, speed {info.get('speed')}), {info.get('answered', 0)} answered, "
+              f"{info.get('timeout', 0)} timeouts; latency ms p50/p99/p99.9/max: "
+              + "/".join(f"{percentile(latencies, p) * 1e3:.2f}" if latencies else "-" for p in (50, 99, 99.9, 100)))
+
+    con = sqlite3.connect(f"file:{a}?mode=ro", uri=True)
+    con.execute("ATTACH DATABASE ? AS b", (f"file:{b}?mode=ro",))
+    annotated = all(info.get('annotated') for info in (dict(con.execute("SELECT key, value FROM main.run")),
+                                                       dict(con.execute("SELECT key, value FROM b.run"))))
+    counts = collections.Counter()
+    offsets = collections.Counter()
+    shown = []
+    rows = con.execute(
+        "SELECT x.seq, x.qname, x.qtype, x.segment = y.segment AND x.source_id = y.source_id, x.response, "
+        "y.response, x.first_changed_byte, y.first_changed_byte "
+        "FROM main.replies x JOIN b.replies y USING (seq) ORDER BY seq")
+    for seq, qname, qtype, same_row, x, y, x_changed, y_changed in rows:
+        if not same_row:
+            raise SystemExit(f"{a} and {b} did not replay the same rows (first difference at seq {seq})")
+        if x is None or y is None:
+            counts['unanswered by both' if x is None and y is None else 'answered by one'] += 1
+            continue
+        if x == y:
+            counts['identical responses'] += 1
+        else:
+            offset = len(os.path.commonprefix((x, y)))
+            counts['DIFFERENT responses'] += 1
+            offsets[offset] += 1
+            if len(shown) < examples:
+                shown.append(f"  seq {seq} {qname} {qtype}: {len(x)} vs. {len(y)} bytes, first difference at "
+                             f"byte {offset}")
+        if annotated:
+            counts['same first_changed_byte' if x_changed == y_changed else 'DIFFERENT first_changed_byte'] += 1
+            if x_changed != y_changed and len(shown) < examples:
+                shown.append(f"  seq {seq} {qname} {qtype}: first_changed_byte {x_changed} vs. {y_changed}")
+    con.close()
+
+    print(", ".join(f"{k}={v}" for k, v in sorted(counts.items())))
+    if offsets:
+        print("first differing byte of different responses: "
+              + ", ".join(f"{offset} ({count})" for offset, count in offsets.most_common(10)))
+    print("\n".join(shown))
+    if not annotated:
+        print("first_changed_byte not compared, replay with --target-log to record it")
+    return counts['DIFFERENT responses'] + counts['DIFFERENT first_changed_byte']
+
+
+def timestamp(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['run', 'diff'])
+    parser.add_argument('paths', nargs='+',
+                        help="run: request log directories or segment files; diff: two results files of run")
+    parser.add_argument('--target', default='127.0.0.1:53', help="address of the proxy to replay to")
+    parser.add_argument('--out', help="results file to create, default: replay-<time>.sqlite3")
+    parser.add_argument('--start', type=timestamp, help="replay rows from this time (timestamp or ISO format) on")
+    parser.add_argument('--end', type=timestamp, help="and before this time")
+    parser.add_argument('--limit', type=int, default=0, help="replay at most this many rows")
+    parser.add_argument('--speed', type=float, default=1,
+                        help="factor by which the original timing is sped up, 0: as fast as possible")
+    parser.add_argument('--clients', type=int, default=64, help="simulated clients")
+    parser.add_argument('--transport', choices=['udp', 'tcp'], default='udp')
+    parser.add_argument('--max-in-flight', type=int, default=10000, help="queries awaiting a response at a time")
+    parser.add_argument('--timeout', type=float, default=2)
+    parser.add_argument('--target-log', help="request log directory of the target, for its first_changed_byte")
+    parser.add_argument('--log-delay', type=float, default=3,
+                        help="seconds to wait for the target's request log before reading it")
+    parser.add_argument('--examples', type=int, default=10, help="diff: differences to show")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'diff':
+        if len(args.paths) != 2:
+            parser.error("diff needs two results files")
+        sys.exit(1 if diff(*args.paths, args.examples) else 0)
+    args.out = args.out or f"replay-{datetime.datetime.now().isoformat(timespec='seconds').replace(':', '_')}.sqlite3"
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
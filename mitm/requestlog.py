@@ -0,0 +1,327 @@
+"""
+The request log of the mitm proxy: one row per query in the SQLite table `requests`.
+
+The log is split into segments, separate database files named requests_<start time>.sqlite3. A new segment is begun
+every hour (or ADNSSEC_LOG_ROTATE_INTERVAL seconds) and when a segment outgrows ADNSSEC_LOG_ROTATE_SIZE bytes.
+open_requests() and read_requests() give a merged read view over all segments or a time range of them.
+
+Worker processes collect compact records (scalar fields plus the raw query bytes) in a local batch and hand whole
+batches to the SqliteLogger process through a bounded multiprocessing queue. If the queue is full, the batch is dropped
+and counted (or, with the "block" policy, the worker waits), so a slow disk never stalls DNS answers. The SqliteLogger
+inserts with executemany, many batches per transaction, on a database in WAL mode.
+"""
+import datetime
+import logging
+import multiprocessing
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from multiprocessing import Process
+from typing import Iterator, List, NamedTuple, Optional, Tuple, Union
+
+from metrics import REGISTRY, REPORTER
+
+logger = logging.getLogger(__name__)
+
+LOG_DB_TABLE_NAME = "requests"
+SQL_INIT_STMT = (
+    f"CREATE TABLE IF NOT EXISTS {LOG_DB_TABLE_NAME} ("
+    f"id integer PRIMARY KEY, "
+    f"date text NOT NULL, "
+    f"timestamp real NOT NULL, "
+    f"host text NOT NULL, "
+    f"port integer NOT NULL, "
+    f"qname text NOT NULL, "
+    f"qtype text NOT NULL, "
+    f"qclass text NOT NULL, "
+    f"first_changed_byte integer NULL, "
+    f"mdump blob"
+    f");"
+)
+SQL_INDEX_STMT = (
+    f"CREATE INDEX IF NOT EXISTS {LOG_DB_TABLE_NAME}_timestamp_qname_host "
+    f"ON {LOG_DB_TABLE_NAME} (timestamp, qname, host);"
+)
+SQL_INSERT_STMT = (
+    f'INSERT INTO {LOG_DB_TABLE_NAME} (date, timestamp, host, port, qname, qtype, qclass, first_changed_byte, mdump) '
+    f'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);'
+)
+
+
+SQLITE_INSERT_SECONDS = REGISTRY.histogram('mitm_sqlite_insert_seconds', "Time to insert a transaction of rows")
+SQLITE_ROWS = REGISTRY.counter('mitm_sqlite_rows_total', "Request log rows, by outcome of their insert", ('outcome',))
+
+SEGMENT_PATTERN = re.compile(r'^requests_(.*)\.sqlite3$')
+SEGMENT_SLACK = 60  # seconds; rows may be written to a segment a little after it was rotated out
+
+
+def segment_path(directory: str, start: float) -> str:
+    return os.path.join(
+        directory, f'requests_{datetime.datetime.fromtimestamp(start).isoformat()}.sqlite3'.replace(":", "_"))
+
+
+def list_segments(directory: str) -> List[Tuple[float, str]]:
+    """All segments in directory as (start timestamp, path), oldest first."""
+    segments = []
+    for name in os.listdir(directory):
+        match = SEGMENT_PATTERN.match(name)
+        if not match:
+            continue
+        try:
+            start = datetime.datetime.fromisoformat(match.group(1).replace("_", ":")).timestamp()
+        except ValueError:
+            logger.warning(f"Ignoring request log file with unexpected name {name}")
+            continue
+        segments.append((start, os.path.join(directory, name)))
+    return sorted(segments)
+
+
+Timestamp = Union[float, datetime.datetime, None]
+
+
+def to_timestamp(t: Timestamp) -> Optional[float]:
+    return t.timestamp() if isinstance(t, datetime.datetime) else t
+
+
+def select_segments(directory: str, start: Timestamp = None, end: Timestamp = None) -> List[str]:
+    """Paths of the segments that may contain rows with start <= timestamp < end."""
+    start, end = to_timestamp(start), to_timestamp(end)
+    segments = list_segments(directory)
+    selected = []
+    for i, (segment_start, path) in enumerate(segments):
+        segment_end = segments[i + 1][0] + SEGMENT_SLACK if i + 1 < len(segments) else float('inf')
+        if (end is None or segment_start - SEGMENT_SLACK < end) and (start is None or segment_end > start):
+            selected.append(path)
+    return selected
+
+
+def time_range_condition(start: Timestamp, end: Timestamp) -> str:
+    start, end = to_timestamp(start), to_timestamp(end)
+    conditions = ([f"timestamp >= {float(start)!r}"] if start is not None else []) + \
+                 ([f"timestamp < {float(end)!r}"] if end is not None else [])
+    return " AND ".join(conditions) or "1"
+
+
+def open_requests(directory: str = "/data", start: Timestamp = None, end: Timestamp = None) -> sqlite3.Connection:
+    """
+    Returns an in-memory connection with all segments that overlap the time range attached (read-only) and merged
+    into the temporary view `requests`, restricted to start <= timestamp < end. The view has an additional column
+    `segment` with the segment's file name, as ids are only unique within a segment. Unreadable segments are skipped.
+    SQLite limits how many databases can be attached (usually 10); use read_requests() for longer time ranges.
+    """
+    paths = select_segments(directory, start, end)
+    con = sqlite3.connect("file::memory:", uri=True)
+    limit = con.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    if len(paths) > limit:
+        raise ValueError(f"{len(paths)} segments in time range, but SQLite can only attach {limit}; "
+                         f"narrow the range or use read_requests()")
+    selects = []
+    for i, path in enumerate(paths):
+        try:
+            con.execute(f"ATTACH DATABASE ? AS s{i}", (f"file:{path}?mode=ro",))
+            con.execute(f"SELECT 1 FROM s{i}.{LOG_DB_TABLE_NAME} LIMIT 1")
+        except sqlite3.DatabaseError as e:
+            logger.warning(f"Skipping unreadable request log segment {path}: {e}")
+            continue
+        selects.append(f"SELECT '{os.path.basename(path)}' AS segment, * FROM s{i}.{LOG_DB_TABLE_NAME}")
+    condition = time_range_condition(start, end)
+    union = " UNION ALL ".join(selects) or \
+        "SELECT NULL AS segment, NULL AS id, NULL AS date, NULL AS timestamp, NULL AS host, NULL AS port, " \
+        "NULL AS qname, NULL AS qtype, NULL AS qclass, NULL AS first_changed_byte, NULL AS mdump LIMIT 0"
+    con.execute(f"CREATE TEMP VIEW {LOG_DB_TABLE_NAME} AS SELECT * FROM ({union}) WHERE {condition}")
+    return con
+
+
+def read_requests(directory: str = "/data", start: Timestamp = None, end: Timestamp = None,
+                  columns: str = "*", where: str = "1", params: tuple = ()) -> Iterator[tuple]:
+    """
+    Streams (segment, <columns>) rows of all segments in the time range, segment by segment, without attaching them
+    all at once. `where` is an additional SQL condition on the requests table.
+    """
+    condition = time_range_condition(start, end)
+    for path in select_segments(directory, start, end):
+        segment = os.path.basename(path)
+        try:
+            con = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        except sqlite3.DatabaseError as e:
+            logger.warning(f"Skipping unreadable request log segment {path}: {e}")
+            continue
+        try:
+            cursor = con.execute(
+                f"SELECT {columns} FROM {LOG_DB_TABLE_NAME} WHERE {condition} AND ({where}) ORDER BY id", params)
+            for row in cursor:
+                yield (segment, *row)
+        except sqlite3.DatabaseError as e:
+            logger.warning(f"Skipping unreadable request log segment {path}: {e}")
+        finally:
+            con.close()
+
+
+class Record(NamedTuple):
+    timestamp: float
+    host: str
+    port: int
+    qname: str
+    qtype: str
+    qclass: str
+    first_changed_byte: Optional[int]
+    mdump: bytes
+
+    def row(self) -> tuple:
+        date = str(datetime.datetime.fromtimestamp(self.timestamp))
+        return (date, *self)
+
+
+class RequestLog:
+    """
+    Worker side of the request log. Records are batched locally and put on the queue once `batch_size` records are
+    collected or the oldest is `flush_interval` seconds old; call maybe_flush() periodically so idle workers flush too.
+    """
+
+    def __init__(self, records: multiprocessing.Queue, dropped: multiprocessing.Value, batch_size: int = 64,
+                 flush_interval: float = .5, policy: str = "drop") -> None:
+        if policy not in ("drop", "block"):
+            raise ValueError(f"Unknown request log queue policy {policy!r}")
+        self.records = records
+        self.dropped = dropped
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block = policy == "block"
+        self.batch: List[Record] = []
+        self.deadline = None
+        self.lock = threading.Lock()
+
+    def log(self, record: Record) -> None:
+        with self.lock:
+            self.batch.append(record)
+            if self.deadline is None:
+                self.deadline = time.monotonic() + self.flush_interval
+            if len(self.batch) >= self.batch_size:
+                self._flush()
+
+    def maybe_flush(self) -> None:
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            with self.lock:
+                self._flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        batch, self.batch, self.deadline = self.batch, [], None
+        if not batch:
+            return
+        try:
+            self.records.put(batch, block=self.block)
+        except queue.Full:
+            with self.dropped.get_lock():
+                self.dropped.value += len(batch)
+            logger.warning(f"Request log queue full, dropped {len(batch)} records ({self.dropped.value} in total)")
+
+
+class SqliteLogger(Process):
+    """
+    Writes batches from the queue to the current segment in `directory`. A transaction is committed once `max_rows`
+    rows are pending or the oldest pending row is `max_delay` seconds old. Before each transaction, a new segment is
+    begun if the first pending row falls into a later `rotate_interval` (aligned to the epoch, i.e. full hours by
+    default) or the segment, including its WAL, is larger than `rotate_size` bytes; 0 disables either rule.
+    A None on the queue stops the logger.
+    """
+
+    def __init__(self, directory: str, records: multiprocessing.Queue, dropped: multiprocessing.Value,
+                 max_rows: int = 1000, max_delay: float = 1, rotate_interval: float = 3600,
+                 rotate_size: int = 0) -> None:
+        super(SqliteLogger, self).__init__()
+        self.directory = directory
+        self.records = records
+        self.dropped = dropped
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.rotate_interval = rotate_interval
+        self.rotate_size = rotate_size
+        self.written = 0
+        self.db_name = None
+        self.bucket = None
+
+    def connect(self, start: float) -> sqlite3.Connection:
+        db_name = segment_path(self.directory, start)
+        con = sqlite3.connect(db_name)
+        try:
+            con.execute("PRAGMA journal_mode=WAL;")
+            con.execute("PRAGMA synchronous=NORMAL;")
+            con.execute(SQL_INIT_STMT)
+            con.execute(SQL_INDEX_STMT)
+        except sqlite3.Error:
+            con.close()
+            raise
+        self.db_name, self.bucket = db_name, self.bucket_of(start)  # only once the segment can be written
+        logger.warning(f"SqliteLogger: logging requests to {self.db_name}")
+        return con
+
+    def bucket_of(self, timestamp: float) -> Optional[int]:
+        return int(timestamp // self.rotate_interval) if self.rotate_interval else None
+
+    def size(self) -> int:
+        return sum(os.path.getsize(path) for path in (self.db_name, self.db_name + "-wal") if os.path.exists(path))
+
+    def should_rotate(self, timestamp: float) -> bool:
+        if self.bucket_of(timestamp) != self.bucket:
+            return True
+        return bool(self.rotate_size) and self.size() >= self.rotate_size
+
+    def rotate(self, con: Optional[sqlite3.Connection], timestamp: float) -> sqlite3.Connection:
+        if con is not None:
+            try:
+                con.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+            finally:
+                con.close()
+        return self.connect(timestamp)
+
+    def run(self):
+        con = None
+        rows, deadline = [], None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                batch = self.records.get(timeout=timeout)
+            except queue.Empty:
+                batch = []
+            if batch is None:
+                break
+            rows.extend(record.row() for record in batch)
+            if rows and deadline is None:
+                deadline = time.monotonic() + self.max_delay
+            if len(rows) >= self.max_rows or (deadline is not None and time.monotonic() >= deadline):
+                con = self.write(con, rows)
+                rows, deadline = [], None
+        con = self.write(con, rows)
+        if con is not None:
+            con.close()
+
+    def write(self, con: Optional[sqlite3.Connection], rows: List[tuple]) -> Optional[sqlite3.Connection]:
+        if not rows:
+            return con
+        first_timestamp = rows[0][1]
+        start = time.perf_counter()
+        rotating = False
+        try:
+            if con is None or self.should_rotate(first_timestamp):
+                rotating = True
+                con = self.rotate(con, first_timestamp)
+            with con:
+                con.executemany(SQL_INSERT_STMT, rows)
+        except sqlite3.Error as e:
+            logger.warning(f"SqliteLogger: failed to write {len(rows)} rows to {self.db_name}: {str(e)}")
+            SQLITE_ROWS.labels('failed').inc(len(rows))
+            REPORTER.report()
+            return None if rotating else con  # the old connection is closed: connect again with the next rows
+        SQLITE_INSERT_SECONDS.observe(time.perf_counter() - start)
+        SQLITE_ROWS.labels('written').inc(len(rows))
+        REPORTER.report()
+        self.written += len(rows)
+        logger.debug(f"SqliteLogger: wrote {len(rows)} rows ({self.written} in total, {self.dropped.value} dropped)")
+        return con
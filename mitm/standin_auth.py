@@ -0,0 +1,265 @@
+"""
+A stand-in for the knot authoritative name server of the ns service, for benchmarks and tests of the mitm proxy
+without docker: serves the zone layout of addzones.py (see zonematrix.py) below ZONE over UDP and TCP.
+
+Each test zone has SOA, NS, DNSKEY, A and TXT at the apex, wildcard A and TXT, ns A and the mitm-rs16-rd delegation
+with NS and DS records. RRsets are signed with every algorithm of the zone, using random signatures of realistic
+size (nothing is validated on the way). With --sign, they are signed for real instead, with one key per algorithm
+generated on start and shared by all zones, so that answers validate (see validate.py); RRsets are signed when first
+asked for. DNSKEYs of removed algorithms are left out, as in addzones.py. Denial of existence (NSEC) is not served.
+
+    python3 standin_auth.py [--zone example.com.] [--host 127.0.0.1] [--port 5300] [--sign]
+"""
+import argparse
+import asyncio
+import base64
+import collections
+import logging
+import os
+import struct
+import sys
+from typing import Dict, List, Optional, Tuple
+
+import dns.dnssec
+import dns.dnssecalgs
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from zonematrix import zones as zone_matrix  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+TTL = 60
+CACHE_SIZE = 10000  # rendered answers kept, least recently used ones are dropped first
+IN = dns.rdataclass.IN
+A, NS, SOA, TXT, DS, DNSKEY = (dns.rdatatype.from_text(t) for t in ['A', 'NS', 'SOA', 'TXT', 'DS', 'DNSKEY'])
+
+RSA = (dns.dnssec.RSASHA1, dns.dnssec.RSASHA256, dns.dnssec.RSASHA512)
+# (public key, signature) lengths in bytes
+KEY_SIZES = {
+    dns.dnssec.RSASHA1: (260, 256),
+    dns.dnssec.RSASHA256: (260, 256),
+    dns.dnssec.RSASHA512: (260, 256),
+    dns.dnssec.ECDSAP256SHA256: (64, 64),
+    dns.dnssec.ECDSAP384SHA384: (96, 96),
+    dns.dnssec.ED25519: (32, 64),
+    dns.dnssec.ED448: (57, 114),
+}
+
+
+INCEPTION, EXPIRATION = '20200101000000', '20300101000000'
+
+
+def b64random(length: int) -> str:
+    return base64.b64encode(os.urandom(length)).decode()
+
+
+class Signer:
+    """A key pair per algorithm, for signing RRsets of any zone."""
+
+    def __init__(self, algorithms=KEY_SIZES) -> None:
+        self.keys = {}
+        for a in algorithms:
+            private_cls = dns.dnssecalgs.get_algorithm_cls(a)
+            key = private_cls.generate(key_size=2048) if a in RSA else private_cls.generate()
+            self.keys[a] = key, key.public_key().to_dnskey(flags=257)
+
+    def dnskey(self, algorithm) -> str:
+        return self.keys[algorithm][1].to_text()
+
+    def sign(self, rrset: dns.rrset.RRset, signer: dns.name.Name, algorithm) -> str:
+        key, dnskey = self.keys[algorithm]
+        return dns.dnssec.sign(rrset, key, signer, dnskey, inception=INCEPTION, expiration=EXPIRATION,
+                               policy=dns.dnssec.allow_all_policy).to_text()
+
+
+class Zone:
+
+    def __init__(self, name: dns.name.Name, algorithms, remove_dnskeys, a_record: str, ns_a_record: str,
+                 signer: Optional[Signer] = None) -> None:
+        self.name = name
+        self.algorithms = list(algorithms)
+        self.signer = signer
+        self.signatures: Dict[Tuple[dns.name.Name, int], List[str]] = {}  # with a signer, by owner and type
+        dnskeys = [signer.dnskey(a) if signer else f'257 3 {int(a)} {b64random(KEY_SIZES[a][0])}'
+                   for a in self.algorithms if a not in remove_dnskeys]
+        ns = dns.name.Name(['ns']) + name.parent()
+        self.rrsets: Dict[Tuple[dns.name.Name, int], dns.rrset.RRset] = {}
+        for owner, rdtype, rdatas in [
+            (name, SOA, [f'get.desec.io. get.desec.io. 2021014779 86400 86400 2419200 {TTL}']),
+            (name, NS, [ns.to_text()]),
+            (name, A, [a_record]),
+            (name, TXT, ['"research test zone"']),
+            (name, DNSKEY, dnskeys),
+            (dns.name.Name(['ns']) + name, A, [ns_a_record]),
+            (dns.name.Name(['*']) + name, A, [a_record]),
+            (dns.name.Name(['*']) + name, TXT, ['"research test zone"']),
+            (dns.name.Name(['mitm-rs16-rd']) + name, NS, ['ns1.desec.io.', 'ns2.desec.org.']),
+            (dns.name.Name(['mitm-rs16-rd']) + name, DS, ['29449 13 2 ' + 'ff' * 32, '29449 13 4 ' + 'ff' * 48]),
+        ]:
+            if rdatas:
+                self.rrsets[owner, rdtype] = dns.rrset.from_text_list(owner, TTL, IN, rdtype, rdatas)
+        self.delegation = dns.name.Name(['mitm-rs16-rd']) + name
+
+    def rrsig(self, rrset: dns.rrset.RRset, owner: dns.name.Name) -> dns.rrset.RRset:
+        if self.signer:
+            signatures = self.signatures.get((rrset.name, rrset.rdtype))
+            if signatures is None:
+                signatures = self.signatures[rrset.name, rrset.rdtype] = [
+                    self.signer.sign(rrset, self.name, a) for a in self.algorithms
+                ]
+            return dns.rrset.from_text_list(owner, TTL, IN, dns.rdatatype.RRSIG, signatures)
+        labels = len(rrset.name) - 1 - (rrset.name[0] == b'*')
+        return dns.rrset.from_text_list(owner, TTL, IN, dns.rdatatype.RRSIG, [
+            f'{dns.rdatatype.to_text(rrset.rdtype)} {int(a)} {labels} {TTL} {EXPIRATION} {INCEPTION} '
+            f'{int(a) * 1000} {self.name} {b64random(KEY_SIZES[a][1])}'
+            for a in self.algorithms
+        ])
+
+    def add(self, section: List[dns.rrset.RRset], rrset: dns.rrset.RRset, owner: dns.name.Name, dnssec: bool):
+        answer = dns.rrset.RRset(owner, IN, rrset.rdtype)
+        answer.update(rrset)
+        answer.ttl = rrset.ttl
+        section.append(answer)
+        if dnssec:
+            section.append(self.rrsig(rrset, owner))
+
+    def answer(self, r: dns.message.Message, qname: dns.name.Name, qtype: int, dnssec: bool) -> None:
+        r.flags |= dns.flags.AA
+        if qname.is_subdomain(self.delegation) and not (qname == self.delegation and qtype == DS):
+            r.flags &= ~dns.flags.AA
+            r.authority.append(self.rrsets[self.delegation, NS])
+            self.add(r.authority, self.rrsets[self.delegation, DS], self.delegation, dnssec)
+            return
+        owner = qname
+        if not any(name == qname for name, _ in self.rrsets):
+            owner = dns.name.Name(['*']) + self.name  # wildcard expansion
+        rrset = self.rrsets.get((owner, qtype))
+        if rrset is None:
+            self.add(r.authority, self.rrsets[self.name, SOA], self.name, dnssec)
+            return
+        self.add(r.answer, rrset, qname, dnssec)
+
+
+class StandinAuth:
+
+    def __init__(self, origin: dns.name.Name, a_record: str = '127.0.0.1', ns_a_record: str = '127.0.0.1',
+                 sign: bool = False) -> None:
+        self.origin = origin
+        signer = Signer() if sign else None
+        self.zones = {
+            name: Zone(name, algorithms, remove_dnskeys, a_record, ns_a_record, signer)
+            for algorithms, remove_dnskeys, name in zone_matrix(origin)
+        }
+        # rendered answers with ID 0, by lowercase qname, qtype, flags and size limit
+        self.cache: Dict[tuple, bytes] = collections.OrderedDict()
+
+    def find_zone(self, qname: dns.name.Name) -> Optional[Zone]:
+        while len(qname) > len(self.origin):
+            zone = self.zones.get(qname)
+            if zone is not None:
+                return zone
+            qname = qname.parent()
+        return None
+
+    def render(self, q: dns.message.Message, max_size: int) -> bytes:
+        r = dns.message.make_response(q, our_payload=1232)
+        question = q.question[0]
+        qname = question.name
+        zone = self.find_zone(qname)
+        if zone is None:
+            r.set_rcode(dns.rcode.REFUSED)
+        else:
+            zone.answer(r, qname, question.rdtype, bool(q.ednsflags & dns.flags.DO))
+        try:
+            return r.to_wire(max_size=max_size)
+        except dns.exception.TooBig:
+            r = dns.message.make_response(q, our_payload=1232)
+            r.flags |= dns.flags.TC
+            return r.to_wire()
+
+    def respond(self, query: bytes, udp: bool) -> Optional[bytes]:
+        try:
+            q = dns.message.from_wire(query)
+        except dns.exception.DNSException:
+            return None
+        if len(q.question) != 1:
+            r = dns.message.make_response(q)
+            r.set_rcode(dns.rcode.FORMERR)
+            return r.to_wire()
+        question = q.question[0]
+        max_size = (max(q.payload, 512) if q.edns >= 0 else 512) if udp else 65535
+        key = (question.name.to_text().lower(), question.rdtype, q.flags & (dns.flags.RD | dns.flags.CD), q.edns,
+               q.ednsflags & dns.flags.DO, max_size)
+        answer = self.cache.get(key)
+        if answer is None:
+            q.id = 0
+            answer = self.cache[key] = self.render(q, max_size)
+            if len(self.cache) > CACHE_SIZE:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(key)
+        # copy the ID and the question (with the case of the query) into the cached answer
+        question_end = 12 + len(question.name.to_wire()) + 4
+        return query[:2] + answer[2:12] + query[12:question_end] + answer[question_end:]
+
+    class UDPProtocol(asyncio.DatagramProtocol):
+
+        def __init__(self, server: 'StandinAuth') -> None:
+            self.server = server
+            self.transport = None
+
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def datagram_received(self, data, addr):
+            response = self.server.respond(data, udp=True)
+            if response is not None:
+                self.transport.sendto(response, addr)
+
+    async def handle_tcp(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                length = struct.unpack('!H', await reader.readexactly(2))[0]
+                response = self.respond(await reader.readexactly(length), udp=False)
+                if response is not None:
+                    writer.write(struct.pack('!H', len(response)) + response)
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def main(self, host: str, port: int):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self.UDPProtocol(self), local_addr=(host, port))
+        server = await asyncio.start_server(self.handle_tcp, host, port)
+        logger.warning(f"stand-in auth serving {len(self.zones)} zones below {self.origin} on {host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+    def serve(self, host: str, port: int):
+        asyncio.run(self.main(host, port))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--zone', default=os.environ.get('ZONE', 'example.com.'))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5300)
+    parser.add_argument('--a', default=os.environ.get('A_RR', '127.0.0.1'), help="A record of the test zones")
+    parser.add_argument('--sign', action='store_true', help="sign with real keys instead of random signatures")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    StandinAuth(dns.name.from_text(args.zone), a_record=args.a, sign=args.sign).serve(args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+Supervision of the worker processes of mitm.py. Each worker binds its own SO_REUSEPORT sockets and keeps its own
+request log batch and upstream pool; the supervisor pins worker i to the i-th allowed CPU (round robin), starts a
+worker again when it dies (after a backoff if it keeps dying right after starting) and handles the signals:
+
+The KEY=VALUE lines of ADNSSEC_CONFIG are read into the environment on start and again on SIGHUP, which is then
+passed on to the workers: they apply the settings that can change at runtime (see mitm.configure) in place, on the
+sockets they have open. Workers started later inherit the new environment. The number of workers and the addresses
+need a restart.
+
+SIGTERM (and SIGINT) is passed on as SIGTERM: the workers stop accepting queries, answer those in flight, hand their
+request log batch to the SqliteLogger and exit. Workers still running after the drain timeout are killed.
+"""
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from multiprocessing.connection import wait
+from typing import Callable, Dict, List, Optional
+
+from metrics import REGISTRY, REPORTER
+
+logger = logging.getLogger(__name__)
+
+RESTARTS = REGISTRY.counter('mitm_worker_restarts_total', "Worker processes started again after they died")
+RELOADS = REGISTRY.counter('mitm_reloads_total', "Configuration reloads on SIGHUP, by outcome", ('outcome',))
+
+MIN_UPTIME = 10  # seconds; a worker that dies earlier is started again only after a backoff
+MAX_BACKOFF = 30
+
+
+def read_config(path: str) -> Dict[str, str]:
+    """KEY=VALUE lines, as in a docker env file; empty lines and lines starting with # are skipped."""
+    config = {}
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            key, sep, value = line.partition('=')
+            if not sep:
+                raise ValueError(f"{path}:{number}: expected KEY=VALUE, got {line!r}")
+            config[key.strip()] = value.strip()
+    return config
+
+
+def load_config(path: Optional[str]) -> bool:
+    """Reads the config file into os.environ; False if there is none or it cannot be read."""
+    if not path:
+        return False
+    try:
+        config = read_config(path)
+    except (OSError, ValueError) as e:
+        logger.error(f"Not reloading, cannot read config {path}: {e}")
+        RELOADS.labels('failed').inc()
+        return False
+    os.environ.update(config)
+    RELOADS.labels('ok').inc()
+    return True
+
+
+def pin(slot: int) -> Optional[int]:
+    """Pins the calling process to one of the CPUs it may run on, chosen by slot; returns the CPU."""
+    if not hasattr(os, 'sched_setaffinity'):
+        return None
+    cpus = sorted(os.sched_getaffinity(0))
+    cpu = cpus[slot % len(cpus)]
+    os.sched_setaffinity(0, {cpu})
+    return cpu
+
+
+class Worker:
+
+    def __init__(self, slot: int, target: Callable[[], None]) -> None:
+        self.slot = slot
+        self.target = target
+        self.process: Optional[multiprocessing.Process] = None
+        self.started = 0.0
+        self.failures = 0
+        self.not_before = 0.0
+
+
+class Supervisor:
+
+    def __init__(self, targets: List[Callable[[], None]], pin_cpus: bool = True, drain_timeout: float = 10,
+                 config_path: Optional[str] = None, configure: Callable[[], None] = None) -> None:
+        self.workers = [Worker(slot, target) for slot, target in enumerate(targets)]
+        self.pin_cpus = pin_cpus
+        self.drain_timeout = drain_timeout
+        self.config_path = config_path
+        self.configure = configure
+        self.stop_requested = False
+        self.reload_requested = False
+
+    def run_worker(self, slot: int, target: Callable[[], None]) -> None:
+        # until the worker installs its own handlers: SIGTERM ends it, SIGHUP and SIGINT (to the whole process group
+        # on Ctrl-C) do not, as the supervisor passes them on
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if self.pin_cpus:
+            logger.info(f"worker {slot} in pid {os.getpid()} pinned to CPU {pin(slot)}")
+        target()
+
+    def start(self, worker: Worker) -> None:
+        worker.process = multiprocessing.Process(target=self.run_worker, args=(worker.slot, worker.target),
+                                                 name=f"worker-{worker.slot}")
+        worker.process.start()
+        worker.started = time.monotonic()
+        logger.info(f"Started {worker.process} from pid {os.getpid()}")
+
+    def exited(self, worker: Worker) -> None:
+        worker.process.join()
+        uptime = time.monotonic() - worker.started
+        worker.failures = worker.failures + 1 if uptime < MIN_UPTIME else 0
+        delay = min(MAX_BACKOFF, .5 * 2 ** (worker.failures - 1)) if worker.failures else 0
+        worker.not_before = time.monotonic() + delay
+        logger.error(f"worker {worker.slot} (pid {worker.process.pid}) exited with {worker.process.exitcode} after "
+                     f"{uptime:.1f}s, starting it again in {delay:.1f}s")
+        worker.process = None
+
+    def reload(self) -> None:
+        self.reload_requested = False
+        if load_config(self.config_path) and self.configure:
+            self.configure()
+        logger.warning(f"reloading {len(self.workers)} workers")
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                os.kill(worker.process.pid, signal.SIGHUP)
+
+    def request_stop(self, signum, frame) -> None:
+        self.stop_requested = True
+
+    def request_reload(self, signum, frame) -> None:
+        self.reload_requested = True
+
+    def run(self) -> None:
+        if load_config(self.config_path) and self.configure:
+            self.configure()
+        for worker in self.workers:
+            self.start(worker)
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        signal.signal(signal.SIGHUP, self.request_reload)
+        while not self.stop_requested:
+            if self.reload_requested:
+                self.reload()
+            running = {worker.process.sentinel: worker for worker in self.workers if worker.process is not None}
+            for sentinel in wait(list(running), timeout=.5):
+                self.exited(running[sentinel])
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.process is None and now >= worker.not_before and not self.stop_requested:
+                    self.start(worker)
+                    RESTARTS.inc()
+            REPORTER.maybe_report()
+        self.drain()
+
+    def drain(self) -> None:
+        running = [worker.process for worker in self.workers if worker.process is not None]
+        logger.warning(f"draining {len(running)} workers")
+        for process in running:
+            process.terminate()
+        deadline = time.monotonic() + self.drain_timeout
+        for process in running:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.error(f"{process} did not drain in {self.drain_timeout}s, killing it")
+                process.kill()
+                process.join()
+        REPORTER.report()
@@ -0,0 +1,445 @@
+"""
+Persistent connections from the mitm proxy to the authoritative name server.
+
+Queries are forwarded as raw wire bytes. Several queries share one upstream TCP connection (RFC 7766 pipelining);
+their message IDs are rewritten to be unique per connection and restored on the way back, so responses can arrive
+in any order. Optionally, queries are sent over UDP first and retried over TCP if the answer comes back truncated;
+queries of clients that asked over UDP can instead get the truncated answer, as they would retry over TCP anyway.
+
+UpstreamPool is used by the blocking socketserver handlers, AsyncUpstreamPool by the asyncio serving mode.
+"""
+import asyncio
+import itertools
+import logging
+import queue
+import random
+import socket
+import struct
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import dns.exception
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_SIZE = 65535
+
+
+class UpstreamError(ConnectionError):
+    pass
+
+
+class UpstreamStats:
+    FIELDS = ('queries', 'hits', 'misses', 'reconnects', 'udp_queries', 'tc_fallbacks', 'tc_passed', 'timeouts',
+              'errors')
+
+    def __init__(self, log_interval: float = 60) -> None:
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+        self.log_interval = log_interval
+        self.last_logged = time.monotonic()
+        self.lock = threading.Lock()  # the blocking pool counts from many handler threads
+
+    def count(self, field: str) -> None:
+        with self.lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def as_dict(self) -> Dict[str, int]:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def __str__(self) -> str:
+        return ", ".join(f"{k}={v}" for k, v in self.as_dict().items())
+
+    def maybe_log(self) -> None:
+        now = time.monotonic()
+        with self.lock:
+            if not self.log_interval or now - self.last_logged < self.log_interval:
+                return
+            self.last_logged = now
+        logger.warning(f"upstream pool stats: {self}")
+
+
+class Backoff:
+    """Exponential backoff with jitter for (re)connecting to the upstream."""
+
+    def __init__(self, initial: float = .05, maximum: float = 5) -> None:
+        self.initial = initial
+        self.maximum = maximum
+        self.failures = 0
+        self.not_before = 0
+
+    def failure(self) -> None:
+        delay = min(self.maximum, self.initial * 2 ** self.failures)
+        self.failures += 1
+        self.not_before = time.monotonic() + delay * random.uniform(.5, 1)
+
+    def success(self) -> None:
+        self.failures = 0
+        self.not_before = 0
+
+    def check(self) -> None:
+        if time.monotonic() < self.not_before:
+            raise UpstreamError(f"upstream unavailable, backing off after {self.failures} failed attempt(s)")
+
+
+def get_id(wire: bytes) -> int:
+    return struct.unpack_from('!H', wire)[0]
+
+
+def set_id(wire: bytes, message_id: int) -> bytes:
+    return struct.pack('!H', message_id) + wire[2:]
+
+
+def is_truncated(wire: bytes) -> bool:
+    return bool(wire[2] & 0x02)
+
+
+def recv_exactly(sock: socket.socket, length: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < length:
+        chunk = sock.recv(length - len(buf))
+        if not chunk:
+            raise UpstreamError("upstream closed the connection")
+        buf += chunk
+    return bytes(buf)
+
+
+class TCPConnection:
+    """A blocking upstream TCP connection with one query in flight at a time."""
+
+    def __init__(self, host: str, port: int, timeout: float) -> None:
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def query(self, wire: bytes, timeout: float) -> bytes:
+        self.sock.settimeout(timeout)
+        self.sock.sendall(struct.pack('!H', len(wire)) + wire)
+        message_id = get_id(wire)
+        while True:
+            length = struct.unpack('!H', recv_exactly(self.sock, 2))[0]
+            response = recv_exactly(self.sock, length)
+            if get_id(response) == message_id:
+                return response
+            logger.debug(f"discarding stale upstream response {get_id(response)}")
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+class UpstreamPool:
+    """
+    Keeps up to `size` idle upstream TCP connections per worker process (none for size 0, i.e. one connection per
+    query). Thread-safe; if more queries are in flight
+    than connections are idle, extra connections are opened and closed again when the pool is full.
+    """
+
+    def __init__(self, host: str, port: int, size: int = 1, timeout: float = 1, udp: bool = False,
+                 stats: UpstreamStats = None) -> None:
+        self.host, self.port = host, port
+        self.size = size
+        self.timeout = timeout
+        self.udp = udp
+        self.stats = stats or UpstreamStats()
+        self.idle = queue.LifoQueue()
+        self.backoff = Backoff()
+        self.lock = threading.Lock()
+
+    def query(self, wire: bytes, truncated_ok: bool = False) -> bytes:
+        """Forwards a query; with truncated_ok, a truncated answer over UDP is returned instead of retried over TCP."""
+        self.stats.count('queries')
+        try:
+            if self.udp:
+                response = self.query_udp(wire)
+                if not is_truncated(response):
+                    return response
+                if truncated_ok:
+                    self.stats.count('tc_passed')
+                    return response
+                self.stats.count('tc_fallbacks')
+            return self.query_tcp(wire)
+        finally:
+            self.stats.maybe_log()
+
+    def query_udp(self, wire: bytes) -> bytes:
+        self.stats.count('udp_queries')
+        message_id = get_id(wire)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect((self.host, self.port))
+            sock.send(wire)
+            deadline = time.monotonic() + self.timeout
+            while True:
+                sock.settimeout(max(deadline - time.monotonic(), 0.001))
+                try:
+                    response = sock.recv(MAX_MESSAGE_SIZE)
+                except socket.timeout:
+                    self.stats.count('timeouts')
+                    raise dns.exception.Timeout
+                except OSError as e:
+                    self.stats.count('errors')
+                    raise UpstreamError(f"upstream {self.host}:{self.port} over UDP: {e}")
+                if len(response) >= 12 and get_id(response) == message_id:
+                    return response
+
+    def query_tcp(self, wire: bytes) -> bytes:
+        # A reused connection may have been closed by the upstream in the meantime; retry once on a fresh one.
+        for attempt in range(2):
+            connection, reused = self.checkout()
+            try:
+                response = connection.query(wire, self.timeout)
+            except socket.timeout:
+                self.stats.count('timeouts')
+                connection.close()
+                raise dns.exception.Timeout
+            except (OSError, UpstreamError) as e:
+                connection.close()
+                if not reused or attempt:
+                    self.stats.count('errors')
+                    raise e if isinstance(e, UpstreamError) else UpstreamError(f"upstream query failed: {e}")
+                self.stats.count('reconnects')
+                continue
+            self.checkin(connection)
+            return response
+
+    def checkout(self) -> Tuple[TCPConnection, bool]:
+        try:
+            connection = self.idle.get_nowait()
+            self.stats.count('hits')
+            return connection, True
+        except queue.Empty:
+            pass
+        self.stats.count('misses')
+        with self.lock:
+            try:
+                self.backoff.check()
+            except UpstreamError:
+                self.stats.count('errors')
+                raise
+            try:
+                connection = TCPConnection(self.host, self.port, self.timeout)
+            except OSError as e:
+                self.backoff.failure()
+                if isinstance(e, socket.timeout):
+                    self.stats.count('timeouts')
+                    raise dns.exception.Timeout
+                self.stats.count('errors')
+                raise UpstreamError(f"cannot connect to upstream {self.host}:{self.port}: {e}")
+            self.backoff.success()
+        return connection, False
+
+    def checkin(self, connection: TCPConnection) -> None:
+        if self.idle.qsize() < self.size:
+            self.idle.put(connection)
+        else:
+            connection.close()
+
+
+class _Multiplexer:
+    """Matches responses to in-flight queries by (rewritten) message ID."""
+
+    def __init__(self, stats: UpstreamStats) -> None:
+        self.stats = stats
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.closed = False
+
+    def allocate_id(self) -> int:
+        if len(self.pending) >= 0x10000:
+            raise UpstreamError("no free message IDs on upstream connection")
+        while True:
+            message_id = random.getrandbits(16)
+            if message_id not in self.pending:
+                return message_id
+
+    def send(self, wire: bytes) -> None:
+        raise NotImplementedError
+
+    async def query(self, wire: bytes, timeout: float) -> bytes:
+        original_id = get_id(wire)
+        message_id = self.allocate_id()
+        future = asyncio.get_running_loop().create_future()
+        self.pending[message_id] = future
+        try:
+            self.send(set_id(wire, message_id))
+            response = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.stats.count('timeouts')
+            raise dns.exception.Timeout
+        finally:
+            self.pending.pop(message_id, None)
+        return set_id(response, original_id)
+
+    def response_received(self, response: bytes) -> None:
+        if len(response) < 12:
+            return
+        future = self.pending.pop(get_id(response), None)
+        if future is not None and not future.done():
+            future.set_result(response)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.closed = True
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(UpstreamError(f"upstream connection lost: {exc}"))
+        self.pending.clear()
+
+
+class AsyncTCPConnection(_Multiplexer):
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, stats: UpstreamStats) -> None:
+        super().__init__(stats)
+        self.reader, self.writer = reader, writer
+        self.reader_task = asyncio.ensure_future(self.read_loop())
+
+    @classmethod
+    async def connect(cls, host: str, port: int, timeout: float, stats: UpstreamStats) -> 'AsyncTCPConnection':
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return cls(reader, writer, stats)
+
+    def close(self) -> None:
+        self.reader_task.cancel()
+        self.writer.close()
+
+    def send(self, wire: bytes) -> None:
+        if self.closed:
+            raise UpstreamError("upstream connection is closed")
+        self.writer.write(struct.pack('!H', len(wire)) + wire)
+
+    async def read_loop(self) -> None:
+        exc = None
+        try:
+            while True:
+                length = struct.unpack('!H', await self.reader.readexactly(2))[0]
+                self.response_received(await self.reader.readexactly(length))
+        except (asyncio.IncompleteReadError, OSError) as e:
+            exc = e
+        finally:
+            self.connection_lost(exc)
+            self.writer.close()
+
+
+class AsyncUDPChannel(_Multiplexer, asyncio.DatagramProtocol):
+
+    def __init__(self, stats: UpstreamStats) -> None:
+        super().__init__(stats)
+        self.transport = None
+
+    @classmethod
+    async def connect(cls, host: str, port: int, stats: UpstreamStats) -> 'AsyncUDPChannel':
+        _, channel = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: cls(stats), remote_addr=(host, port))
+        return channel
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        self.response_received(data)
+
+    def error_received(self, exc: Exception) -> None:
+        logger.debug(f"upstream UDP error: {exc}")
+
+    def send(self, wire: bytes) -> None:
+        self.transport.sendto(wire)
+
+
+class AsyncUpstreamPool:
+    """
+    Spreads queries round-robin over `size` pipelined upstream TCP connections of one event loop. Broken connections
+    are re-established on demand, with exponential backoff if the upstream is unreachable.
+    """
+
+    def __init__(self, host: str, port: int, size: int = 1, timeout: float = 1, udp: bool = False,
+                 stats: UpstreamStats = None) -> None:
+        self.host, self.port = host, port
+        self.timeout = timeout
+        self.udp = udp
+        self.stats = stats or UpstreamStats()
+        self.connections: List[Optional[AsyncTCPConnection]] = [None] * size
+        self.locks = [asyncio.Lock() for _ in range(size)]
+        self.backoffs = [Backoff() for _ in range(size)]
+        self.slots = itertools.cycle(range(size))
+        self.udp_channel: Optional[AsyncUDPChannel] = None
+
+    async def query(self, wire: bytes, truncated_ok: bool = False) -> bytes:
+        self.stats.count('queries')
+        try:
+            if self.udp:
+                response = await self.query_udp(wire)
+                if not is_truncated(response):
+                    return response
+                if truncated_ok:
+                    self.stats.count('tc_passed')
+                    return response
+                self.stats.count('tc_fallbacks')
+            return await self.query_tcp(wire)
+        finally:
+            self.stats.maybe_log()
+
+    async def query_udp(self, wire: bytes) -> bytes:
+        self.stats.count('udp_queries')
+        if self.udp_channel is None or self.udp_channel.closed:
+            try:
+                self.udp_channel = await AsyncUDPChannel.connect(self.host, self.port, self.stats)
+            except OSError as e:
+                self.stats.count('errors')
+                raise UpstreamError(f"cannot connect to upstream {self.host}:{self.port} over UDP: {e}")
+        return await self.udp_channel.query(wire, self.timeout)
+
+    async def query_tcp(self, wire: bytes) -> bytes:
+        if not self.connections:
+            return await self.query_oneshot(wire)
+        # The upstream may close an idle connection just as we pipeline onto it; retry once on a fresh one.
+        slot = next(self.slots)
+        for attempt in range(2):
+            connection = None
+            try:
+                connection = await self.connection(slot)
+                return await connection.query(wire, self.timeout)
+            except (OSError, UpstreamError):
+                if attempt:
+                    if connection is not None:  # failures to connect are counted by connection()
+                        self.stats.count('errors')
+                    raise
+
+    async def query_oneshot(self, wire: bytes) -> bytes:
+        """Without pooled connections (size 0), every query gets a connection of its own."""
+        self.stats.count('misses')
+        try:
+            connection = await AsyncTCPConnection.connect(self.host, self.port, self.timeout, self.stats)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.stats.count('errors')
+            raise UpstreamError(f"cannot connect to upstream {self.host}:{self.port}: {e}")
+        try:
+            return await connection.query(wire, self.timeout)
+        finally:
+            connection.close()
+
+    async def connection(self, slot: int) -> AsyncTCPConnection:
+        connection = self.connections[slot]
+        if connection is not None and not connection.closed:
+            self.stats.count('hits')
+            return connection
+        async with self.locks[slot]:
+            connection = self.connections[slot]
+            if connection is not None and not connection.closed:
+                self.stats.count('hits')
+                return connection
+            self.stats.count('misses')
+            if connection is not None:
+                self.stats.count('reconnects')
+            backoff = self.backoffs[slot]
+            try:
+                backoff.check()
+                connection = await AsyncTCPConnection.connect(self.host, self.port, self.timeout, self.stats)
+            except UpstreamError:
+                self.stats.count('errors')
+                raise
+            except (OSError, asyncio.TimeoutError) as e:
+                backoff.failure()
+                self.stats.count('errors')
+                raise UpstreamError(f"cannot connect to upstream {self.host}:{self.port}: {e}")
+            backoff.success()
+            self.connections[slot] = connection
+            return connection
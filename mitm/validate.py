@@ -0,0 +1,450 @@
+"""
+Offline DNSSEC validation of the answers of the proxy: tells for every query whether its upstream answer and its
+filtered answer would be secure, insecure or bogus for a validating resolver, without going through one.
+
+    python3 validate.py log /data [more logs ...] [--start ...] [--end ...] --auth 127.0.0.1:53 --out verdicts.csv
+    python3 validate.py dumps /data/dumps.jsonl --auth 127.0.0.1:53 --out verdicts.parquet
+
+`log` takes the queries of request logs (their mdump column, see replay.py for the paths), asks the auth NS for the
+upstream answer of every distinct query and filters it as the proxy does (filters.py) if the row has a
+first_changed_byte. `dumps` takes the upstream and final answers that digest() captured in the dump file (dumps.py).
+Either way, the DNSKEY RRsets of the zones are fetched from the auth NS.
+
+The zones are those of the matrix of addzones.py (see zonematrix.py) below --zone; each has DS records for the
+algorithms in its name, of which the simulated resolver supports those in --algorithms (default: all). Following
+RFC 4035 section 5 and RFC 6840 section 5.11, an answer is
+  insecure      if none of the zone's DS algorithms is supported,
+  bogus         if no DNSKEY of a supported DS algorithm validates the zone's DNSKEY RRset, or if an RRset of the
+                answer or authority section (except the NS RRset of a delegation) has no RRSIG that validates with
+                one of these DNSKEYs,
+  secure        otherwise, and
+  indeterminate if it has no RRsets to validate, cannot be parsed or is not from a zone of the matrix.
+Denial of existence and wildcard expansion are not checked: the zones are not served with NSEC. Signatures are checked
+against --now (default: the current time) rather than the time of the query.
+
+The answers are validated in chunks by a pool of --processes worker processes. Each of them caches per zone the
+parsed public keys and the outcome of every (RRset, RRSIG) verification, and the verdict of every distinct answer, so
+repeated answers cost a lookup; chunks hold the rows of one zone, for the caches of the process that gets them. The
+verdicts, one row per query, are written as CSV or, for an --out file ending in .parquet, as Parquet (requires
+pyarrow).
+"""
+import argparse
+import base64
+import collections
+import csv
+import json
+import logging
+import multiprocessing
+import time
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+import dns.dnssec
+import dns.dnssecalgs
+import dns.exception
+import dns.message
+import dns.name
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+from cryptography.exceptions import InvalidSignature
+
+import filters
+from replay import merged_rows, timestamp
+from standin_auth import zone_matrix
+from upstream import UpstreamError, UpstreamPool
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+NS, DNSKEY, RRSIG = dns.rdatatype.NS, dns.rdatatype.DNSKEY, dns.rdatatype.RRSIG
+ALGORITHMS = sorted({int(a) for algos, _, _ in zone_matrix(dns.name.root) for a in algos})
+CHUNK_SIZE = 256
+ANSWER_CACHE_SIZE = 100000  # verdicts of distinct answers, per process
+VERIFIED_CACHE_SIZE = 100000  # outcomes of (RRset, RRSIG) verifications, per zone and process
+
+COLUMNS = ['source', 'id', 'timestamp', 'qname', 'qtype', 'zone', 'first_changed_byte', 'upstream_verdict',
+           'upstream_reason', 'final_verdict', 'final_reason', 'final_algorithms']
+
+
+class Item(NamedTuple):
+    """A query to validate the answers of; answers that are None are fetched (upstream) or filtered (final)."""
+    source: str  # segment or dump file
+    id: int  # in the source
+    timestamp: float
+    qname: str
+    qtype: str
+    first_changed_byte: Optional[int]
+    filtered: bool  # whether the proxy filtered the upstream answer
+    query: Optional[bytes]
+    upstream: Optional[bytes]
+    final: Optional[bytes]
+
+
+class Verdict(NamedTuple):
+    verdict: str
+    reason: str = ''
+    algorithms: str = ''  # of the RRSIGs that validated, e.g. '8,13'
+    zone: Optional[str] = None
+
+
+class Zone:
+
+    def __init__(self, name: dns.name.Name, ds_algorithms: Set[int], supported: Set[int]) -> None:
+        self.name = name
+        self.ds_algorithms = ds_algorithms
+        self.supported = ds_algorithms & supported
+        self.keys: Dict[Tuple[int, int], list] = {}  # (key tag, algorithm) -> parsed public keys of trusted DNSKEYs
+        self.error: Optional[str] = None  # why the DNSKEY RRset did not validate
+        self.verified: Dict[tuple, bool] = {}
+
+
+class Validator:
+    """The validation of the answers in one process, with its caches."""
+
+    def __init__(self, auth: Tuple[str, int], origin: dns.name.Name, algorithms: Iterable[int] = ALGORITHMS,
+                 now: Optional[float] = None) -> None:
+        self.auth = auth
+        self.pool: Optional[UpstreamPool] = None
+        self.algorithms = set(algorithms)
+        self.now = now or time.time()
+        self.ds_algorithms = {name: {int(a) for a in algos} for algos, _, name in zone_matrix(origin)}
+        self.zones: Dict[dns.name.Name, Zone] = {}
+        self.answers: Dict[bytes, Verdict] = {}
+        self.upstream_answers: Dict[bytes, bytes] = {}
+        self.filtered_answers: Dict[bytes, bytes] = {}
+        self.stats = collections.Counter()
+
+    def query(self, wire: bytes) -> bytes:
+        if self.pool is None:  # in the worker process
+            self.pool = UpstreamPool(*self.auth, size=1, timeout=2)
+        return self.pool.query(wire)
+
+    def find_zone(self, qname: dns.name.Name) -> Optional[dns.name.Name]:
+        while len(qname) > 1:
+            if qname in self.ds_algorithms:
+                return qname
+            qname = qname.parent()
+        return None
+
+    def zone(self, name: dns.name.Name) -> Zone:
+        zone = self.zones.get(name)
+        if zone is None:
+            zone = self.zones[name] = Zone(name, self.ds_algorithms[name], self.algorithms)
+            if zone.supported:
+                self.load_keys(zone)
+        return zone
+
+    def load_keys(self, zone: Zone) -> None:
+        """Trusts the DNSKEYs of supported DS algorithms that sign the DNSKEY RRset, as for a DS match."""
+        self.stats['dnskey queries'] += 1
+        try:
+            r = dns.message.from_wire(self.query(dns.message.make_query(zone.name, DNSKEY, want_dnssec=True).to_wire()))
+        except (UpstreamError, OSError, dns.exception.DNSException) as e:
+            zone.error = f"cannot get DNSKEY: {e}"
+            return
+        dnskeys = r.get_rrset(r.answer, zone.name, dns.rdataclass.IN, DNSKEY)
+        rrsigs = r.get_rrset(r.answer, zone.name, dns.rdataclass.IN, RRSIG, DNSKEY)
+        if dnskeys is None:
+            zone.error = "no DNSKEY RRset"
+            return
+        candidates = collections.defaultdict(list)
+        for dnskey in dnskeys:
+            if dnskey.algorithm in zone.supported:
+                try:
+                    public_key = dns.dnssecalgs.get_algorithm_cls_from_dnskey(dnskey).public_cls.from_dnskey(dnskey)
+                except (ValueError, dns.dnssec.UnsupportedAlgorithm):
+                    continue
+                candidates[dns.dnssec.key_id(dnskey), dnskey.algorithm].append(public_key)
+        if not candidates:
+            zone.error = f"no DNSKEY of DS algorithms {sorted(zone.supported)}"
+            return
+        zone.keys = candidates
+        for rrsig in rrsigs or ():
+            if self.check(zone, dnskeys, rrsig) is None:
+                return
+        zone.keys = {}
+        zone.error = f"DNSKEY RRset not signed by a DNSKEY of DS algorithms {sorted(zone.supported)}"
+
+    def check(self, zone: Zone, rrset: dns.rrset.RRset, rrsig) -> Optional[str]:
+        """Verifies the RRSIG over the RRset with the zone's trusted keys; returns why it does not validate."""
+        if rrsig.signer != zone.name:
+            return f"signer {rrsig.signer}"
+        if rrsig.algorithm not in zone.supported:
+            return "algorithm not supported"
+        keys = zone.keys.get((rrsig.key_tag, rrsig.algorithm))
+        if not keys:
+            return f"no DNSKEY with tag {rrsig.key_tag}"
+        if rrsig.expiration < self.now:
+            return "expired"
+        if rrsig.inception > self.now:
+            return "not yet valid"
+        # not public API, hence dnspython is pinned to 2.x in requirements.txt
+        data = dns.dnssec._make_rrsig_signature_data(rrset, rrsig)
+        key = (data, rrsig.signature)
+        valid = zone.verified.get(key)
+        if valid is None:
+            self.stats['verifications'] += 1
+            valid = False
+            for public_key in keys:
+                try:
+                    public_key.verify(rrsig.signature, data)
+                except (InvalidSignature, ValueError):
+                    continue
+                valid = True
+                break
+            if len(zone.verified) >= VERIFIED_CACHE_SIZE:
+                zone.verified.clear()
+            zone.verified[key] = valid
+        else:
+            self.stats['verifications cached'] += 1
+        return None if valid else "invalid signature"
+
+    def validate(self, answer: Optional[bytes]) -> Verdict:
+        if answer is None:
+            return Verdict('indeterminate', "no answer")
+        verdict = self.answers.get(answer[2:])
+        if verdict is not None:
+            self.stats['answers cached'] += 1
+            return verdict
+        self.stats['answers validated'] += 1
+        verdict = self.validate_answer(answer)
+        if len(self.answers) >= ANSWER_CACHE_SIZE:
+            self.answers.clear()
+        self.answers[answer[2:]] = verdict
+        return verdict
+
+    def validate_answer(self, answer: bytes) -> Verdict:
+        try:
+            a = dns.message.from_wire(answer)
+        except dns.exception.DNSException as e:
+            return Verdict('indeterminate', f"cannot parse: {e}")
+        if not a.question:
+            return Verdict('indeterminate', "no question")
+        name = self.find_zone(a.question[0].name)
+        if name is None:
+            return Verdict('indeterminate', "not a zone of the matrix")
+        zone = self.zone(name)
+        if not zone.supported:
+            return Verdict('insecure', f"DS algorithms {sorted(zone.ds_algorithms)} not supported", '', name.to_text())
+        if zone.error:
+            return Verdict('bogus', zone.error, '', name.to_text())
+
+        rrsigs = collections.defaultdict(list)
+        rrsets = []
+        for section in (a.answer, a.authority):
+            for rrset in section:
+                if rrset.rdtype == RRSIG:
+                    rrsigs[rrset.name, rrset.covers].extend(rrset)
+                elif not (section is a.authority and rrset.rdtype == NS and rrset.name != zone.name):
+                    rrsets.append(rrset)
+        if not rrsets:
+            return Verdict('indeterminate', "nothing to validate", '', name.to_text())
+        failures, algorithms = [], set()
+        for rrset in rrsets:
+            valid, errors = False, []
+            for rrsig in rrsigs.get((rrset.name, rrset.rdtype), ()):
+                error = self.check(zone, rrset, rrsig)
+                if error is None:
+                    valid = True
+                    algorithms.add(rrsig.algorithm)
+                else:
+                    errors.append(f"{rrsig.algorithm}/{rrsig.key_tag}: {error}")
+            if not valid:
+                failures.append(f"{rrset.name} {dns.rdatatype.to_text(rrset.rdtype)}: "
+                                f"{', '.join(errors) if errors else 'no RRSIG'}")
+        algorithms = ",".join(str(int(a)) for a in sorted(algorithms))
+        if failures:
+            return Verdict('bogus', "; ".join(failures), algorithms, name.to_text())
+        return Verdict('secure', '', algorithms, name.to_text())
+
+    def upstream(self, query: bytes) -> Optional[bytes]:
+        answer = self.upstream_answers.get(query[2:])
+        if answer is None:
+            self.stats['upstream queries'] += 1
+            try:
+                answer = self.query(query)
+            except (UpstreamError, OSError, dns.exception.DNSException) as e:
+                logger.warning(f"cannot get the upstream answer: {e}")
+                return None
+            if len(self.upstream_answers) >= ANSWER_CACHE_SIZE:
+                self.upstream_answers.clear()
+            self.upstream_answers[query[2:]] = answer
+        return query[:2] + answer[2:]
+
+    def filter(self, upstream: bytes) -> bytes:
+        """The upstream answer filtered as by the proxy."""
+        final = self.filtered_answers.get(upstream[2:])
+        if final is None:
+            a = dns.message.from_wire(upstream)
+            filters.filter_response(a)
+            final = a.to_wire(want_shuffle=False)
+            if len(self.filtered_answers) >= ANSWER_CACHE_SIZE:
+                self.filtered_answers.clear()
+            self.filtered_answers[upstream[2:]] = final
+        return upstream[:2] + final[2:]
+
+    def row(self, item: Item) -> dict:
+        upstream, final = item.upstream, item.final
+        if upstream is None and item.query is not None:
+            upstream = self.upstream(item.query)
+        if final is None and upstream is not None:
+            final = self.filter(upstream) if item.filtered else upstream
+        upstream_verdict, final_verdict = self.validate(upstream), self.validate(final)
+        return dict(
+            source=item.source, id=item.id, timestamp=item.timestamp, qname=item.qname, qtype=item.qtype,
+            zone=final_verdict.zone or upstream_verdict.zone, first_changed_byte=item.first_changed_byte,
+            upstream_verdict=upstream_verdict.verdict, upstream_reason=upstream_verdict.reason,
+            final_verdict=final_verdict.verdict, final_reason=final_verdict.reason,
+            final_algorithms=final_verdict.algorithms,
+        )
+
+
+VALIDATOR: Optional[Validator] = None  # of the worker process
+
+
+def init_worker(*args) -> None:
+    global VALIDATOR
+    VALIDATOR = Validator(*args)
+
+
+def validate_chunk(items: List[Item]) -> Tuple[List[dict], collections.Counter]:
+    VALIDATOR.stats.clear()
+    return [VALIDATOR.row(item) for item in items], VALIDATOR.stats.copy()
+
+
+def zone_key(qname: str) -> str:
+    """The qname without its first label, which is the zone for the queries of the test setup."""
+    return qname.partition('.')[2].lower()
+
+
+def chunks(items: Iterable[Item], size: int = CHUNK_SIZE) -> Iterator[List[Item]]:
+    """Groups the items by zone into chunks of up to size items; a zone's chunk is sent when full, the rest at the end.
+    """
+    pending = collections.defaultdict(list)
+    for item in items:
+        chunk = pending[zone_key(item.qname)]
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            pending[zone_key(item.qname)] = []
+    yield from (chunk for chunk in pending.values() if chunk)
+
+
+def log_items(paths: List[str], start=None, end=None) -> Iterator[Item]:
+    for timestamp_, segment, row_id, host, qname, qtype, first_changed_byte, mdump in merged_rows(paths, start, end):
+        if mdump:
+            yield Item(segment, row_id, timestamp_, qname, qtype, first_changed_byte, first_changed_byte is not None,
+                       mdump, None, None)
+
+
+def from_dump(fields: dict, key: str) -> Optional[bytes]:
+    if fields.get(f'{key}_wire'):
+        return base64.b64decode(fields[f'{key}_wire'])
+    if fields.get(key):  # dumps written before the wire was dumped, too
+        return dns.message.from_text(fields[key]).to_wire(want_shuffle=False)
+    return None
+
+
+def dump_items(paths: List[str]) -> Iterator[Item]:
+    for path in paths:
+        with open(path) as f:
+            for number, line in enumerate(f, 1):
+                try:
+                    fields = json.loads(line)
+                    question = dns.message.from_text(fields['query']).question[0]
+                    upstream = from_dump(fields, 'upstream')
+                    final = from_dump(fields, 'final') or upstream
+                except (ValueError, KeyError, IndexError, dns.exception.DNSException) as e:
+                    logger.warning(f"{path}:{number}: skipping malformed dump: {e}")
+                    continue
+                yield Item(path, number, fields.get('time'), fields.get('qname', question.name.to_text()),
+                           dns.rdatatype.to_text(question.rdtype), fields.get('first_changed_byte'), final != upstream,
+                           None, upstream, final)
+
+
+class Writer:
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.parquet = path.endswith('.parquet')
+        if self.parquet:
+            if pyarrow is None:
+                raise SystemExit("Writing Parquet requires pyarrow")
+            self.schema = pyarrow.schema([
+                (column, pyarrow.int64() if column in ('id', 'first_changed_byte') else
+                 pyarrow.float64() if column == 'timestamp' else pyarrow.string())
+                for column in COLUMNS
+            ])
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression='zstd')
+        else:
+            self.file = open(path, 'w', newline='')
+            self.writer = csv.DictWriter(self.file, COLUMNS)
+            self.writer.writeheader()
+
+    def write(self, rows: List[dict]) -> None:
+        if self.parquet:
+            self.writer.write_table(pyarrow.Table.from_pylist(rows, schema=self.schema))
+        else:
+            self.writer.writerows(rows)
+
+    def close(self) -> None:
+        if self.parquet:
+            self.writer.close()
+        else:
+            self.file.close()
+
+
+def run(items: Iterable[Item], writer: Optional[Writer], processes: int, *validator_args) -> Tuple[
+        collections.Counter, collections.Counter]:
+    """Validates the items in a pool of processes; returns the counts of (upstream, final) verdicts and the stats."""
+    verdicts, stats = collections.Counter(), collections.Counter()
+    with multiprocessing.Pool(processes, initializer=init_worker, initargs=validator_args) as pool:
+        for rows, chunk_stats in pool.imap_unordered(validate_chunk, chunks(items)):
+            for row in rows:
+                verdicts[row['upstream_verdict'], row['final_verdict']] += 1
+            stats.update(chunk_stats)
+            if writer is not None:
+                writer.write(rows)
+    return verdicts, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['log', 'dumps'])
+    parser.add_argument('paths', nargs='+', help="log: request log directories or segment files; dumps: dump files")
+    parser.add_argument('--auth', default='127.0.0.1:53', help="address of the auth NS, for DNSKEYs and answers")
+    parser.add_argument('--zone', default='example.com.', help="origin of the zone matrix")
+    parser.add_argument('--algorithms', default=",".join(map(str, ALGORITHMS)),
+                        help="algorithms the simulated resolver supports, comma-separated numbers")
+    parser.add_argument('--now', type=timestamp, help="time to check the signatures' validity against")
+    parser.add_argument('--start', type=timestamp, help="log: rows from this time (timestamp or ISO format) on")
+    parser.add_argument('--end', type=timestamp, help="log: and before this time")
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--out', default='verdicts.csv', help="verdict table, .csv or .parquet")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    host, _, port = args.auth.rpartition(':')
+    items = log_items(args.paths, args.start, args.end) if args.command == 'log' else dump_items(args.paths)
+    writer = Writer(args.out)
+    start = time.perf_counter()
+    try:
+        verdicts, stats = run(items, writer, args.processes, (host, int(port)), dns.name.from_text(args.zone),
+                              [int(a) for a in args.algorithms.split(',')], args.now)
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - start
+    total = sum(verdicts.values())
+    logger.info(f"validated the answers to {total} queries in {elapsed:.1f}s ({total / elapsed:.0f}/s), "
+                f"wrote {args.out}; {', '.join(f'{k}={v}' for k, v in sorted(stats.items()))}")
+    for (upstream, final), count in sorted(verdicts.items()):
+        print(f"upstream {upstream:13} final {final:13} {count}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,524 @@
+"""
+Rewrites upstream answers directly on the wire, as an alternative to filters.filter_response.
+
+The upstream answer is parsed once into an index of RRsets (offsets only). The instruction codes of the query's
+compiled Plan are applied to the RRsets they affect, and the answer is then spliced together in one output buffer:
+untouched parts are copied from the upstream answer, with compression pointers moved where data before their
+target changed length. The result is byte-for-byte what the dnspython path (with RR shuffling disabled) produces,
+including its quirks: every rebuilt RRset gets TTL 0, and identical RRs in an RRset are merged.
+
+Answers whose layout dnspython would not reproduce unchanged (RRs of one RRset spread out, differing TTLs within an
+RRset, OPT not at the end, TSIG, names not compressed the way dnspython compresses them, types whose rdata may hold
+names this module does not know about, compression pointers into removed data, ...) raise WireFallback, whether or
+not an instruction applies to them; use the dnspython path for those.
+"""
+import os
+import struct
+from typing import Callable, Dict, List, Optional, Tuple
+
+import filters
+
+TYPE_NS, TYPE_CNAME, TYPE_SOA, TYPE_PTR, TYPE_MX, TYPE_TXT, TYPE_A, TYPE_DS, TYPE_RRSIG = 2, 5, 6, 12, 15, 16, 1, 43, 46
+TYPE_OPT, TYPE_TSIG = 41, 250
+CLASS_IN = 1
+# types with a name in the rdata that dnspython writes uncompressed, by its offset (NSEC, DNAME, SRV, AFSDB, RT, KX,
+# SVCB, HTTPS)
+UNCOMPRESSED_NAME_AT = {TYPE_RRSIG: 18, 47: 0, 39: 0, 33: 6, 18: 2, 21: 2, 36: 2, 64: 2, 65: 2}
+# types without names in the rdata that dnspython writes back as read: A, HINFO, TXT, AAAA, DS, SSHFP, DNSKEY, NSEC3,
+# NSEC3PARAM, TLSA, SMIMEA, CDS, CDNSKEY, OPENPGPKEY, ZONEMD, SPF, CAA
+OPAQUE_TYPES = {TYPE_A, 13, TYPE_TXT, 28, TYPE_DS, 44, 48, 50, 51, 52, 53, 59, 60, 61, 63, 99, 257}
+BOGUS_SIGNATURE = b"\xff" * 24
+EVIL_TXT = b"\x04evil"
+EVIL_DS = [
+    struct.pack('!HBB', key_tag, algorithm, digest_type) + digest
+    for key_tag, algorithm, digest_type, digest in [
+        (18351, 13, 2, bytes.fromhex("bd638ab1d0259d76c435acfeab0028adbd273a358d154549565812f333454303")),
+        (18351, 13, 4, bytes.fromhex("000c3f7da476c17bccff160f7536ba4df5980b030ff65cc8c64c82dadd561dfd5fdd6b253fdf20f9147bcb5d002eef07")),
+    ]
+]
+
+
+class WireFallback(Exception):
+    pass
+
+
+class RRset:
+    """
+    An RRset of the upstream answer, given by offsets into it. `rdatas` is only filled in (with the RRs' rdata) once
+    an instruction touches the RRset; touched RRsets are re-emitted from it with TTL 0.
+    """
+    __slots__ = ('start', 'end', 'owner_start', 'owner_end', 'owner_pointer', 'rdtype', 'rdclass', 'covers',
+                 'rr_offsets', 'rdatas')
+
+    def __init__(self, start, owner_start, owner_end, owner_pointer, rdtype, rdclass, covers):
+        self.start = start
+        self.end = start
+        self.owner_start, self.owner_end = owner_start, owner_end
+        self.owner_pointer = owner_pointer  # True if the owner name is a single compression pointer
+        self.rdtype, self.rdclass, self.covers = rdtype, rdclass, covers
+        self.rr_offsets: List[Tuple[int, int]] = []  # (rdata start, rdata end) per RR
+        self.rdatas: Optional[List[bytes]] = None
+
+    def touch(self, wire: memoryview) -> List[bytes]:
+        if self.rdatas is None:
+            self.rdatas = [bytes(wire[start:end]) for start, end in self.rr_offsets]
+        return self.rdatas
+
+
+def uncompressed_name(wire, pos: int) -> bytes:
+    """The uncompressed wire form of the name at pos."""
+    out = bytearray()
+    while True:
+        length = wire[pos]
+        if length & 0xC0 == 0xC0:
+            target = ((length & 0x3F) << 8) | wire[pos + 1]
+            if target >= pos:
+                raise WireFallback(f"forward compression pointer at {pos}")
+            pos = target
+            continue
+        out += wire[pos:pos + length + 1]
+        if length == 0:
+            return bytes(out)
+        pos += length + 1
+
+
+def name_key(wire, pos: int) -> bytes:
+    """The lowercased, uncompressed wire form of the name at pos."""
+    return uncompressed_name(wire, pos).lower()
+
+
+def skip_name(wire, pos: int) -> int:
+    while True:
+        length = wire[pos]
+        if length == 0:
+            return pos + 1
+        if length & 0xC0 == 0xC0:
+            return pos + 2
+        pos += length + 1
+
+
+class Index:
+    """
+    Offsets of the question and the RRsets of an answer, plus the positions of all compression pointers. Checks that
+    the answer is encoded as dnspython would encode it.
+    """
+
+    def __init__(self, wire: bytes) -> None:
+        self.wire = memoryview(wire)
+        self.pointers: List[Tuple[int, int]] = []  # (offset of pointer, target)
+        self.compress: Dict[bytes, int] = {}  # offsets of the names written so far, as in dnspython's renderer
+        if len(wire) < 12:
+            raise WireFallback("short message")
+        try:
+            self.read(wire)
+        except (IndexError, struct.error):
+            raise WireFallback("malformed message")
+
+    def read(self, wire: bytes) -> None:
+        qdcount, *counts = struct.unpack_from('!HHHH', wire, 4)
+        pos = 12
+        for _ in range(qdcount):
+            pos = self.read_name(pos) + 4
+        self.question_end = pos
+        self.sections: List[List[RRset]] = []
+        for section, count in enumerate(counts):
+            rrsets, pos = self.read_section(pos, count, last=section == 2)
+            self.sections.append(rrsets)
+        if pos != len(wire):
+            raise WireFallback("trailing data")
+        self.opt = self.sections[2].pop() if self.sections[2] and self.sections[2][-1].rdtype == TYPE_OPT else None
+
+    def skip_name(self, pos: int, compressible: bool = True) -> int:
+        wire = self.wire
+        while True:
+            length = wire[pos]
+            if length == 0:
+                return pos + 1
+            if length & 0xC0 == 0xC0:
+                if not compressible:
+                    raise WireFallback(f"compressed name at {pos} in uncompressed context")
+                target = ((length & 0x3F) << 8) | wire[pos + 1]
+                if target >= pos:
+                    raise WireFallback(f"forward compression pointer at {pos}")
+                self.pointers.append((pos, target))
+                return pos + 2
+            if length & 0xC0:
+                raise WireFallback(f"unsupported label type at {pos}")
+            pos += length + 1
+
+    def read_name(self, pos: int, compressible: bool = True, name: Optional[bytes] = None) -> int:
+        """
+        Skips the name at pos, checking that dnspython writes it (or the name given instead, e.g. the owner of the
+        RRset for its later RRs) the same way. Returns the position after it.
+        """
+        end = self.skip_name(pos, compressible)
+        if compressible and self.compressed(name or uncompressed_name(self.wire, pos), pos) != self.wire[pos:end]:
+            raise WireFallback(f"name not compressed as dnspython does at {pos}")
+        return end
+
+    def compressed(self, name: bytes, pos: int) -> bytes:
+        """How dnspython's Name.to_wire writes the uncompressed name at pos, remembering its suffixes."""
+        out = bytearray()
+        i = 0
+        while name[i]:
+            suffix = name[i:].lower()
+            target = self.compress.get(suffix)
+            if target is not None:
+                return bytes(out + struct.pack('!H', 0xC000 | target))
+            if pos + len(out) <= 0x3FFF:
+                self.compress[suffix] = pos + len(out)
+            out += name[i:i + name[i] + 1]
+            i += name[i] + 1
+        return bytes(out + b'\x00')
+
+    def read_section(self, pos: int, count: int, last: bool) -> Tuple[List[RRset], int]:
+        wire = self.wire
+        rrsets: List[RRset] = []
+        keys: Dict[tuple, RRset] = {}
+        ttls: Dict[tuple, int] = {}
+        owners: Dict[tuple, bytes] = {}  # dnspython writes the owner of the first RR for all RRs of the RRset
+        for i in range(count):
+            rr_start = pos
+            owner_pointer = wire[pos] & 0xC0 == 0xC0
+            pos = skip_name(wire, pos)  # checked below, once the RRset is known
+            owner_end = pos
+            rdtype, rdclass, ttl, rdlength = struct.unpack_from('!HHIH', wire, pos)
+            pos += 10
+            rdata_start, rdata_end = pos, pos + rdlength
+            if rdata_end > len(wire):
+                raise WireFallback("truncated rdata")
+            if rdtype == TYPE_TSIG:
+                raise WireFallback("TSIG")
+            if rdclass != CLASS_IN and rdtype != TYPE_OPT:
+                raise WireFallback(f"class {rdclass}")
+            covers = struct.unpack_from('!H', wire, rdata_start)[0] if rdtype == TYPE_RRSIG else 0
+            owner = uncompressed_name(wire, rr_start)
+            key = (owner.lower(), rdtype, rdclass, covers)
+            self.read_name(rr_start, name=owners.setdefault(key, owner))
+            if rdtype == TYPE_OPT:
+                if not last or i != count - 1:
+                    raise WireFallback("OPT is not the last RR")
+            elif rdtype in (TYPE_NS, TYPE_CNAME, TYPE_PTR):
+                self.read_name(rdata_start)
+            elif rdtype == TYPE_MX:
+                self.read_name(rdata_start + 2)
+            elif rdtype == TYPE_SOA:
+                self.read_name(self.read_name(rdata_start))
+            elif rdtype in UNCOMPRESSED_NAME_AT:
+                self.read_name(rdata_start + UNCOMPRESSED_NAME_AT[rdtype], compressible=False)
+            elif rdtype not in OPAQUE_TYPES:
+                raise WireFallback(f"type {rdtype}")
+            rrset = keys.get(key)
+            if rrset is None or rdtype == TYPE_OPT:
+                rrset = RRset(rr_start, rr_start, owner_end, owner_pointer, rdtype, rdclass, covers)
+                keys[key] = rrset
+                ttls[key] = ttl
+                rrsets.append(rrset)
+            elif rrset is not rrsets[-1]:
+                raise WireFallback("RRs of one RRset are not adjacent")
+            elif ttls[key] != ttl:
+                raise WireFallback("differing TTLs within an RRset")
+            elif any(wire[s:e] == wire[rdata_start:rdata_end] for s, e in rrset.rr_offsets):
+                raise WireFallback("duplicate RR")
+            rrset.rr_offsets.append((rdata_start, rdata_end))
+            rrset.end = pos = rdata_end
+        return rrsets, pos
+
+
+def rrsig_algorithm(rdata: bytes) -> int:
+    return rdata[2]
+
+
+def rrsig_signature_start(rdata: bytes) -> int:
+    pos = 18
+    while rdata[pos]:
+        pos += rdata[pos] + 1
+    return pos + 1
+
+
+def rrsets_of_type(section: List[RRset], rdtype: int) -> List[RRset]:
+    return [rrset for rrset in section if rrset.rdtype == rdtype]
+
+
+def replace_rrsig_algo(index: Index, section: List[RRset], replace_with: int) -> None:
+    for rrset in rrsets_of_type(section, TYPE_RRSIG):
+        rrset.rdatas = [rdata[:2] + bytes([replace_with]) + rdata[3:] for rdata in rrset.touch(index.wire)]
+
+
+def replace_a(index: Index, section: List[RRset], *args) -> None:
+    address = bytes(int(octet) for octet in filters.IP_A_EVIL.split('.'))
+    for rrset in rrsets_of_type(section, TYPE_A):
+        rrset.touch(index.wire)
+        rrset.rdatas = [address]
+
+
+def replace_txt(index: Index, section: List[RRset], *args) -> None:
+    for rrset in rrsets_of_type(section, TYPE_TXT):
+        new_rdatas = []
+        for rdata in rrset.touch(index.wire):
+            new_rdata, pos = bytearray(), 0
+            while pos < len(rdata):
+                length = rdata[pos]
+                new_rdata.append(length)
+                new_rdata += (b"evil " * ((length // 5) + 1))[:length]
+                pos += length + 1
+            new_rdatas.append(bytes(new_rdata))
+        rrset.rdatas = new_rdatas
+
+
+def replace_ds(index: Index, section: List[RRset], *args) -> None:
+    for rrset in rrsets_of_type(section, TYPE_DS):
+        rrset.touch(index.wire)
+        rrset.rdatas = list(EVIL_DS)
+
+
+def drop_rrsigs(index: Index, section: List[RRset], algorithm: int) -> None:
+    for rrset in rrsets_of_type(section, TYPE_RRSIG):
+        rrset.rdatas = [rdata for rdata in rrset.touch(index.wire) if rrsig_algorithm(rdata) != algorithm]
+        if not rrset.rdatas:
+            section.remove(rrset)
+
+
+def add_bogus_rrsig(index: Index, section: List[RRset], algorithm: int) -> None:
+    for rrset in rrsets_of_type(section, TYPE_RRSIG):
+        rdatas = rrset.touch(index.wire)
+        last = rdatas[-1]
+        rdatas.append(last[:2] + bytes([algorithm]) + last[3:rrsig_signature_start(last)] + BOGUS_SIGNATURE)
+
+
+def add_bogus_txt(index: Index, section: List[RRset], *args) -> None:
+    for rrset in rrsets_of_type(section, TYPE_TXT):
+        rrset.touch(index.wire).append(EVIL_TXT)
+
+
+def modify_signatures(index: Index, section: List[RRset], *args) -> None:
+    for rrset in rrsets_of_type(section, TYPE_RRSIG):
+        new_rdatas = []
+        for rdata in rrset.touch(index.wire):
+            new_rdatas.append(rdata[:-1] + bytes([rdata[-1] ^ 0x1]))  # flip last bit
+        rrset.rdatas = new_rdatas
+
+
+WIRE_ACTIONS: Dict[Callable, Callable] = {
+    filters.replace_rrsig_algo: replace_rrsig_algo,
+    filters.replace_a: replace_a,
+    filters.replace_txt: replace_txt,
+    filters.replace_ds: replace_ds,
+    filters.drop_rrsigs: drop_rrsigs,
+    filters.add_bogus_rrsig: add_bogus_rrsig,
+    filters.add_bogus_txt: add_bogus_txt,
+    filters.modify_signatures: modify_signatures,
+}
+
+
+def dedupe(rdatas: List[bytes]) -> List[bytes]:
+    # dnspython's RRsets are sets: adding an RR equal to an existing one is a no-op
+    return list(dict.fromkeys(rdatas))
+
+
+class Splicer:
+    """Builds the output buffer, remembering where copied upstream ranges end up so pointers can be moved."""
+
+    def __init__(self, wire: memoryview) -> None:
+        self.wire = wire
+        self.out = bytearray()
+        self.segments: List[Tuple[int, int, int]] = []  # (upstream start, upstream end, output start)
+        self.first_dirty: Optional[int] = None
+
+    def copy(self, start: int, end: int) -> None:
+        if self.segments and self.segments[-1][1] == start and \
+                self.segments[-1][2] + start - self.segments[-1][0] == len(self.out):
+            s, _, o = self.segments[-1]
+            self.segments[-1] = (s, end, o)
+        else:
+            self.segments.append((start, end, len(self.out)))
+        self.out += self.wire[start:end]
+
+    def write(self, data: bytes) -> None:
+        self.dirty(len(self.out))
+        self.out += data
+
+    def dirty(self, pos: int) -> None:
+        if self.first_dirty is None or pos < self.first_dirty:
+            self.first_dirty = pos
+
+    def translate(self, pos: int) -> int:
+        for start, end, out_start in self.segments:
+            if start <= pos < end:
+                return out_start + pos - start
+        raise WireFallback(f"compression pointer into modified data at {pos}")
+
+    def fix_pointers(self, pointers: List[Tuple[int, int]]) -> None:
+        for pos, target in pointers:
+            try:
+                new_pos = self.translate(pos)
+            except WireFallback:
+                continue  # the pointer itself was not copied
+            new_target = self.translate(target)
+            if new_target != target:
+                if new_target > 0x3FFF:
+                    raise WireFallback("compression pointer target out of range")
+                struct.pack_into('!H', self.out, new_pos, 0xC000 | new_target)
+                self.dirty(new_pos)
+
+
+def emit_rrset(splicer: Splicer, index: Index, rrset: RRset) -> int:
+    """Writes a touched RRset the way dnspython renders it and returns the number of RRs written."""
+    rdatas = rrset.rdatas
+    owner_out = len(splicer.out)
+    splicer.copy(rrset.owner_start, rrset.owner_end)
+    if rrset.owner_pointer:
+        target = struct.unpack_from('!H', index.wire, rrset.owner_start)[0] & 0x3FFF
+        pointer = struct.pack('!H', 0xC000 | splicer.translate(target))
+    else:
+        if owner_out > 0x3FFF:
+            raise WireFallback("owner name beyond compression range")
+        pointer = struct.pack('!H', 0xC000 | owner_out)
+    fixed = struct.pack('!HHI', rrset.rdtype, rrset.rdclass, 0)
+    for i, rdata in enumerate(rdatas):
+        if i:
+            splicer.write(pointer)
+        splicer.write(fixed + struct.pack('!H', len(rdata)) + rdata)
+    return len(rdatas)
+
+
+def apply_plan(wire: bytes, plan: filters.Plan) -> Tuple[bytes, Optional[int]]:
+    index = Index(wire)
+    for section in index.sections:
+        for action, arg in plan.actions:
+            WIRE_ACTIONS[action](index, section, arg)
+            for rrset in section:
+                if rrset.rdatas is not None:
+                    rrset.rdatas = dedupe(rrset.rdatas)
+
+    splicer = Splicer(index.wire)
+    splicer.copy(0, index.question_end)
+    counts = []
+    for section in index.sections:
+        count = 0
+        for rrset in section:
+            if rrset.rdatas is None:
+                splicer.copy(rrset.start, rrset.end)
+                count += len(rrset.rr_offsets)
+            else:
+                count += emit_rrset(splicer, index, rrset)
+        counts.append(count)
+    if index.opt is not None:
+        splicer.copy(index.opt.start, index.opt.end)
+        counts[2] += 1
+    splicer.fix_pointers(index.pointers)
+
+    out = splicer.out
+    if struct.unpack_from('!HHH', wire, 6) != tuple(counts):
+        struct.pack_into('!HHH', out, 6, *counts)
+        splicer.dirty(6)
+    if splicer.first_dirty is None:
+        return wire, None
+    # same semantics as comparing the complete messages with os.path.commonprefix
+    start = splicer.first_dirty
+    first_changed_byte = start + len(os.path.commonprefix((wire[start:], bytes(out[start:]))))
+    return bytes(out), first_changed_byte if first_changed_byte < len(out) else None
+
+
+def question_label(wire: bytes) -> bytes:
+    if len(wire) < 13 or not struct.unpack_from('!H', wire, 4)[0]:
+        raise WireFallback("no question")
+    length = wire[12]
+    if length & 0xC0:
+        raise WireFallback("compressed question name")
+    return wire[13:13 + length]
+
+
+def filter_response(wire: bytes) -> Tuple[bytes, Optional[int]]:
+    """
+    Wire-level equivalent of filters.filter_response. Returns the final answer and the index of its first byte that
+    differs from the upstream answer (None if unchanged).
+    """
+    label = question_label(wire)
+    if not label.lower().startswith(b'mitm'):
+        return unchanged(wire)
+    plan = filters.compile_plan(label.decode().lower())
+    if not plan.actions:
+        return unchanged(wire)
+    return apply_plan(wire, plan)
+
+
+def unchanged(wire: bytes) -> Tuple[bytes, None]:
+    """The answer as the dnspython path forwards it if nothing is filtered, i.e. re-encoded by dnspython."""
+    Index(wire)
+    return wire, None
+
+
+def records(wire: bytes) -> Tuple[int, List[Tuple[int, int, int, int, int, int]]]:
+    """The end of the question, and (section, start, end, rdtype, rdclass, covers) of every RR."""
+    qdcount, *counts = struct.unpack_from('!HHHH', wire, 4)
+    pos = 12
+    for _ in range(qdcount):
+        pos = skip_name(wire, pos) + 4
+    question_end, rrs = pos, []
+    for section, count in enumerate(counts):
+        for _ in range(count):
+            start = pos
+            pos = skip_name(wire, pos)
+            rdtype, rdclass, _, rdlength = struct.unpack_from('!HHIH', wire, pos)
+            pos += 10
+            covers = struct.unpack_from('!H', wire, pos)[0] if rdtype == TYPE_RRSIG else 0
+            pos += rdlength
+            if pos > len(wire):
+                raise WireFallback("truncated rdata")
+            rrs.append((section, start, pos, rdtype, rdclass, covers))
+    return question_end, rrs
+
+
+def truncate(wire: bytes, limit: int) -> Tuple[bytes, bool]:
+    """
+    Fits an answer into limit bytes for UDP (RFC 2181 section 9, RFC 6891 section 7): whole RRsets are kept from the
+    start for as long as they fit, and the OPT RR is kept. As only a prefix of the answer is kept, its compression
+    pointers stay valid. TC is set if an RRset of the answer or authority section is dropped; dropping additional
+    data alone does not set it. Returns the answer and whether TC was set.
+    """
+    if len(wire) <= limit:
+        return wire, False
+    try:
+        question_end, rrs = records(wire)
+    except (IndexError, struct.error, WireFallback):
+        question_end, rrs = len(wire), []  # unparsable: send the header only
+    opt = b''
+    if rrs and rrs[-1][3] == TYPE_OPT:
+        opt = wire[rrs.pop()[1]:]
+    budget = limit - len(opt)
+    if question_end > budget:
+        question_end = 12
+    end, counts, i = question_end, [0, 0, 0], 0
+    while i < len(rrs):
+        section, start, rrset_end, *key = rrs[i]
+        owner = name_key(wire, start)
+        j = i + 1
+        while j < len(rrs) and rrs[j][0] == section and rrs[j][3:] == tuple(key) and name_key(wire, rrs[j][1]) == owner:
+            rrset_end = rrs[j][2]
+            j += 1
+        if rrset_end > budget:
+            break
+        end = rrset_end
+        counts[section] += j - i
+        i = j
+    tc = i < len(rrs) and rrs[i][0] < 2 or question_end == 12
+    out = bytearray(wire[:end])
+    if question_end == 12:
+        struct.pack_into('!H', out, 4, 0)
+    struct.pack_into('!HHH', out, 6, counts[0], counts[1], counts[2] + bool(opt))
+    if tc:
+        out[2] |= 0x02
+    return bytes(out + opt), tc
+
+
+def set_payload(wire: bytes, payload: int) -> bytes:
+    """The query with the UDP payload size of its OPT RR (if any) set to payload."""
+    try:
+        _, rrs = records(wire)
+    except (IndexError, struct.error, WireFallback):
+        return wire
+    if not rrs or rrs[-1][3] != TYPE_OPT:
+        return wire
+    offset = skip_name(wire, rrs[-1][1]) + 2  # the class field of OPT
+    return wire[:offset] + struct.pack('!H', payload) + wire[offset + 2:]
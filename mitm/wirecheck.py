@@ -0,0 +1,210 @@
+"""
+Checks that the wire-level rewriting engine (wire.py) produces byte-for-byte the same answers and first_changed_byte
+as the dnspython path (filters.py) on a corpus of upstream answers.
+
+The corpus is given as files containing one raw DNS answer each (or directories of such files), or as dumps of
+mitm.py (see dumps.py), whose upstream answers are used; with --synthetic, signed-looking answers covering all
+instruction codes are generated instead, each also with all names written out uncompressed. Answers that dnspython
+would encode differently than the upstream did have to fall back to the dnspython path.
+
+With --truncate, wire.truncate is checked instead: each answer is cut to a range of UDP payload sizes, and the result
+has to parse, fit, keep the OPT RR and whole RRsets from the start of the answer, and have TC set exactly if an RRset
+of the answer or authority section was dropped.
+
+    python3 wirecheck.py [--synthetic] [--truncate] [--dumps /data/dumps.jsonl ...] [CORPUS ...]
+"""
+import argparse
+import base64
+import collections
+import itertools
+import json
+import os
+import struct
+import sys
+import time
+from typing import Iterator, Optional, Tuple
+
+import dns.flags
+import dns.message
+import dns.name
+import dns.rrset
+
+import filters
+import wire
+from bench_filters import rrsig
+
+SYNTHETIC_LABELS = [
+    'www', 'mitm', 'mitm-rs16-rd', 'mitm-ra-ds8-ds13', 'mitm-ra-ds8-ds13-ds15-ds16', 'mitm-ds13', 'mitm-ds13-ds15',
+    'mitm-as15', 'mitm-as15-as16', 'mitm-at', 'mitm-at-at', 'mitm-ms', 'mitm-rt', 'mitm-rs8-ms-at', 'MITM-RS16-DS16',
+]
+
+
+def reference(upstream: bytes) -> Tuple[bytes, Optional[int]]:
+    """The dnspython path of mitm.py."""
+    a = dns.message.from_wire(upstream)
+    upstream_answer = a.to_wire(want_shuffle=False)
+    filters.filter_response(a)
+    final_answer = a.to_wire(want_shuffle=False)
+    common_prefix_length = len(os.path.commonprefix((upstream_answer, final_answer)))
+    return final_answer, common_prefix_length if common_prefix_length < len(final_answer) else None
+
+
+def synthetic() -> Iterator[bytes]:
+    for label, algorithms, qtype in itertools.product(
+            SYNTHETIC_LABELS, [(13,), (13, 15), (8, 13), (8, 16)], ['A', 'TXT', 'DS', 'NS']):
+        zone = dns.name.from_text('ds13-ds15-dnskey13-dnskey15.example.com.')
+        name = dns.name.from_text(label, origin=zone)
+        r = dns.message.make_response(dns.message.make_query(name, qtype, want_dnssec=True))
+        if qtype == 'A':
+            answer = dns.rrset.from_text(name, 3600, 'IN', 'A', '127.0.0.1')
+        elif qtype == 'TXT':
+            answer = dns.rrset.from_text(name, 3600, 'IN', 'TXT', '"research test zone"', '"a" "bc"', '"abcdef"')
+        elif qtype == 'DS':
+            answer = dns.rrset.from_text(name, 3600, 'IN', 'DS', '29449 13 2 ' + 'ff' * 32, '29449 13 4 ' + 'ff' * 48)
+        else:
+            answer = dns.rrset.from_text(name, 3600, 'IN', 'NS', 'ns1.desec.io.', 'ns2.desec.org.')
+        r.answer.append(answer)
+        r.answer.append(dns.rrset.from_text(name, 3600, 'IN', 'RRSIG', *[rrsig(qtype, a, name) for a in algorithms]))
+        r.authority.append(dns.rrset.from_text(zone, 3600, 'IN', 'NS', f'ns.{zone.parent()}'))
+        r.authority.append(dns.rrset.from_text(zone, 3600, 'IN', 'RRSIG', *[rrsig('NS', a, zone) for a in algorithms]))
+        r.additional.append(dns.rrset.from_text(f'ns.{zone.parent()}', 3600, 'IN', 'A', '127.0.0.2'))
+        r.additional.append(dns.rrset.from_text(f'ns.{zone.parent()}', 3600, 'IN', 'TXT', '"x"'))
+        yield r.to_wire(want_shuffle=False)
+        yield decompressed(r.to_wire(want_shuffle=False))
+
+
+def decompressed(upstream: bytes) -> bytes:
+    """The answer with all names written out, as some name servers send them: valid, but not as dnspython does."""
+    question_end, rrs = wire.records(upstream)
+    out = bytearray(upstream[:12])
+    pos = 12
+    while pos < question_end:
+        name = wire.uncompressed_name(upstream, pos)
+        pos = wire.skip_name(upstream, pos)
+        out += name + upstream[pos:pos + 4]
+        pos += 4
+    for _, start, end, rdtype, _, _ in rrs:
+        fixed = wire.skip_name(upstream, start)
+        rdata_start = fixed + 10
+        if rdtype in (wire.TYPE_NS, wire.TYPE_CNAME, wire.TYPE_PTR):
+            rdata = wire.uncompressed_name(upstream, rdata_start)
+        elif rdtype == wire.TYPE_MX:
+            rdata = upstream[rdata_start:rdata_start + 2] + wire.uncompressed_name(upstream, rdata_start + 2)
+        elif rdtype == wire.TYPE_SOA:
+            rname = wire.skip_name(upstream, rdata_start)
+            rdata = wire.uncompressed_name(upstream, rdata_start) + wire.uncompressed_name(upstream, rname) + \
+                upstream[wire.skip_name(upstream, rname):end]
+        else:
+            rdata = upstream[rdata_start:end]
+        out += wire.uncompressed_name(upstream, start) + upstream[fixed:fixed + 8] + struct.pack('!H', len(rdata))
+        out += rdata
+    return bytes(out)
+
+
+def check_truncation(upstream: bytes, limit: int) -> Optional[str]:
+    """None if wire.truncate(upstream, limit) is right, else what is wrong."""
+    truncated, tc = wire.truncate(upstream, limit)
+    if len(truncated) > limit:
+        return f"{len(truncated)} bytes"
+    a, t = dns.message.from_wire(upstream), dns.message.from_wire(truncated)
+    if (t.edns, t.payload, t.options) != (a.edns, a.payload, a.options):
+        return "OPT changed"
+    dropped = False
+    for name in ('answer', 'authority', 'additional'):
+        kept, original = getattr(t, name), getattr(a, name)
+        if kept != original[:len(kept)]:
+            return f"{name} section is not a prefix of RRsets of the upstream answer"
+        if len(kept) < len(original) and name != 'additional':
+            dropped = True
+    if tc != dropped or bool(t.flags & dns.flags.TC) != (tc or bool(a.flags & dns.flags.TC)):
+        return f"TC is {tc}, but RRsets of the answer or authority section were {'' if dropped else 'not '}dropped"
+    return None
+
+
+def truncation(corpus) -> int:
+    results = collections.Counter()
+    for upstream in corpus:
+        minimum = len(wire.truncate(upstream, 0)[0])
+        for limit in range(minimum, len(upstream) + 2, 7):
+            problem = check_truncation(upstream, limit)
+            results['ok' if problem is None else 'WRONG'] += 1
+            if problem is not None:
+                a = dns.message.from_wire(upstream)
+                print(f"truncating {a.question[0].name} ({len(upstream)} bytes) to {limit}: {problem}", file=sys.stderr)
+    print(f"{len(corpus)} answers truncated to {sum(results.values())} sizes: "
+          + ", ".join(f"{k}={v}" for k, v in sorted(results.items())))
+    return results['WRONG']
+
+
+def dumps(paths) -> Iterator[bytes]:
+    """The upstream answers in JSON lines files of dumps.py."""
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                upstream_wire = json.loads(line).get('upstream_wire')
+                if upstream_wire:
+                    yield base64.b64decode(upstream_wire)
+
+
+def files(paths) -> Iterator[bytes]:
+    for path in paths:
+        if os.path.isdir(path):
+            yield from files(sorted(os.path.join(path, f) for f in os.listdir(path)))
+        else:
+            with open(path, 'rb') as f:
+                yield f.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('corpus', nargs='*', help="files or directories with one raw DNS answer per file")
+    parser.add_argument('--synthetic', action='store_true', help="check generated answers")
+    parser.add_argument('--dumps', nargs='+', default=[], help="check the upstream answers in these dumps of mitm.py")
+    parser.add_argument('--truncate', action='store_true', help="check truncation to UDP payload sizes")
+    args = parser.parse_args()
+
+    corpus = list(files(args.corpus)) + list(dumps(args.dumps))
+    if args.synthetic or not corpus:
+        corpus += list(synthetic())
+    if args.truncate:
+        sys.exit(1 if truncation(corpus) else 0)
+
+    results = collections.Counter()
+    fallbacks = collections.Counter()
+    elapsed = collections.Counter()
+    for upstream in corpus:
+        start = time.perf_counter()
+        expected = reference(upstream)
+        elapsed['dnspython'] += time.perf_counter() - start
+        canonical = dns.message.from_wire(upstream).to_wire(want_shuffle=False) == upstream
+        start = time.perf_counter()
+        try:
+            actual = wire.filter_response(upstream)
+        except wire.WireFallback as e:
+            fallbacks[str(e).split(' at ')[0]] += 1
+            results['fallback'] += 1
+            continue
+        finally:
+            elapsed['wire'] += time.perf_counter() - start
+        if not canonical:  # dnspython does not reproduce the upstream answer's encoding, so neither can the engine
+            results['NOT CANONICAL'] += 1
+            a = dns.message.from_wire(upstream)
+            print(f"no fallback for {a.question[0].name}, which dnspython encodes differently", file=sys.stderr)
+        elif actual == expected:
+            results['identical'] += 1
+        else:
+            results['MISMATCH'] += 1
+            a = dns.message.from_wire(upstream)
+            print(f"mismatch for {a.question[0].name}: expected first_changed_byte={expected[1]}, "
+                  f"got {actual[1]}", file=sys.stderr)
+
+    print(f"{len(corpus)} answers: " + ", ".join(f"{k}={v}" for k, v in sorted(results.items())))
+    for reason, count in fallbacks.most_common():
+        print(f"  fallback: {reason} ({count})")
+    for engine, seconds in elapsed.items():
+        print(f"  {engine}: {seconds / len(corpus) * 1e6:.1f}us per answer")
+    sys.exit(1 if results['MISMATCH'] or results['NOT CANONICAL'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+"""
+Survey of resolvers as in Crawler.ipynb: for each resolver, domain and repetition, query A with DO and CD set, check
+that the answer has exactly one RRSIG and note its algorithm and the AD flag, and if AD is not set, query again
+without CD. The records are those of check_resolver in the notebook: qname, resolver, time, handle, status ('ok',
+'timeout', 'servfail'), rcode, algorithm, ttl, ad1, ad2.
+
+Queries are sent by an asyncio UDP engine: thousands of them can be in flight on a few sockets, answers are matched
+by resolver, ID and question. Queries to each resolver are spaced out to at most --rate per second, and time out
+after a per-resolver estimate of the round-trip time (as for TCP, RFC 6298), doubled for the retry; before the first
+answer of a resolver, the timeouts are 2 and 5 seconds as in the notebook. Results are appended to a JSON lines file
+as they come in, and errors (answers without exactly one RRSIG) to a second one.
+
+    python3 survey.py --resolvers traffic/open-resolvers.csv --domains 10 --repeat 10 --out resolvers-results.jsonl
+
+In a notebook: `await run_survey(resolvers, domains, repeat, out)`, then `results, errors = read_results(out)`.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import random
+import string
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.rdataclass
+import dns.rdatatype
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+IN = dns.rdataclass.from_text("IN")
+A = dns.rdatatype.from_text("A")
+RRSIG = dns.rdatatype.from_text("RRSIG")
+
+
+class ResolverState:
+    """Spacing of queries to a resolver, and its round-trip time estimate."""
+
+    def __init__(self, rate: float, initial_timeout: float = 2, min_timeout: float = .5, max_timeout: float = 5):
+        self.interval = 1 / rate if rate else 0
+        self.next_send = 0.0
+        self.initial_timeout = initial_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.srtt: Optional[float] = None
+        self.rttvar = 0.0
+
+    async def turn(self) -> None:
+        now = time.monotonic()
+        send = max(now, self.next_send)
+        self.next_send = send + self.interval
+        if send > now:
+            await asyncio.sleep(send - now)
+
+    def timeout(self, attempt: int) -> float:
+        if self.srtt is None:
+            return self.initial_timeout if attempt == 0 else self.max_timeout
+        return min(max(self.srtt + 4 * self.rttvar, self.min_timeout) * 2 ** attempt, self.max_timeout)
+
+    def sample(self, rtt: float) -> None:
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = .75 * self.rttvar + .25 * abs(self.srtt - rtt)
+            self.srtt = .875 * self.srtt + .125 * rtt
+
+
+class UDPEngine:
+    """Sends queries from a few UDP sockets and matches the answers to them by resolver, ID and question."""
+
+    class Protocol(asyncio.DatagramProtocol):
+
+        def __init__(self, engine: 'UDPEngine', index: int) -> None:
+            self.engine = engine
+            self.index = index
+
+        def datagram_received(self, data, addr):
+            self.engine.received(self.index, data, addr)
+
+        def error_received(self, exc):
+            logger.debug(f"socket {self.index}: {exc}")
+
+    def __init__(self, sockets: int = 4, port: int = 53) -> None:
+        self.sockets = sockets
+        self.port = port
+        self.transports: List[asyncio.DatagramTransport] = []
+        self.pending: Dict[tuple, asyncio.Future] = {}
+        self.next_socket = 0
+        self.sent = self.received_answers = self.unmatched = 0
+
+    async def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        for index in range(self.sockets):
+            transport, _ = await loop.create_datagram_endpoint(lambda i=index: self.Protocol(self, i),
+                                                               local_addr=('0.0.0.0', 0))
+            self.transports.append(transport)
+
+    def close(self) -> None:
+        for transport in self.transports:
+            transport.close()
+
+    @staticmethod
+    def question(m: dns.message.Message) -> tuple:
+        return tuple((q.name.to_text().lower(), q.rdtype, q.rdclass) for q in m.question)
+
+    def received(self, index: int, data: bytes, addr) -> None:
+        try:
+            r = dns.message.from_wire(data)
+        except dns.exception.DNSException:
+            self.unmatched += 1
+            return
+        future = self.pending.pop((index, addr[0], r.id, self.question(r)), None)
+        if future is None or future.done():
+            self.unmatched += 1
+            return
+        self.received_answers += 1
+        future.set_result(r)
+
+    async def query(self, q: dns.message.Message, resolver: str, timeout: float) -> dns.message.Message:
+        """Sends q with a new ID; raises asyncio.TimeoutError if no answer comes within timeout seconds."""
+        index = self.next_socket = (self.next_socket + 1) % self.sockets
+        while True:
+            q.id = random.getrandbits(16)
+            key = (index, resolver, q.id, self.question(q))
+            if key not in self.pending:
+                break
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        try:
+            self.transports[index].sendto(q.to_wire(), (resolver, self.port))
+            self.sent += 1
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+
+
+class Survey:
+
+    def __init__(self, engine: UDPEngine, rate: float = 20, attempts: int = 2) -> None:
+        self.engine = engine
+        self.rate = rate
+        self.attempts = attempts
+        self.resolvers: Dict[str, ResolverState] = {}
+
+    async def query(self, qname: dns.name.Name, resolver: str, cd: bool) -> dns.message.Message:
+        q = dns.message.make_query(qname, A, want_dnssec=True)
+        if cd:
+            q.flags = q.flags | dns.flags.CD
+        state = self.resolvers.setdefault(resolver, ResolverState(self.rate))
+        for attempt in range(self.attempts):
+            await state.turn()
+            start = time.monotonic()
+            try:
+                r = await self.engine.query(q, resolver, state.timeout(attempt))
+            except asyncio.TimeoutError:
+                continue
+            state.sample(time.monotonic() - start)  # every attempt has its own ID, so the sample is unambiguous
+            return r
+        raise dns.exception.Timeout
+
+    async def check_resolver(self, resolver: str, d: dns.name.Name, rname: str) -> dict:
+        base = {
+            'qname': d.to_text(),
+            'resolver': resolver,
+            'time': datetime.now(),
+            'handle': rname,
+        }
+
+        try:
+            r = await self.query(d, resolver, cd=True)
+        except dns.exception.Timeout:
+            return {'status': 'timeout', **base}
+
+        base['rcode'] = r.rcode()
+        if r.rcode() == 2:  # servfail
+            return {'status': 'servfail', **base}
+
+        ad1 = bool(r.flags & dns.flags.AD)
+        rrsigs = r.get_rrset(r.answer, d, IN, RRSIG, covers=A) or []
+        if len(rrsigs) != 1:
+            raise Exception(f"Expected exactly one signature on A/{d} when queried via {resolver}, but got "
+                            f"{len(rrsigs)}: {rrsigs}")
+        suite = rrsigs[0].algorithm
+        ttl = rrsigs.ttl
+
+        ad2 = None
+        if not ad1:
+            try:
+                r = await self.query(d, resolver, cd=False)
+            except dns.exception.Timeout:
+                return {'status': 'timeout', **base}
+            ad2 = bool(r.flags & dns.flags.AD)
+
+        return {'algorithm': suite, 'ttl': ttl, 'ad1': ad1, 'ad2': ad2, 'status': 'ok', **base}
+
+
+class JsonLines:
+    """Appends records to a file, flushing at most every flush_interval seconds."""
+
+    def __init__(self, path: str, flush_interval: float = 1) -> None:
+        self.file = open(path, 'a')
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+        self.count = 0
+
+    def write(self, record: dict) -> None:
+        self.file.write(json.dumps(record, default=lambda o: o.isoformat() if isinstance(o, datetime) else int(o)) + "\n")
+        self.count += 1
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.file.flush()
+            self.last_flush = time.monotonic()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def errors_path(out: str) -> str:
+    root, ext = os.path.splitext(out)
+    return f"{root}.errors{ext}"
+
+
+async def run_survey(resolvers: Dict[str, str], domains: Iterable[dns.name.Name], repeat: int, out: str,
+                     rate: float = 20, in_flight: int = 2000, sockets: int = 4, port: int = 53,
+                     progress: bool = True) -> Tuple[int, int]:
+    """
+    Checks the resolvers, given as {handle: address}, repeat times for each domain, and appends the results to out
+    and the errors to out with .errors before the extension. Returns the number of results and errors.
+    """
+    domains = list(domains)
+    engine = UDPEngine(sockets, port)
+    await engine.start()
+    survey = Survey(engine, rate)
+    results, errors = JsonLines(out), JsonLines(errors_path(out))
+    slots = asyncio.Semaphore(in_flight)
+    tasks = set()
+    pbar = tqdm(total=repeat * len(domains) * len(resolvers), desc="Querying", disable=not progress)
+
+    async def check(resolver: str, d: dns.name.Name, rname: str) -> None:
+        try:
+            results.write(await survey.check_resolver(resolver, d, rname))
+        except Exception as e:
+            logger.warning(f"{resolver}: {e}")
+            errors.write({'qname': d.to_text(), 'resolver': resolver, 'time': datetime.now(), 'handle': rname,
+                          'error': str(e)})
+        finally:
+            slots.release()
+            pbar.update(1)
+
+    try:
+        for _ in range(repeat):
+            for d in domains:
+                for rname, r in resolvers.items():
+                    await slots.acquire()
+                    task = asyncio.create_task(check(r, d, rname))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+    finally:
+        pbar.close()
+        engine.close()
+        results.close()
+        errors.close()
+    logger.info(f"{engine.sent} queries sent, {engine.received_answers} answers, {engine.unmatched} unmatched")
+    return results.count, errors.count
+
+
+def read_results(out: str) -> Tuple[List[dict], List[dict]]:
+    """The results and errors of run_survey, with times as datetime."""
+    def read(path: str) -> List[dict]:
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            records = [json.loads(line) for line in f]
+        for record in records:
+            record['time'] = datetime.fromisoformat(record['time'])
+        return records
+
+    return read(out), read(errors_path(out))
+
+
+def random_domains(count: int, parent: str) -> List[dns.name.Name]:
+    return [dns.name.from_text(f"{''.join(random.choices(string.ascii_lowercase, k=6))}.{parent}") for _ in range(count)]
+
+
+def read_resolvers(path: str) -> Dict[str, str]:
+    with open(path) as f:
+        return {row['Handle']: row['IPv4'] for row in csv.DictReader(f)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--resolvers', action='append', default=[], help="CSV file with Handle and IPv4 columns")
+    parser.add_argument('--resolver', action='append', default=[], help="a resolver as handle=address")
+    parser.add_argument('--domains', type=int, default=10, help="number of random domains to query")
+    parser.add_argument('--parent', default='ml.adnssec.dedyn.io', help="parent of the random domains")
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--out', default='resolvers-results.jsonl')
+    parser.add_argument('--rate', type=float, default=20, help="queries per second per resolver")
+    parser.add_argument('--in-flight', type=int, default=2000, help="resolver checks in progress at a time")
+    parser.add_argument('--sockets', type=int, default=4)
+    parser.add_argument('--port', type=int, default=53, help="port of the resolvers")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    resolvers = {}
+    for path in args.resolvers:
+        resolvers.update(read_resolvers(path))
+    resolvers.update(dict(r.split('=', 1) for r in args.resolver))
+    start = time.monotonic()
+    count, errors = asyncio.run(run_survey(resolvers, random_domains(args.domains, args.parent), args.repeat, args.out,
+                                           args.rate, args.in_flight, args.sockets, args.port))
+    logger.warning(f"{count} results and {errors} errors in {time.monotonic() - start:.1f}s, written to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
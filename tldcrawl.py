@@ -0,0 +1,333 @@
+"""
+Crawler of Crawler DNSSEC Misconfiguration TLD.ipynb: for each delegation in the root zone, find the zone by walking
+up to its SOA, then get the DS and (if there is a DS) the DNSKEY records of the zone, all with CD set from a resolver
+over TCP (127.0.0.1 port 5301 by default).
+
+Names are streamed from the AXFR of the root zone (or read from --names) into a bounded queue that --jobs workers
+take them from; queries go over a pool of --connections persistent TCP connections. SOA lookups are memoized, so
+a parent walk is done once for all names below it. Results are written to Parquet files in --out, a part every
+--part-size results; names already there are skipped, so a crawl that was interrupted resumes where it stopped.
+Instead of pickled rrsets, the output has the algorithms, key tags and digest types of the records as list columns.
+Failed names are tried again once at the end, and written with the error if that fails, too.
+
+    python3 tldcrawl.py [--out dnssec-misconfiguration-prevalence-tld] [--jobs 50] [--connections 16]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import struct
+import time
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import dns.dnssec
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.query
+import dns.rdataclass
+import dns.rdatatype
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+IN = dns.rdataclass.from_text("IN")
+NS = dns.rdatatype.from_text("NS")
+DS = dns.rdatatype.from_text("DS")
+DNSKEY = dns.rdatatype.from_text("DNSKEY")
+SOA = dns.rdatatype.from_text("SOA")
+RRSIG = dns.rdatatype.from_text("RRSIG")
+
+SCHEMA = pa.schema([
+    ('domain', pa.string()),
+    ('zone', pa.string()),
+    ('ds_algorithms', pa.list_(pa.uint8())),
+    ('ds_key_tags', pa.list_(pa.uint16())),
+    ('ds_digest_types', pa.list_(pa.uint8())),
+    ('dnskey_algorithms', pa.list_(pa.uint8())),
+    ('dnskey_key_tags', pa.list_(pa.uint16())),
+    ('dnskey_flags', pa.list_(pa.uint16())),
+    ('dnskey_rrsig_algorithms', pa.list_(pa.uint8())),
+    ('dnskey_rrsig_key_tags', pa.list_(pa.uint16())),
+    ('soa_rrsig_algorithms', pa.list_(pa.uint8())),
+    ('soa_rrsig_key_tags', pa.list_(pa.uint16())),
+    ('error', pa.string()),
+])
+
+
+class Connection:
+    """A TCP connection to the resolver, opened when needed and again after it failed."""
+
+    def __init__(self, host: str, port: int, timeout: float = 5) -> None:
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.opened = 0
+
+    def close(self) -> None:
+        if self.writer:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def exchange(self, q: dns.message.Message) -> dns.message.Message:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            self.opened += 1
+        wire = q.to_wire()
+        self.writer.write(struct.pack('!H', len(wire)) + wire)
+        await self.writer.drain()
+        length, = struct.unpack('!H', await self.reader.readexactly(2))
+        r = dns.message.from_wire(await self.reader.readexactly(length))
+        if not q.is_response(r):
+            raise dns.exception.DNSException(f"answer does not match query {q.question[0].name}")
+        return r
+
+    async def query(self, q: dns.message.Message) -> dns.message.Message:
+        """Sends q and waits for its answer, trying again once on a new connection as the notebook did."""
+        for attempt in range(2):
+            try:
+                return await asyncio.wait_for(self.exchange(q), self.timeout)
+            except (OSError, EOFError, asyncio.TimeoutError, dns.exception.DNSException) as e:
+                self.close()
+                if attempt:
+                    raise dns.exception.Timeout(f"{q.question[0].name}: {e!r}") from e
+
+
+class Crawler:
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 5301, connections: int = 16, timeout: float = 5) -> None:
+        self.connections = [Connection(host, port, timeout) for _ in range(connections)]
+        self.idle: Optional[asyncio.Queue] = None
+        self.soa_cache: Dict[dns.name.Name, asyncio.Future] = {}
+        self.queries = self.soa_hits = 0
+
+    async def query(self, q: dns.message.Message) -> dns.message.Message:
+        if self.idle is None:
+            self.idle = asyncio.Queue()
+            for connection in self.connections:
+                self.idle.put_nowait(connection)
+        q.flags = q.flags | dns.flags.CD
+        connection = await self.idle.get()
+        try:
+            self.queries += 1
+            r = await connection.query(q)
+        finally:
+            self.idle.put_nowait(connection)
+        if r.rcode() == 2:  # servfail
+            raise Exception(f"SERVFAIL after asking {q.question[0].name} {dns.rdatatype.to_text(q.question[0].rdtype)}")
+        return r
+
+    async def zone_soa(self, qname: dns.name.Name):
+        """SOA and its RRSIG of the zone of qname, memoized (for the parents walked up to)."""
+        future = self.soa_cache.get(qname)
+        if future is None:
+            future = self.soa_cache[qname] = asyncio.ensure_future(self._zone_soa(qname))
+            future.add_done_callback(lambda f: (f.cancelled() or f.exception()) and self.soa_cache.pop(qname, None))
+        else:
+            self.soa_hits += 1
+        return await asyncio.shield(future)
+
+    async def _zone_soa(self, qname: dns.name.Name):
+        r = await self.query(dns.message.make_query(qname, SOA, want_dnssec=True))
+        if r.rcode() == 3:  # NXDOMAIN
+            return None, None
+        if r.rcode() != 0:
+            raise Exception(f"zone_soa({qname}) query response code:{r.rcode()}")
+        name = qname
+        while True:  # loop over qname parents to find SOA record in DNS reply
+            rr = r.get_rrset(r.authority, name, IN, SOA) or r.get_rrset(r.answer, name, IN, SOA)
+            rrsig = r.get_rrset(r.authority, name, IN, RRSIG, covers=SOA) \
+                or r.get_rrset(r.answer, name, IN, RRSIG, covers=SOA) or []
+            if rr:
+                return rr, rrsig
+            if name == dns.name.root:
+                break
+            name = name.parent()
+        if qname == dns.name.root:
+            return None, None
+        return await self.zone_soa(qname.parent())
+
+    async def zone_ds(self, qname: dns.name.Name):
+        r = await self.query(dns.message.make_query(qname, DS))
+        return r.get_rrset(r.answer, qname, IN, DS) or []
+
+    async def zone_dnskey(self, qname: dns.name.Name):
+        r = await self.query(dns.message.make_query(qname, DNSKEY, want_dnssec=True))
+        dnskey_set = r.get_rrset(r.answer, qname, IN, DNSKEY) or []
+        dnskey_set_rrsig = r.get_rrset(r.answer, qname, IN, RRSIG, covers=DNSKEY) or []
+        return dnskey_set, dnskey_set_rrsig
+
+    async def check_domain(self, d: dns.name.Name) -> dict:
+        soa, soa_rrsig = await self._zone_soa(d)  # names are checked once, only their parents are shared
+        z = soa.name if soa else None
+
+        if z is None:
+            raise Exception(f"Could not identify zone name for domain {d}")
+
+        ds = await self.zone_ds(z)
+        dnskey, dnskey_rrsig = (await self.zone_dnskey(z)) if ds else ([], [])
+
+        return {
+            'domain': d.to_text(),
+            'zone': z.to_text(),
+            'ds_algorithms': [int(rr.algorithm) for rr in ds],
+            'ds_key_tags': [rr.key_tag for rr in ds],
+            'ds_digest_types': [int(rr.digest_type) for rr in ds],
+            'dnskey_algorithms': [int(rr.algorithm) for rr in dnskey],
+            'dnskey_key_tags': [dns.dnssec.key_id(rr) for rr in dnskey],
+            'dnskey_flags': [int(rr.flags) for rr in dnskey],
+            'dnskey_rrsig_algorithms': [int(rr.algorithm) for rr in dnskey_rrsig],
+            'dnskey_rrsig_key_tags': [rr.key_tag for rr in dnskey_rrsig],
+            'soa_rrsig_algorithms': [int(rr.algorithm) for rr in soa_rrsig],
+            'soa_rrsig_key_tags': [rr.key_tag for rr in soa_rrsig],
+            'error': None,
+        }
+
+
+def failed(domain: str, error: Exception) -> dict:
+    return {'domain': domain, **{field.name: [] for field in SCHEMA if pa.types.is_list(field.type)},
+            'zone': None, 'error': str(error) or repr(error)}
+
+
+class Parts:
+    """Parquet files of results in a directory, written a part at a time."""
+
+    def __init__(self, directory: str, part_size: int = 1000) -> None:
+        self.directory = directory
+        self.part_size = part_size
+        self.buffer: List[dict] = []
+        os.makedirs(directory, exist_ok=True)
+        self.count = len(self.paths())
+
+    def paths(self) -> List[str]:
+        return sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                      if name.startswith('part-') and name.endswith('.parquet'))
+
+    def done(self) -> Set[str]:
+        return {domain for path in self.paths() for domain in pq.read_table(path, columns=['domain'])['domain']
+                .to_pylist()}
+
+    def write(self, record: dict) -> None:
+        self.buffer.append(record)
+        if len(self.buffer) >= self.part_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.buffer:
+            return
+        name = f"part-{self.count:05d}.parquet"
+        columns = {field.name: [record[field.name] for record in self.buffer] for field in SCHEMA}
+        tmp = os.path.join(self.directory, f".{name}.tmp")
+        pq.write_table(pa.Table.from_pydict(columns, schema=SCHEMA), tmp)
+        os.replace(tmp, os.path.join(self.directory, name))  # a part is there completely or not at all
+        self.count += 1
+        self.buffer = []
+
+
+def axfr_names(server: str, zone: dns.name.Name = dns.name.root) -> Iterator[str]:
+    """Owner names of the NS records of the zone, as the AXFR comes in."""
+    for m in dns.query.xfr(server, zone, timeout=5):
+        for rrset in m.answer + m.authority:
+            if rrset.rdtype in [NS]:
+                yield rrset.name.to_text()
+
+
+def file_names(path: str) -> Iterator[str]:
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield dns.name.from_text(line.strip()).to_text()
+
+
+async def crawl(names: Iterator[str], crawler: Crawler, parts: Parts, jobs: int = 50) -> Tuple[int, int]:
+    """Checks the names not in parts yet and writes the results to parts; returns the number of results and errors."""
+    loop = asyncio.get_running_loop()
+    done = parts.done()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=2 * jobs)
+    retry: List[str] = []
+    counts = {'results': 0, 'errors': 0}
+    pbar = tqdm(desc="Querying", unit=" names")
+
+    async def worker(final: bool) -> None:
+        while True:
+            domain = await queue.get()
+            if domain is None:
+                return
+            try:
+                parts.write(await crawler.check_domain(dns.name.from_text(domain)))
+                counts['results'] += 1
+            except Exception as e:
+                if not final:
+                    retry.append(domain)
+                    continue
+                logger.warning(f"{domain}: {e}")
+                parts.write(failed(domain, e))
+                counts['errors'] += 1
+            finally:
+                pbar.update(1)
+
+    async def run(source, final: bool) -> None:
+        workers = [asyncio.ensure_future(worker(final)) for _ in range(jobs)]
+        seen = set()
+        while True:
+            domain = await loop.run_in_executor(None, next, source, None)  # the AXFR blocks, so it runs in a thread
+            if domain is None:
+                break
+            if domain in done or domain in seen:
+                continue
+            seen.add(domain)
+            await queue.put(domain)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+
+    try:
+        await run(iter(names), final=False)
+        if retry:
+            logger.info(f"trying {len(retry)} names again")
+            await run(iter(list(retry)), final=True)
+    finally:
+        pbar.close()
+        parts.flush()
+        for connection in crawler.connections:
+            connection.close()
+    return counts['results'], counts['errors']
+
+
+def read_crawl(directory: str) -> pd.DataFrame:
+    """The results in the directory, with the list columns as arrays."""
+    paths = Parts(directory).paths()
+    return pd.concat([pq.read_table(path).to_pandas() for path in paths], ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', default='dnssec-misconfiguration-prevalence-tld')
+    parser.add_argument('--axfr', default='192.0.32.132', help="server to transfer the root zone from")
+    parser.add_argument('--names', help="file with a name per line, instead of the root zone")
+    parser.add_argument('--resolver', default='127.0.0.1:5301')
+    parser.add_argument('--jobs', type=int, default=50, help="names checked at a time")
+    parser.add_argument('--connections', type=int, default=16, help="TCP connections to the resolver")
+    parser.add_argument('--part-size', type=int, default=1000, help="results per Parquet file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    host, port = args.resolver.rsplit(':', 1)
+    crawler = Crawler(host, int(port), args.connections)
+    parts = Parts(args.out, args.part_size)
+    names = file_names(args.names) if args.names else axfr_names(args.axfr)
+    start = time.monotonic()
+    results, errors = asyncio.run(crawl(names, crawler, parts, args.jobs))
+    logger.warning(f"{results} results and {errors} errors in {time.monotonic() - start:.1f}s, "
+                   f"{crawler.queries} queries ({crawler.soa_hits} SOA lookups memoized) on "
+                   f"{sum(c.opened for c in crawler.connections)} connections, written to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""
+The layout of the test zones: one zone per combination of one or two signing algorithms and subset of their DNSKEYs
+that is removed again, named after the DS and DNSKEY algorithms it ends up with, e.g. ds8-ds13-dnskey13.<origin>.
+"""
+import itertools
+from typing import List, Tuple
+
+import dns.dnssec
+import dns.name
+
+ALGORITHMS = [
+    dns.dnssec.RSASHA1,
+    dns.dnssec.RSASHA256,
+    dns.dnssec.RSASHA512,
+    dns.dnssec.ECDSAP256SHA256,
+    dns.dnssec.ECDSAP384SHA384,
+    dns.dnssec.ED25519,
+    dns.dnssec.ED448,
+]
+
+Zone = Tuple[Tuple[dns.dnssec.Algorithm, ...], List[dns.dnssec.Algorithm], dns.name.Name]
+
+
+def zone_name(algos, remove_dnskeys, origin: dns.name.Name) -> dns.name.Name:
+    return dns.name.from_text(
+        "-".join(
+            [f"ds{a}" for a in sorted(algos)] +
+            [f"dnskey{int(a)}" for a in sorted(set(algos) - set(remove_dnskeys))]
+        ),
+        origin=origin
+    )
+
+
+def zones(origin: dns.name.Name) -> List[Zone]:
+    """All test zones below origin as (signing algorithms, algorithms whose DNSKEY is removed, zone name)."""
+    return [
+        (algos, remove_dnskeys, zone_name(algos, remove_dnskeys, origin))
+        for algos in itertools.chain(itertools.combinations(ALGORITHMS, 1), itertools.combinations(ALGORITHMS, 2))
+        for remove_dnskeys in [[a for i, a in enumerate(algos) if v[i]] for v in itertools.product([True, False], repeat=len(algos))]
+    ]